@@ -0,0 +1,186 @@
+"""Latency of the manager's queue queries over a job table with a long history
+
+    python -m bench.db_queries [--jobs 1000000] [--db sqlite:///bench.sqlite3] [--drop-indexes]
+
+Fills the database with finished jobs and their transitions plus a small live
+queue, then times each query the manager runs on hot paths"""
+import argparse
+import datetime
+import os
+import random
+import statistics
+import tempfile
+import time
+
+from sqlalchemy import event
+
+from mipt_distencode.manager.db_models import (
+    Base, MeltJobHandle, MeltJobState, MeltJobTransition, Session, make_engine, utcnow
+)
+
+
+WORKERS = [f'worker-{i}' for i in range(50)]
+BATCH = 50000
+LIVE = [
+    (MeltJobState.ACCEPTED, 200),
+    (MeltJobState.WAITING_RETRY, 50),
+    (MeltJobState.IN_PROGRESS, 100),
+    (MeltJobState.MERGING, 5),
+]
+
+
+def _job_row(job_id, state, now, rng):
+    worker = rng.choice(WORKERS)
+    row = {
+        'id': job_id,
+        'projectPath': f'/media/share/lecture-{job_id}.mlt',
+        'encodingPresetName': '1080p_nvenc_vbr',
+        'resultPath': f'/media/share/lecture-{job_id}.mp4',
+        'state': state.name,
+        'attempts': 1,
+        'cacheKey': f'{rng.getrandbits(256):064x}',
+        'submitter': 'client-1',
+        'worker': worker,
+        'createdAt': now - datetime.timedelta(minutes=10),
+        'dispatchedAt': now - datetime.timedelta(minutes=9),
+        'startedAt': now - datetime.timedelta(minutes=9),
+        'finishedAt': None,
+        'leaseOwner': None,
+        'leaseDeadline': None,
+    }
+    if state in [MeltJobState.FINISHED, MeltJobState.FAILED]:
+        row['finishedAt'] = now - datetime.timedelta(minutes=1)
+    elif state == MeltJobState.IN_PROGRESS:
+        row['leaseOwner'] = worker
+        row['leaseDeadline'] = now + datetime.timedelta(hours=1)
+    else:
+        row.update(worker=None, dispatchedAt=None, startedAt=None)
+    return row
+
+
+def populate(engine, jobs):
+    rng = random.Random(42)
+    now = utcnow()
+    history_states = [
+        (MeltJobState.FINISHED, 0.95), (MeltJobState.FAILED, 0.05)
+    ]
+    job_table = MeltJobHandle.__table__
+    transition_table = MeltJobTransition.__table__
+    job_id = 0
+    with engine.begin() as connection:
+        while job_id < jobs:
+            rows, transitions = list(), list()
+            for _ in range(min(BATCH, jobs - job_id)):
+                job_id += 1
+                state = rng.choices(
+                    [s for s, _ in history_states], [w for _, w in history_states])[0]
+                row = _job_row(job_id, state, now, rng)
+                rows.append(row)
+                for from_state, to_state in [
+                        (None, MeltJobState.ACCEPTED),
+                        (MeltJobState.ACCEPTED, MeltJobState.IN_PROGRESS),
+                        (MeltJobState.IN_PROGRESS, state)]:
+                    transitions.append({
+                        'jobId': job_id,
+                        'fromState': from_state and from_state.name,
+                        'toState': to_state.name,
+                        'at': now,
+                        'worker': row['worker'],
+                    })
+            connection.execute(job_table.insert(), rows)
+            connection.execute(transition_table.insert(), transitions)
+        live = list()
+        for state, count in LIVE:
+            for _ in range(count):
+                job_id += 1
+                live.append(_job_row(job_id, state, now, rng))
+        connection.execute(job_table.insert(), live)
+    return live
+
+
+def measure(name, query, repeat):
+    timings = list()
+    for _ in range(repeat):
+        started = time.perf_counter()
+        query()
+        timings.append(time.perf_counter() - started)
+    timings.sort()
+    print('{:<24} median {:8.1f} us   p99 {:8.1f} us'.format(
+        name, statistics.median(timings) * 1e6, timings[int(len(timings) * 0.99)] * 1e6))
+
+
+def emitted(engine, query) -> 'List[Tuple[str, tuple]]':
+    """Statements and parameters the query runs"""
+    statements = list()
+
+    def record(connection, cursor, statement, parameters, context, executemany):
+        statements.append((statement, parameters))
+    event.listen(engine, 'before_cursor_execute', record)
+    try:
+        query()
+    finally:
+        event.remove(engine, 'before_cursor_execute', record)
+    return statements
+
+
+def explain(session, statement, parameters):
+    for row in session.connection().exec_driver_sql(
+            f'EXPLAIN QUERY PLAN {statement}', parameters):
+        print('   ', row[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--jobs', type=int, default=10**6)
+    parser.add_argument('--db')
+    parser.add_argument('--repeat', type=int, default=1000)
+    parser.add_argument('--drop-indexes', action='store_true',
+                        help='Compare with the schema before indexes were added')
+    args = parser.parse_args()
+
+    db = args.db
+    if db is None:
+        db = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.sqlite3')
+    engine = make_engine(db, pool_size=1)
+    Base.metadata.create_all(engine)
+    if args.drop_indexes:
+        for index in MeltJobHandle.__table__.indexes | MeltJobTransition.__table__.indexes:
+            index.drop(engine)
+    Session.configure(bind=engine)
+
+    started = time.perf_counter()
+    live = populate(engine, args.jobs)
+    print(f'Populated {db} with {args.jobs} finished jobs in '
+          f'{time.perf_counter() - started:.0f}s')
+
+    rng = random.Random(1)
+    pending = [row for row in live if row['state'] == 'ACCEPTED']
+    parent_id = rng.randrange(1, args.jobs)
+    with Session() as session:
+        queries = {
+            'next_pending': lambda: MeltJobHandle.next_pending(session),
+            'leasable(33)': lambda: MeltJobHandle.leasable(session, 33),
+            'expired_leases': lambda: MeltJobHandle.expired_leases(session, utcnow()),
+            'on_worker(IN_PROGRESS)': lambda: MeltJobHandle.on_worker(
+                session, rng.choice(WORKERS), [MeltJobState.IN_PROGRESS]),
+            'in_flight_with_key': lambda: MeltJobHandle.in_flight_with_key(
+                session, rng.choice(pending)['cacheKey']),
+            # Only the query, the job it is called on is at hand in the manager
+            'segments': lambda: MeltJobHandle(id=parent_id).segments(session),
+            'history': lambda: MeltJobHandle(id=rng.randrange(1, args.jobs)).history(session),
+        }
+        for name, query in queries.items():
+            measure(name, query, args.repeat)
+            session.expunge_all()
+
+        if engine.dialect.name == 'sqlite':
+            print('Query plans:')
+            for name, query in queries.items():
+                for statement, parameters in emitted(engine, query):
+                    print(f'  {name}:')
+                    explain(session, statement, parameters)
+                session.expunge_all()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+"""Queueing delay of small submitters while one submitter floods the queue
+
+    python -m bench.fair_share [--workers 4] [--slots 2] [--bulk-jobs 200] [--seed 1]
+
+Replays the same submissions through the manager's Scheduler twice: with one
+FIFO queue for everybody and with priorities and fair share per submitter.
+Encoding is simulated, time is virtual"""
+import argparse
+import heapq
+import random
+import statistics
+from types import SimpleNamespace
+
+from mipt_distencode.jobs_pb2 import BULK, NORMAL, URGENT
+from mipt_distencode.manager.fair_share import FairShare
+from mipt_distencode.manager.scheduler import LeastLoadedPolicy, Scheduler
+
+
+SMALL_SUBMITTERS = [f'dept-{i}' for i in range(1, 6)]
+HOUR = 3600
+
+
+def submissions(args, rng) -> 'List[SimpleNamespace]':
+    """Jobs with submit time and encode duration, in submit order"""
+    def duration():
+        return rng.lognormvariate(0, 0.3) * args.job_minutes * 60
+
+    jobs = [
+        SimpleNamespace(submitter='dept-bulk', priority=BULK, at=0.0, duration=duration())
+        for _ in range(args.bulk_jobs)
+    ]
+    for submitter in SMALL_SUBMITTERS:
+        for _ in range(rng.randint(1, 3)):
+            jobs.append(SimpleNamespace(
+                submitter=submitter, priority=NORMAL,
+                at=rng.uniform(0, args.hours * HOUR), duration=duration()))
+    jobs.append(SimpleNamespace(
+        submitter='dept-news', priority=URGENT, at=args.hours * HOUR / 2,
+        duration=duration()))
+    jobs.sort(key=lambda job: job.at)
+    for job_id, job in enumerate(jobs, start=1):
+        job.id = job_id
+        job.projectPath = f'/media/share/lecture-{job_id}.mlt'
+        job.encodingPresetName = '1080p_nvenc_vbr'
+        job.estimatedCost = job.duration
+        job.attempts = 0
+    return jobs
+
+
+def simulate(jobs, args, fair) -> 'Dict[int, float]':
+    """Seconds each job waited for a slot"""
+    scheduler = Scheduler(LeastLoadedPolicy(), FairShare({}, {}, args.max_inflight))
+    for index in range(args.workers):
+        scheduler.add_worker(f'worker-{index}', args.slots)
+    by_id = {job.id: job for job in jobs}
+    waits = dict()
+    # (time, order, job id): submissions and completions, completions first
+    events = [(job.at, 1, job.id) for job in jobs]
+    heapq.heapify(events)
+
+    def handle(job):
+        # The FIFO baseline is everybody being one submitter of one priority
+        if fair:
+            return job
+        return SimpleNamespace(
+            id=job.id, submitter=None, priority=NORMAL, projectPath=job.projectPath,
+            encodingPresetName=job.encodingPresetName, estimatedCost=job.estimatedCost,
+            attempts=0)
+
+    def start(job, now):
+        waits[job.id] = now - job.at
+        heapq.heappush(events, (now + job.duration, 0, job.id))
+
+    while events:
+        now, kind, job_id = heapq.heappop(events)
+        job = by_id[job_id]
+        if kind == 1:
+            if scheduler.reserve(handle(job)) is not None:
+                start(job, now)
+            else:
+                scheduler.enqueue(handle(job))
+            continue
+        scheduler.release(job_id)
+        while (pending_id := scheduler.pop_pending()) is not None:
+            pending = by_id[pending_id]
+            if scheduler.reserve(handle(pending)) is None:
+                scheduler.enqueue(handle(pending))
+                break
+            start(pending, now)
+    return waits
+
+
+def report(name, jobs, waits):
+    print(name)
+    print('  {:<12} {:>5} {:>12} {:>12}'.format('submitter', 'jobs', 'median wait', 'max wait'))
+    for submitter in ['dept-bulk', *SMALL_SUBMITTERS, 'dept-news']:
+        submitted = [waits[job.id] / 60 for job in jobs if job.submitter == submitter]
+        print('  {:<12} {:>5} {:>10.0f} m {:>10.0f} m'.format(
+            submitter, len(submitted), statistics.median(submitted), max(submitted)))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--slots', type=int, default=2)
+    parser.add_argument('--bulk-jobs', type=int, default=200)
+    parser.add_argument('--job-minutes', type=float, default=20)
+    parser.add_argument('--hours', type=float, default=4,
+                        help='Small submitters submit during this time')
+    parser.add_argument('--max-inflight', type=int, default=0,
+                        help='Per-submitter in-flight limit, 0 is unlimited')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    jobs = submissions(args, random.Random(args.seed))
+    fifo = simulate(jobs, args, fair=False)
+    fair = simulate(jobs, args, fair=True)
+    report('FIFO', jobs, fifo)
+    report('Priorities and fair share', jobs, fair)
+
+    # A small submitter with nothing in flight has the lowest pass, so it
+    # waits at most until the first slot frees, i.e. one encode
+    longest = max(job.duration for job in jobs)
+    small = [job for job in jobs if job.submitter != 'dept-bulk']
+    worst = max(fair[job.id] for job in small)
+    print(f'Worst wait of small and urgent submitters: {worst / 60:.0f} m, '
+          f'longest encode: {longest / 60:.0f} m, '
+          f'bound {"holds" if worst <= longest else "violated"}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,471 @@
+"""Throughput and latency of a real manager driven by simulated workers
+
+    python -m bench.load [--workers 4] [--slots 2] [--jobs 200] [--rate 20] [--output run.json]
+    python -m bench.load ... --baseline main.json   # exit code 1 on a regression
+
+Starts a manager and worker processes on loopback addresses, each with its
+own throwaway certificate. Workers run scripts/fake-melt.py, which takes as long
+as encoding the project at --melt-fps, sleeping or with --burn spinning a CPU.
+Jobs are submitted at --rate per second, 0 posts them all in batches at once.
+Once every job is done the harness reports dispatch and completion latency
+percentiles from the job history, jobs per second, database and RPC time from
+the manager's metrics and worker utilization from the workers' metrics.
+
+Processes read their Config from the environment at import, so every worker is
+a process of its own. Seeded, the same arguments submit the same jobs"""
+import argparse
+import datetime
+import json
+import math
+import os
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+from concurrent import futures
+
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PRESET_DIR = os.path.join(REPO, 'config', 'presets')
+CLIENT_IDENTITY = 'bench-client'
+METRIC_RE = re.compile(r'^(\w+)(?:\{(.*)\})? (\S+)$')
+LABEL_RE = re.compile(r'(\w+)="((?:[^"\\]|\\.)*)"')
+# Loopback scrapes must not go through an http_proxy of the environment
+OPENER = urllib.request.build_opener(urllib.request.ProxyHandler({}))
+# Results compared with a baseline, the rest depend on the arguments
+LOWER_IS_BETTER = re.compile(r'^failed$|latency|seconds_per_job|_ms$')
+HIGHER_IS_BETTER = re.compile(r'^jobs_per_second$|^worker_utilization$')
+
+
+def make_certs(config_dir, identities):
+    """A CA and a certificate per identity in the layout of pb_common,
+    addresses get an IP subjectAltName so that TLS checks them"""
+    os.makedirs(config_dir)
+
+    def openssl(*args):
+        subprocess.run(['openssl', *args], cwd=config_dir, check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    openssl('req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '2',
+            '-subj', '/CN=distenc-bench-ca', '-keyout', 'ca-private.pem', '-out', 'ca.pem')
+    for identity in identities:
+        openssl('req', '-newkey', 'rsa:2048', '-nodes', '-subj', f'/CN={identity}',
+                '-keyout', f'{identity}-private.pem', '-out', f'{identity}.csr')
+        extensions = os.path.join(config_dir, f'{identity}.ext')
+        with open(extensions, 'w') as f:
+            if re.fullmatch(r'[\d.]+', identity):
+                f.write(f'subjectAltName=IP:{identity}\n')
+        openssl('x509', '-req', '-days', '2', '-in', f'{identity}.csr',
+                '-CA', 'ca.pem', '-CAkey', 'ca-private.pem', '-CAcreateserial',
+                '-extfile', extensions, '-out', f'{identity}-cert.pem')
+
+
+def make_projects(project_dir, args, rng) -> 'List[str]':
+    """MLT projects of lognormally distributed length around --frames"""
+    os.makedirs(project_dir)
+    paths = list()
+    for index in range(args.projects):
+        frames = max(int(rng.lognormvariate(math.log(args.frames), 0.5)), 1)
+        path = os.path.join(project_dir, f'project-{index}.mlt')
+        with open(path, 'w') as f:
+            f.write('<mlt><profile frame_rate_num="30" frame_rate_den="1" '
+                    'width="1920" height="1080"/>'
+                    f'<tractor id="t" in="0" out="{frames - 1}"/></mlt>\n')
+        paths.append(path)
+    return paths
+
+
+def job_specs(projects, result_dir, args, rng) -> 'List[Dict]':
+    presets = sorted(name[:-len('.json')] for name in os.listdir(PRESET_DIR)
+                     if name.endswith('.json'))
+    return [{
+        'projectPath': rng.choice(projects),
+        'encodingPresetName': rng.choice(presets),
+        'resultPath': os.path.join(result_dir, f'job-{index}.mp4'),
+    } for index in range(args.jobs)]
+
+
+class Cluster:
+    """The manager and worker processes, each in its own directory with the
+    shared certificates, logs go to <directory>/server.log"""
+    def __init__(self, workdir, args):
+        self.workdir = workdir
+        self.args = args
+        prefix = args.address_prefix
+        self.manager = f'{prefix}.1'
+        self.workers = [f'{prefix}.{index}' for index in range(2, args.workers + 2)]
+        self.db_path = os.path.join(workdir, self.manager, 'manager.sqlite3')
+        self.processes = list()
+
+    def start(self):
+        make_certs(os.path.join(self.workdir, 'config'),
+                   [self.manager, *self.workers, CLIENT_IDENTITY])
+        self._spawn('mipt_distencode.manager.server', self.manager, {
+            'DISTENC_DB': f'sqlite:///{self.db_path}',
+            'DISTENC_SCHEDULER_POLICY': self.args.policy,
+            'DISTENC_MAX_OUTPUTS_PER_JOB': str(self.args.max_outputs),
+        })
+        wait_for(lambda: scrape(self.manager, 9452), 'manager')
+        for worker in self.workers:
+            self._spawn('mipt_distencode.worker.server', worker, {
+                'DISTENC_MANAGER_ADDR': self.manager,
+                'DISTENC_MELT': os.path.join(REPO, 'scripts', 'fake-melt.py'),
+                'DISTENC_WORKER_SLOTS': str(self.args.slots),
+                # Slots are the limit, not the resources of the bench machine
+                'DISTENC_WORKER_RESOURCES': 'cpu_threads=4096,encoder_sessions=4096,'
+                                            'memory_mb=1048576',
+                'FAKE_MELT_FPS': str(self.args.melt_fps),
+                'FAKE_MELT_BURN': '1' if self.args.burn else '0',
+            })
+        wait_for(lambda: self.registered_workers() >= len(self.workers), 'workers')
+
+    def _spawn(self, module, identity, extra_env):
+        directory = os.path.join(self.workdir, identity)
+        os.makedirs(directory, exist_ok=True)
+        os.symlink(os.path.join(self.workdir, 'config'), os.path.join(directory, 'config'))
+        env = dict(os.environ)
+        env.update({
+            'PYTHONPATH': REPO,
+            'DISTENC_IDENTITY': identity,
+            'DISTENC_METRICS_ADDR': identity,
+            'DISTENC_DISPATCH_MODE': self.args.dispatch_mode,
+            'DISTENC_MELT_PRESET_DIR': PRESET_DIR,
+            'DISTENC_FFPROBE': os.path.join(REPO, 'scripts', 'fake-ffprobe.py'),
+        }, **extra_env)
+        env.update(self.args.env)
+        with open(os.path.join(directory, 'server.log'), 'wb') as log:
+            self.processes.append(subprocess.Popen(
+                [sys.executable, '-m', module], cwd=directory, env=env,
+                stdout=log, stderr=subprocess.STDOUT))
+
+    def registered_workers(self) -> int:
+        metrics = scrape(self.manager, 9452) or {}
+        return sum(1 for (name, labels) in metrics
+                   if name == 'distenc_worker_slots' and ('kind', 'total') in labels)
+
+    def stop(self):
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+
+
+def wait_for(condition, what, timeout=60):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise RuntimeError(f'Timed out waiting for {what}')
+        time.sleep(0.2)
+
+
+def scrape(address, port) -> 'Optional[Dict[Tuple[str, frozenset], float]]':
+    """{(name, frozenset of label pairs): value} from a metrics endpoint"""
+    try:
+        with OPENER.open(f'http://{address}:{port}/metrics', timeout=5) as r:
+            text = r.read().decode('utf-8')
+    except (urllib.error.URLError, OSError):
+        return None
+    samples = dict()
+    for line in text.splitlines():
+        match = METRIC_RE.match(line)
+        if match is None:
+            continue
+        name, labels, value = match.groups()
+        samples[(name, frozenset(LABEL_RE.findall(labels or '')))] = float(value)
+    return samples
+
+
+def histogram(samples, name, **labels) -> 'Tuple[float, float, List[Tuple[float, float]]]':
+    """Sum, count and cumulative (bound, count) buckets of one series"""
+    wanted = set(labels.items())
+    total = count = 0.0
+    buckets = list()
+    for (sample, pairs), value in samples.items():
+        if not wanted <= pairs:
+            continue
+        if sample == f'{name}_sum':
+            total += value
+        elif sample == f'{name}_count':
+            count += value
+        elif sample == f'{name}_bucket':
+            buckets.append((float(dict(pairs)['le']), value))
+    return total, count, sorted(buckets)
+
+
+def bucket_quantile(buckets, q) -> 'Optional[float]':
+    """Quantile interpolated within buckets, as histogram_quantile does"""
+    if not buckets or buckets[-1][1] == 0:
+        return None
+    rank = q * buckets[-1][1]
+    lower, below = 0.0, 0.0
+    for bound, cumulative in buckets:
+        if cumulative >= rank:
+            if math.isinf(bound):
+                return lower
+            return lower + (bound - lower) * (rank - below) / max(cumulative - below, 1)
+        lower, below = bound, cumulative
+    return lower
+
+
+def percentiles(values) -> 'Dict[str, float]':
+    if not values:
+        return {}
+    values = sorted(values)
+
+    def at(q):
+        return values[min(int(q * len(values)), len(values) - 1)]
+    return {'p50': at(0.5), 'p90': at(0.9), 'p99': at(0.99), 'max': values[-1]}
+
+
+def submit(cluster, specs, args) -> 'List[float]':
+    """Posts the jobs at the target rate, returns RPC latencies in ms"""
+    # The client reads its identity and certificates like the servers do
+    client_dir = os.path.join(cluster.workdir, CLIENT_IDENTITY)
+    os.makedirs(client_dir)
+    os.symlink(os.path.join(cluster.workdir, 'config'), os.path.join(client_dir, 'config'))
+    os.chdir(client_dir)
+    os.environ['DISTENC_IDENTITY'] = CLIENT_IDENTITY
+    from google.protobuf.json_format import ParseDict
+    from mipt_distencode import jobs_pb2
+    from mipt_distencode.manager.client import make_client
+
+    client = make_client(endpoint=f'{cluster.manager}:50052', secure=True)
+    jobs = [ParseDict(spec, jobs_pb2.MeltJob()) for spec in specs]
+
+    def post(call, message):
+        started = time.perf_counter()
+        call(message)
+        return (time.perf_counter() - started) * 1e3
+
+    if args.rate <= 0:
+        return [post(client.PostMeltJobs, jobs_pb2.MeltJobBatch(jobs=jobs[start:start + 100]))
+                for start in range(0, len(jobs), 100)]
+    # Open loop: a slow manager does not slow the submissions down
+    started = time.monotonic()
+    with futures.ThreadPoolExecutor(max_workers=16) as pool:
+        posted = list()
+        for index, job in enumerate(jobs):
+            delay = started + index / args.rate - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            posted.append(pool.submit(post, client.PostMeltJob, job))
+        return [future.result() for future in posted]
+
+
+def wait_until_done(cluster, expected, timeout):
+    from mipt_distencode.manager.db_models import LIVE_STATES, MeltJobHandle, make_engine
+    from sqlalchemy.orm import Session
+
+    engine = make_engine(f'sqlite:///{cluster.db_path}', pool_size=1)
+    deadline = time.monotonic() + timeout
+    with Session(engine) as session:
+        while True:
+            total = session.query(MeltJobHandle).count()
+            live = session.query(MeltJobHandle) \
+                .filter(MeltJobHandle.state.in_(LIVE_STATES)).count()
+            if total >= expected and live == 0:
+                return engine
+            if time.monotonic() > deadline:
+                raise RuntimeError(f'Timed out with {live} of {total} jobs not done')
+            session.rollback()
+            time.sleep(0.5)
+
+
+def job_latencies(engine) -> 'Dict':
+    """Latencies from the job history: to the first dispatch, bundling
+    counts as one, and to FINISHED, plus the span of the whole run"""
+    from mipt_distencode.manager.db_models import MeltJobHandle, MeltJobState, MeltJobTransition
+    from sqlalchemy.orm import Session
+
+    dispatched = dict()
+    finished = dict()
+    with Session(engine) as session:
+        created = dict(session.query(MeltJobHandle.id, MeltJobHandle.createdAt)
+                       .filter(MeltJobHandle.parentId.is_(None),
+                               MeltJobHandle.speculativeOf.is_(None)))
+        states = dict(session.query(MeltJobHandle.id, MeltJobHandle.state))
+        for job_id, to_state, at in session.query(
+                MeltJobTransition.jobId, MeltJobTransition.toState, MeltJobTransition.at) \
+                .order_by(MeltJobTransition.id):
+            if to_state in [MeltJobState.IN_PROGRESS, MeltJobState.BUNDLED]:
+                dispatched.setdefault(job_id, at)
+            elif to_state == MeltJobState.FINISHED:
+                finished.setdefault(job_id, at)
+
+    def seconds(ends):
+        return [(ends[job_id] - at).total_seconds()
+                for job_id, at in created.items() if job_id in ends]
+
+    done = [finished[job_id] for job_id in created if job_id in finished]
+    span = (max(done) - min(created.values())).total_seconds() if done else 0.0
+    return {
+        'jobs': len(created),
+        'finished': len(done),
+        'failed': sum(1 for job_id in created if states[job_id] == MeltJobState.FAILED),
+        'span_seconds': span,
+        'jobs_per_second': len(done) / span if span > 0 else 0.0,
+        'dispatch_latency_seconds': percentiles(seconds(dispatched)),
+        'completion_latency_seconds': percentiles(seconds(finished)),
+    }
+
+
+def server_metrics(cluster, span, finished) -> 'Dict':
+    manager = scrape(cluster.manager, 9452) or {}
+    rpc = dict()
+    methods = {dict(labels)['method'] for name, labels in manager
+               if name == 'distenc_rpc_duration_seconds_count'}
+    for method in sorted(methods):
+        total, count, buckets = histogram(manager, 'distenc_rpc_duration_seconds',
+                                          method=method)
+        p95 = bucket_quantile(buckets, 0.95)
+        rpc[method.rsplit('/', 1)[-1]] = {
+            'calls': int(count),
+            'mean_ms': total / count * 1e3,
+            'p95_ms': p95 * 1e3 if p95 is not None else None,
+        }
+    db_seconds, statements, _ = histogram(manager, 'distenc_db_statement_seconds')
+    melt_seconds = 0.0
+    for worker in cluster.workers:
+        melt_seconds += histogram(scrape(worker, 9453) or {}, 'distenc_melt_seconds')[0]
+    capacity = len(cluster.workers) * cluster.args.slots * span
+    return {
+        'rpc': rpc,
+        'db_statements': int(statements),
+        'db_seconds': db_seconds,
+        'db_seconds_per_job': db_seconds / finished if finished else None,
+        'worker_utilization': melt_seconds / capacity if capacity else None,
+    }
+
+
+def revision() -> 'Optional[str]':
+    try:
+        head = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO, check=True,
+                              capture_output=True, text=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'],
+                               cwd=REPO, capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return head + ('-dirty' if dirty else '')
+
+
+def flatten(results, prefix='') -> 'Dict[str, float]':
+    flat = dict()
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, f'{prefix}{key}.'))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[prefix + key] = value
+    return flat
+
+
+def compare(results, baseline, tolerance) -> 'List[str]':
+    """Keys of the baseline that got worse by more than tolerance"""
+    current = flatten(results)
+    regressions = list()
+    for key, before in flatten(baseline).items():
+        after = current.get(key)
+        lower_is_better = LOWER_IS_BETTER.search(key)
+        if after is None or not (lower_is_better or HIGHER_IS_BETTER.search(key)):
+            continue
+        if before:
+            change = (after - before) / abs(before)
+        else:
+            change = math.inf if after > 0 else 0.0
+        worse = change > tolerance if lower_is_better else -change > tolerance
+        print(f'  {key:<52} {before:12.4g} -> {after:12.4g} {change:+8.1%}'
+              f'{"  REGRESSION" if worse else ""}')
+        if worse:
+            regressions.append(key)
+    return regressions
+
+
+def parse_env(value) -> 'Tuple[str, str]':
+    name, _, setting = value.partition('=')
+    return name, setting
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--slots', type=int, default=2)
+    parser.add_argument('--jobs', type=int, default=200)
+    parser.add_argument('--rate', type=float, default=20,
+                        help='Jobs submitted per second, 0 posts all at once')
+    parser.add_argument('--projects', type=int, default=20)
+    parser.add_argument('--frames', type=int, default=300,
+                        help='Median project length in frames')
+    parser.add_argument('--melt-fps', type=float, default=600,
+                        help='Speed of the fake melt, frames per second')
+    parser.add_argument('--burn', action='store_true',
+                        help='Fake melt spins a CPU instead of sleeping')
+    parser.add_argument('--dispatch-mode', choices=['push', 'pull'], default='push')
+    parser.add_argument('--policy', default='least-loaded')
+    parser.add_argument('--max-outputs', type=int, default=4)
+    parser.add_argument('--env', type=parse_env, action='append', default=[],
+                        metavar='NAME=VALUE', help='Extra environment of all servers')
+    parser.add_argument('--address-prefix', default='127.0.77',
+                        help='Loopback /24 of the processes, the manager is .1')
+    parser.add_argument('--timeout', type=float, default=600)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='Write results to this JSON file')
+    parser.add_argument('--baseline', help='JSON of an earlier run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Relative change of a result that counts as a regression')
+    parser.add_argument('--keep', action='store_true', help='Keep the work directory')
+    args = parser.parse_args()
+    args.env = dict(args.env)
+
+    rng = random.Random(args.seed)
+    workdir = tempfile.mkdtemp(prefix='distenc-bench-')
+    cluster = Cluster(workdir, args)
+    try:
+        projects = make_projects(os.path.join(workdir, 'projects'), args, rng)
+        os.makedirs(os.path.join(workdir, 'results'))
+        specs = job_specs(projects, os.path.join(workdir, 'results'), args, rng)
+        cluster.start()
+        post_ms = submit(cluster, specs, args)
+        engine = wait_until_done(cluster, len(specs), args.timeout)
+        results = job_latencies(engine)
+        results['post_latency_ms'] = percentiles(post_ms)
+        results.update(server_metrics(cluster, results['span_seconds'], results['finished']))
+    finally:
+        cluster.stop()
+        if args.keep:
+            print(f'Work directory: {workdir}')
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        'revision': revision(),
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        'arguments': {key: value for key, value in vars(args).items()
+                      if key not in ['output', 'baseline', 'keep']},
+        'results': results,
+    }
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        print(f'Compared with {baseline.get("revision")} of {baseline.get("date")}:')
+        if baseline.get('arguments') != report['arguments']:
+            print('  arguments differ, results may not be comparable')
+        regressions = compare(results, baseline['results'], args.tolerance)
+        if regressions:
+            print(f'{len(regressions)} results regressed by more than {args.tolerance:.0%}')
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
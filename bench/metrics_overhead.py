@@ -0,0 +1,103 @@
+"""Cost of the metrics interceptor on the gRPC hot path
+
+    python -m bench.metrics_overhead [--calls 20000] [--rounds 3]
+
+Times a trivial unary method over a local channel on a server with and
+without MetricsInterceptor, and the interceptor wrapper alone called in
+process, so the recording cost is not lost in transport noise"""
+import argparse
+import statistics
+import time
+from concurrent import futures
+
+import grpc
+
+from mipt_distencode.metrics import REGISTRY, MetricsInterceptor
+
+
+METHOD = '/bench.Echo/Echo'
+
+
+def echo(request, context):
+    return request
+
+
+def make_server(interceptors) -> 'Tuple[grpc.Server, int]':
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=4), interceptors=interceptors)
+    handler = grpc.unary_unary_rpc_method_handler(echo)
+    server.add_generic_rpc_handlers([
+        grpc.method_handlers_generic_handler('bench.Echo', {'Echo': handler})])
+    port = server.add_insecure_port('127.0.0.1:0')
+    server.start()
+    return server, port
+
+
+def time_calls(port, calls) -> 'List[float]':
+    """Microseconds per call"""
+    with grpc.insecure_channel(f'127.0.0.1:{port}') as channel:
+        call = channel.unary_unary(METHOD)
+        for _ in range(min(calls, 1000)):
+            call(b'x')
+        latencies = list()
+        for _ in range(calls):
+            started = time.perf_counter()
+            call(b'x')
+            latencies.append((time.perf_counter() - started) * 1e6)
+    return latencies
+
+
+class _Context:
+    def code(self):
+        return None
+
+
+def time_wrapper(calls) -> 'Tuple[float, float]':
+    """Microseconds per direct call of the handler, bare and wrapped"""
+    handler = grpc.unary_unary_rpc_method_handler(echo)
+    details = type('Details', (), {'method': METHOD})()
+    wrapped = MetricsInterceptor().intercept_service(lambda _: handler, details).unary_unary
+    context = _Context()
+    results = list()
+    for behavior in [echo, wrapped]:
+        started = time.perf_counter()
+        for _ in range(calls):
+            behavior(b'x', context)
+        results.append((time.perf_counter() - started) / calls * 1e6)
+    return results[0], results[1]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--calls', type=int, default=20000)
+    parser.add_argument('--rounds', type=int, default=3)
+    args = parser.parse_args()
+
+    medians = {'plain': list(), 'metrics': list()}
+    # Alternate to spread drift of the machine over both
+    for _ in range(args.rounds):
+        for name, interceptors in [('plain', []), ('metrics', [MetricsInterceptor()])]:
+            server, port = make_server(interceptors)
+            try:
+                medians[name].append(statistics.median(time_calls(port, args.calls)))
+            finally:
+                server.stop(None)
+    plain = statistics.median(medians['plain'])
+    metrics = statistics.median(medians['metrics'])
+    print(f'unary RPC over loopback, median of {args.rounds} rounds x {args.calls} calls')
+    print(f'  without interceptor {plain:8.1f} us')
+    print(f'  with interceptor    {metrics:8.1f} us  ({metrics - plain:+.1f} us, '
+          f'{(metrics - plain) / plain:+.1%})')
+
+    bare, wrapped = time_wrapper(args.calls * 10)
+    print(f'handler called in process, {args.calls * 10} calls')
+    print(f'  bare                {bare:8.2f} us')
+    print(f'  recorded            {wrapped:8.2f} us  ({wrapped - bare:+.2f} us per call)')
+
+    started = time.perf_counter()
+    body = REGISTRY.render()
+    print(f'scrape of {len(body.splitlines())} lines: '
+          f'{(time.perf_counter() - started) * 1e3:.2f} ms')
+
+
+if __name__ == '__main__':
+    main()
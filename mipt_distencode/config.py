@@ -6,4 +6,106 @@ class Config:
     db = os.environ.get('DISTENC_DB')
     melt_path = os.environ.get('DISTENC_MELT')
     melt_preset_dir = os.environ.get('DISTENC_MELT_PRESET_DIR')
-    manager_address = os.environ.get('DISTENC_MANAGER_ADDR')
+    # Comma-separated manager replicas, clients fail over between them in order
+    manager_addresses = [
+        address.strip() for address in os.environ.get('DISTENC_MANAGER_ADDR', '').split(',')
+        if address.strip()
+    ]
+    # Comma-separated client identities that see the jobs of every submitter,
+    # besides manager replicas; others only list and watch their own jobs
+    admin_identities = [
+        identity.strip() for identity in os.environ.get('DISTENC_ADMINS', '').split(',')
+        if identity.strip()
+    ]
+    ffmpeg_path = os.environ.get('DISTENC_FFMPEG', 'ffmpeg')
+    ffprobe_path = os.environ.get('DISTENC_FFPROBE', 'ffprobe')
+    # Results are probed and hashed by this many manager threads before FINISHED
+    verify_threads = int(os.environ.get('DISTENC_VERIFY_THREADS', '2'))
+    # Frames the result may differ from the project and preset by
+    verify_frame_tolerance = int(os.environ.get('DISTENC_VERIFY_FRAME_TOLERANCE', '2'))
+    # Split projects longer than this into segments, 0 disables splitting
+    segment_frames = int(os.environ.get('DISTENC_SEGMENT_FRAMES', '0'))
+    # Attempts per job including the first, a failed attempt is retried with
+    # exponential backoff on another worker if there is one
+    job_max_attempts = int(os.environ.get('DISTENC_JOB_MAX_ATTEMPTS', '3'))
+    retry_backoff_seconds = float(os.environ.get('DISTENC_RETRY_BACKOFF_SECONDS', '10'))
+    retry_backoff_max_seconds = float(os.environ.get('DISTENC_RETRY_BACKOFF_MAX_SECONDS', '600'))
+    # A started job without progress reports for this long has failed
+    job_stall_seconds = float(os.environ.get('DISTENC_JOB_STALL_SECONDS', '300'))
+    # Duplicate jobs running longer than this times the expected time, 0 disables
+    speculation_factor = float(os.environ.get('DISTENC_SPECULATION_FACTOR', '2'))
+    supervise_interval_seconds = float(os.environ.get('DISTENC_SUPERVISE_INTERVAL_SECONDS', '5'))
+    # One of: least-loaded, bin-packing, affinity, makespan
+    scheduler_policy = os.environ.get('DISTENC_SCHEDULER_POLICY', 'least-loaded')
+    # Order of a submitter's pending jobs: fifo or sjf, cheapest estimate first
+    queue_order = os.environ.get('DISTENC_QUEUE_ORDER', 'fifo')
+    # Share of workers per submitter identity (client certificate CN), e.g.
+    # dept-video=3,dept-lectures=1, unlisted identities have weight 1
+    fair_share_weights = os.environ.get('DISTENC_FAIR_SHARE_WEIGHTS')
+    # In-flight job limits per identity in the same format, 0 is unlimited
+    fair_share_limits = os.environ.get('DISTENC_FAIR_SHARE_LIMITS')
+    fair_share_max_inflight = int(os.environ.get('DISTENC_FAIR_SHARE_MAX_INFLIGHT', '0'))
+    # Pending jobs of the same project and frames with different presets are
+    # rendered by one melt run with up to this many outputs, 1 disables
+    max_outputs_per_job = int(os.environ.get('DISTENC_MAX_OUTPUTS_PER_JOB', '4'))
+    # push: manager sends jobs to workers, pull: workers lease jobs from manager
+    dispatch_mode = os.environ.get('DISTENC_DISPATCH_MODE', 'push')
+    lease_seconds = int(os.environ.get('DISTENC_LEASE_SECONDS', '60'))
+    lease_poll_seconds = float(os.environ.get('DISTENC_LEASE_POLL_SECONDS', '2'))
+    lease_wait_seconds = int(os.environ.get('DISTENC_LEASE_WAIT_SECONDS', '20'))
+    # Manager replicas sharing the database renew a lease row every supervision
+    # round, another replica takes over the workers and jobs of one that stops
+    replica_lease_seconds = int(os.environ.get('DISTENC_REPLICA_LEASE_SECONDS', '30'))
+    # Each long-polling worker holds one thread, keep well above the worker count
+    manager_threads = int(os.environ.get('DISTENC_MANAGER_THREADS', '32'))
+    # WatchJobs streams waiting for state changes on the aio endpoint cost a
+    # queue each, the rest are turned away
+    max_watchers = int(os.environ.get('DISTENC_MAX_WATCHERS', '10000'))
+    # State changes made by other replicas reach watchers within this interval
+    watch_poll_seconds = float(os.environ.get('DISTENC_WATCH_POLL_SECONDS', '1'))
+    # A transition id skipped by the watchers is looked for this long, as the
+    # transaction that took it may commit after a later one
+    watch_gap_seconds = float(os.environ.get('DISTENC_WATCH_GAP_SECONDS', '30'))
+    # Pooled gRPC channels without calls drop their connection after this long
+    channel_idle_seconds = float(os.environ.get('DISTENC_CHANNEL_IDLE_SECONDS', '300'))
+    worker_slots = int(os.environ.get('DISTENC_WORKER_SLOTS', str(os.cpu_count() or 1)))
+    # e.g. cpu_threads=32,encoder_sessions=3,memory_mb=65536, see worker/resources.py
+    worker_resources = os.environ.get('DISTENC_WORKER_RESOURCES')
+    # Limit of a melt run unless the job sets timeoutSeconds, 0 is unlimited
+    melt_timeout_seconds = int(os.environ.get('DISTENC_MELT_TIMEOUT_SECONDS', '0'))
+    # nice level of melt per job priority, bulk jobs also get the idle I/O class
+    melt_nice = os.environ.get('DISTENC_MELT_NICE', 'bulk=10,normal=5,urgent=0')
+    # Urgent jobs without a free slot suspend running bulk jobs on the worker
+    preempt_bulk_jobs = os.environ.get('DISTENC_PREEMPT_BULK_JOBS', '1') == '1'
+    worker_rpc_threads = int(os.environ.get('DISTENC_WORKER_RPC_THREADS', '16'))
+    progress_interval_seconds = float(os.environ.get('DISTENC_PROGRESS_INTERVAL_SECONDS', '10'))
+    log_dir = os.environ.get('DISTENC_LOG_DIR', 'logs')
+    # Bytes of melt output kept in memory and sent with MeltJobResult
+    log_tail_bytes = int(os.environ.get('DISTENC_LOG_TAIL_BYTES', '16384'))
+    # Unset disables the result cache, the manager also needs DISTENC_MELT_PRESET_DIR
+    result_cache_dir = os.environ.get('DISTENC_RESULT_CACHE_DIR')
+    result_cache_max_gb = float(os.environ.get('DISTENC_RESULT_CACHE_MAX_GB', '100'))
+    result_cache_max_age_days = float(os.environ.get('DISTENC_RESULT_CACHE_MAX_AGE_DAYS', '30'))
+    # Worker-local copies of source media, unset reads media from its path directly
+    media_cache_dir = os.environ.get('DISTENC_MEDIA_CACHE_DIR')
+    media_cache_max_gb = float(os.environ.get('DISTENC_MEDIA_CACHE_MAX_GB', '50'))
+    media_prefetch_threads = int(os.environ.get('DISTENC_MEDIA_PREFETCH_THREADS', '2'))
+    # Filesystem of the results, its free space is reported in Worker.GetState
+    result_disk_path = os.environ.get('DISTENC_RESULT_DISK_PATH', '.')
+    # Workers failing health_max_failures polls in a row are excluded and their jobs requeued
+    health_interval_seconds = float(os.environ.get('DISTENC_HEALTH_INTERVAL_SECONDS', '2'))
+    health_timeout_seconds = float(os.environ.get('DISTENC_HEALTH_TIMEOUT_SECONDS', '2'))
+    health_max_failures = int(os.environ.get('DISTENC_HEALTH_MAX_FAILURES', '2'))
+    # shared: workers write resultPath on storage mounted everywhere, upload:
+    # workers encode to scratch_dir and stream results to the manager
+    result_transfer = os.environ.get('DISTENC_RESULT_TRANSFER', 'shared')
+    scratch_dir = os.environ.get('DISTENC_SCRATCH_DIR', 'scratch')
+    transfer_chunk_bytes = int(os.environ.get('DISTENC_TRANSFER_CHUNK_KB', '1024')) * 1024
+    transfer_threads = int(os.environ.get('DISTENC_TRANSFER_THREADS', '2'))
+    # Results are kept here until the manager acknowledges them
+    result_journal_dir = os.environ.get('DISTENC_RESULT_JOURNAL_DIR', 'result-journal')
+    result_replay_seconds = float(os.environ.get('DISTENC_RESULT_REPLAY_SECONDS', '5'))
+    # Prometheus text metrics at http://metrics_address:port/metrics, 0 disables
+    metrics_address = os.environ.get('DISTENC_METRICS_ADDR', '127.0.0.1')
+    manager_metrics_port = int(os.environ.get('DISTENC_MANAGER_METRICS_PORT', '9452'))
+    worker_metrics_port = int(os.environ.get('DISTENC_WORKER_METRICS_PORT', '9453'))
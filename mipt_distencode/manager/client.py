@@ -1,26 +1,212 @@
+import functools
+import itertools
+import json
 import logging
 import sys
+import threading
+import time
 
 import grpc
+from google.protobuf.json_format import ParseDict, ParseError
 from google.protobuf.text_format import MessageToString
 
 from mipt_distencode.manager.manager_pb2_grpc import ManagerStub
 from mipt_distencode import jobs_pb2, mgmt_messages_pb2
-from mipt_distencode.pb_common import make_channel
+from mipt_distencode.config import Config
+from mipt_distencode.pb_common import channel_pool
 
 
 def make_client(channel=None, **kwargs) -> ManagerStub:
     if channel and kwargs:
         raise ValueError('Specify either channel or construction kwargs')
     if channel is None:
-        channel = make_channel(**kwargs)
+        channel = channel_pool.get(**kwargs)
     return ManagerStub(channel)
 
 
+class FailoverClient:
+    """ManagerStub over manager replicas sharing the database
+
+    Calls go to the current replica, UNAVAILABLE makes the next one current.
+    Unary requests are retried there until every replica was tried, streamed
+    requests cannot be replayed and fail, as do response streams once started"""
+    # WatchJobs is served on an endpoint of its own
+    PORTS = {'WatchJobs': 50054}
+
+    def __init__(self, addresses, secure=True):
+        if not addresses:
+            raise ValueError('No manager addresses, set DISTENC_MANAGER_ADDR')
+        self.addresses = list(addresses)
+        self.secure = secure
+        self.current = 0
+        self.lock = threading.Lock()
+        self.logger = logging.getLogger(__name__)
+
+    def prefer(self, address) -> bool:
+        """Make the replica current, e.g. the one that polls this worker"""
+        with self.lock:
+            if address not in self.addresses:
+                return False
+            self.current = self.addresses.index(address)
+            return True
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        def call(request, **kwargs):
+            for attempt in range(len(self.addresses)):
+                index, stub = self._current_stub(self.PORTS.get(name, 50052))
+                method = getattr(stub, name)
+                try:
+                    response = method(request, **kwargs)
+                except grpc.RpcError as e:
+                    if e.code() != grpc.StatusCode.UNAVAILABLE:
+                        raise
+                    self._failed(index, e)
+                    if attempt == len(self.addresses) - 1 or isinstance(
+                            method, (grpc.StreamUnaryMultiCallable,
+                                     grpc.StreamStreamMultiCallable)):
+                        raise
+                    continue
+                if isinstance(method, grpc.UnaryStreamMultiCallable):
+                    return self._watch(index, response)
+                return response
+        return call
+
+    def _current_stub(self, port) -> 'Tuple[int, ManagerStub]':
+        with self.lock:
+            index = self.current
+        return index, make_client(
+            endpoint=f'{self.addresses[index]}:{port}', secure=self.secure)
+
+    def _failed(self, index, error):
+        with self.lock:
+            # Concurrent calls failing on the same replica move on once
+            if self.current != index:
+                return
+            self.current = (index + 1) % len(self.addresses)
+            self.logger.warning('Manager %s is unavailable, switching to %s: %s',
+                                self.addresses[index], self.addresses[self.current],
+                                error.details())
+
+    def _watch(self, index, responses):
+        try:
+            yield from responses
+        except grpc.RpcError as e:
+            if e.code() == grpc.StatusCode.UNAVAILABLE:
+                self._failed(index, e)
+            raise
+
+
+@functools.lru_cache(maxsize=None)
+def _failover_client(addresses, secure) -> FailoverClient:
+    return FailoverClient(addresses, secure)
+
+
+def make_replica_client(addresses=None, secure=True) -> FailoverClient:
+    """Client of the manager replicas, DISTENC_MANAGER_ADDR by default.
+    Clients of the same replicas share which one is current"""
+    return _failover_client(tuple(addresses or Config.manager_addresses), secure)
+
+
+DEFAULT_BATCH_SIZE = 100
+
+
+def read_job_specs(lines):
+    """Yields (line number, MeltJob or error) for JSONL with MeltJob fields, e.g.
+    {"projectPath": "a.mlt", "encodingPresetName": "1080p_nvenc_vbr", "resultPath": "a.mp4"}"""
+    for number, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        try:
+            yield number, ParseDict(json.loads(line), jobs_pb2.MeltJob())
+        except (ValueError, ParseError) as e:
+            yield number, 'Invalid job spec: ' + ' '.join(str(e).split())
+
+
+def post_jobs(client, specs, batch_size, accepted=None) -> int:
+    """Submits jobs in batches, prints an id or an error per line, returns error count.
+    Ids of the posted jobs are appended to accepted if given"""
+    errors = 0
+    specs = iter(specs)
+    while batch := list(itertools.islice(specs, batch_size)):
+        outcomes = {
+            number: ('error', job) for number, job in batch if isinstance(job, str)
+        }
+        jobs = [(number, job) for number, job in batch if number not in outcomes]
+        try:
+            result = client.PostMeltJobs(
+                jobs_pb2.MeltJobBatch(jobs=[job for _, job in jobs]))
+            for (number, _), submission in zip(jobs, result.submissions):
+                if submission.HasField('error'):
+                    outcomes[number] = ('error', submission.error)
+                else:
+                    outcomes[number] = ('id', submission.id.id)
+                    if accepted is not None:
+                        accepted.append(submission.id.id)
+        except grpc.RpcError as e:
+            for number, _ in jobs:
+                outcomes[number] = ('error', f'{e.code().name}: {e.details()}')
+        for number, (kind, value) in sorted(outcomes.items()):
+            print(f'{number}\t{kind}\t{value}')
+            errors += kind == 'error'
+        sys.stdout.flush()
+    return errors
+
+
+ENDED_STATES = [jobs_pb2.FINISHED, jobs_pb2.FAILED, jobs_pb2.CANCELLED]
+RECONNECT_SECONDS = 1.0
+
+
+def format_status(status) -> str:
+    line = f'{status.id.id}\t{jobs_pb2.JobState.Name(status.state)}'
+    if status.HasField('progress') and status.state == jobs_pb2.IN_PROGRESS:
+        line += f'\t{status.progress.percent}%'
+    return line
+
+
+def wait_for_jobs(client, job_ids) -> int:
+    """Prints state changes of the jobs until all are over, returns how many
+    did not finish. A stream broken by a failover is opened again on the next
+    replica, it starts with the current states"""
+    pending = set(job_ids)
+    states = dict()
+    failed = 0
+    while pending:
+        watch = jobs_pb2.JobWatch(ids=[jobs_pb2.JobId(id=job_id) for job_id in sorted(pending)])
+        try:
+            for status in client.WatchJobs(watch):
+                if states.get(status.id.id) != status.state:
+                    states[status.id.id] = status.state
+                    print(format_status(status))
+                    sys.stdout.flush()
+                if status.state in ENDED_STATES and status.id.id in pending:
+                    pending.discard(status.id.id)
+                    failed += status.state != jobs_pb2.FINISHED
+        except grpc.RpcError as e:
+            if e.code() != grpc.StatusCode.UNAVAILABLE:
+                raise
+            time.sleep(RECONNECT_SECONDS)
+    return failed
+
+
+def list_jobs(client, query):
+    """Yields JobStatus of all pages"""
+    while True:
+        page = client.ListJobs(query)
+        yield from page.jobs
+        if not page.HasField('nextPageToken'):
+            return
+        query.pageToken = page.nextPageToken
+
+
 def client_main(argv):
-    peer, command, args = argv[0], argv[1], argv[2:]
-    channel = make_channel(f'{peer}:50052', secure=True)
-    client = make_client(channel)
+    peers, command, args = argv[0], argv[1], argv[2:]
+    # Post and then wait until the jobs are over, exit status 1 if any did not finish
+    wait = '--wait' in args
+    args = [arg for arg in args if arg != '--wait']
+    client = make_replica_client(peers.split(','))
     if command == 'WorkerSelfAnnouncement':
         newState, hostname = args
         newState = mgmt_messages_pb2.WorkerState.Value(newState)
@@ -30,12 +216,28 @@ def client_main(argv):
         assert response.newState == newState
         assert response.hostname == hostname
     elif command == 'PostMeltJob':
-        projectPath, encodingPresetName, resultPath = args
+        projectPath, encodingPresetName, resultPath, *optional = args
         job = jobs_pb2.MeltJob(
             projectPath=projectPath,
             encodingPresetName=encodingPresetName,
             resultPath=resultPath)
+        if optional:
+            job.segmentFrames = int(optional[0])
+        if len(optional) > 1:
+            job.priority = jobs_pb2.JobPriority.Value(optional[1])
         response = client.PostMeltJob(job)
+        if wait:
+            print('Response:', MessageToString(response, as_one_line=True))
+            return 1 if wait_for_jobs(client, [response.id]) else 0
+    elif command == 'PostMeltJobs':
+        path, *batchSize = args
+        batch_size = int(batchSize[0]) if batchSize else DEFAULT_BATCH_SIZE
+        accepted = list()
+        with (sys.stdin if path == '-' else open(path)) as lines:
+            errors = post_jobs(client, read_job_specs(lines), batch_size, accepted)
+        if wait:
+            errors += wait_for_jobs(client, accepted)
+        return 1 if errors else 0
     elif command == 'PostMeltJobResult':
         jobId, success, error, log, result_path = args
         jobId = int(jobId)
@@ -50,6 +252,34 @@ def client_main(argv):
             resultPath=result_path)
         response = client.PostMeltJobResult(jobResult)
         assert response == jobResult
+    elif command == 'CancelJob':
+        jobId, = args
+        response = client.CancelJob(jobs_pb2.JobId(id=int(jobId)))
+    elif command == 'GetJob':
+        jobId, = args
+        response = client.GetJob(jobs_pb2.JobId(id=int(jobId)))
+    elif command == 'ListJobs':
+        # States comma-separated, - for any
+        states, *submitter = args or ['-']
+        query = jobs_pb2.JobQuery()
+        if states != '-':
+            query.states.extend(jobs_pb2.JobState.Value(state) for state in states.split(','))
+        if submitter:
+            query.submitter = submitter[0]
+        for status in list_jobs(client, query):
+            print(f'{format_status(status)}\t{status.submitter}\t{status.resultPath}')
+        return
+    elif command == 'WatchJobs':
+        return 1 if wait_for_jobs(client, [int(jobId) for jobId in args]) else 0
+    elif command == 'GetJobLog':
+        jobId, *bounds = args
+        log_range = jobs_pb2.LogRange(
+            id=jobs_pb2.JobId(id=int(jobId)), offset=int(bounds[0]) if bounds else 0)
+        if len(bounds) > 1:
+            log_range.length = int(bounds[1])
+        for chunk in client.GetJobLog(log_range):
+            sys.stdout.buffer.write(chunk.data)
+        return
     else:
         raise ValueError('Unknown command:', command)
     print('Response:', MessageToString(response, as_one_line=True))
@@ -57,4 +287,4 @@ def client_main(argv):
 
 if __name__ == '__main__':
     logging.basicConfig(level=logging.DEBUG)
-    client_main(sys.argv[1:])
+    sys.exit(client_main(sys.argv[1:]))
@@ -0,0 +1,137 @@
+import functools
+import json
+import os
+import threading
+import xml.etree.ElementTree as ET
+from fractions import Fraction
+
+from mipt_distencode.mlt_project import MltProject
+
+
+# A cost unit is one output frame of 1080p from a single track without filters
+REFERENCE_PIXELS = 1920 * 1080
+FILTER_COST = 0.1
+TRACK_COST = 0.05
+
+
+class ProjectStats:
+    def __init__(self, frames, frame_rate, resolution, tracks, filters, media):
+        self.frames = frames
+        self.frame_rate = frame_rate
+        self.resolution = resolution
+        self.tracks = tracks
+        self.filters = filters
+        self.media = media
+
+    def __repr__(self):
+        return ('ProjectStats({} frames at {} fps, {}, {} tracks, {} filters, '
+                '{} media files)').format(
+            self.frames, self.frame_rate,
+            '{}x{}'.format(*self.resolution) if self.resolution else 'no size',
+            self.tracks, self.filters, len(self.media))
+
+    def output_frame_rate(self, preset) -> Fraction:
+        general = preset.get('general', {})
+        return Fraction(general['framerate']) if 'framerate' in general \
+            else self.frame_rate
+
+    def output_frames(self, frames, preset) -> Fraction:
+        """Frames the preset produces from frames of the project"""
+        return frames / self.frame_rate * self.output_frame_rate(preset)
+
+    def cost(self, frames, preset) -> float:
+        """Cost units of encoding frames of the project with the preset"""
+        general = preset.get('general', {})
+        resolution = tuple(map(int, general['size'].split('x'))) if 'size' in general \
+            else self.resolution
+        output_frames = self.output_frames(frames, preset)
+        scale = resolution[0] * resolution[1] / REFERENCE_PIXELS if resolution else 1.0
+        effects = 1 + FILTER_COST * self.filters + TRACK_COST * (self.tracks - 1)
+        return float(output_frames) * scale * effects * preset.get('cost', 1.0)
+
+
+@functools.lru_cache(maxsize=4096)
+def _analyze(project_path, mtime_ns) -> ProjectStats:
+    project = MltProject.load(project_path)
+    return ProjectStats(
+        frames=project.frame_count(),
+        frame_rate=project.frame_rate,
+        resolution=project.resolution(),
+        tracks=project.track_count(),
+        filters=project.filter_count(),
+        media=project.media_paths())
+
+
+def analyze_project(project_path) -> 'Optional[ProjectStats]':
+    """Cached per project file mtime, None if the project is unreadable"""
+    try:
+        return _analyze(project_path, os.stat(project_path).st_mtime_ns)
+    except (OSError, ValueError, ET.ParseError):
+        return None
+
+
+@functools.lru_cache(maxsize=64)
+def _load_preset(preset_path, mtime_ns) -> 'Dict':
+    with open(preset_path) as preset_file:
+        return json.load(preset_file)
+
+
+def load_preset(preset_dir, preset_name) -> 'Dict':
+    """Empty if the manager has no presets, estimates then ignore the preset"""
+    if not preset_dir:
+        return {}
+    preset_path = os.path.join(preset_dir, f'{preset_name}.json')
+    try:
+        return _load_preset(preset_path, os.stat(preset_path).st_mtime_ns)
+    except (OSError, ValueError):
+        return {}
+
+
+def job_frames(job_handle) -> 'Optional[int]':
+    if job_handle.inFrame is not None and job_handle.outFrame is not None:
+        return job_handle.outFrame - job_handle.inFrame + 1
+    stats = analyze_project(job_handle.projectPath)
+    return stats.frames if stats is not None else None
+
+
+def estimate_cost(job_handle, preset_dir) -> 'Optional[float]':
+    stats = analyze_project(job_handle.projectPath)
+    if stats is None:
+        return None
+    frames = job_frames(job_handle)
+    return stats.cost(frames, load_preset(preset_dir, job_handle.encodingPresetName))
+
+
+class CostModel:
+    """Encode seconds per cost unit by preset, per worker and over all workers,
+    calibrated on finished attempts with exponential weighting"""
+    def __init__(self, weight=0.3):
+        self.weight = weight
+        # (preset, worker or None) -> seconds per cost unit
+        self.rates = dict()
+        self.lock = threading.Lock()
+
+    def record(self, preset, worker, cost, seconds):
+        if not cost or seconds <= 0:
+            return
+        rate = seconds / cost
+        with self.lock:
+            for key in [(preset, worker), (preset, None)]:
+                previous = self.rates.get(key)
+                self.rates[key] = rate if previous is None \
+                    else (1 - self.weight) * previous + self.weight * rate
+
+    def warm_up(self, attempts):
+        """Calibrate on (preset, worker, cost, seconds) of past attempts, oldest first"""
+        for preset, worker, cost, seconds in attempts:
+            self.record(preset, worker, cost, seconds)
+
+    def expected_seconds(self, preset, cost, worker=None) -> 'Optional[float]':
+        """On the worker if it has finished jobs of the preset, else on an average one"""
+        if not cost:
+            return None
+        with self.lock:
+            rate = self.rates.get((preset, worker))
+            if rate is None:
+                rate = self.rates.get((preset, None))
+        return cost * rate if rate is not None else None
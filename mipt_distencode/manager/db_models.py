@@ -1,17 +1,122 @@
+import datetime
 import enum
+import functools
+import os
+import time
 
-from sqlalchemy import Column, ForeignKey, MetaData, Sequence
-from sqlalchemy import DateTime, Integer, String, Enum
+from sqlalchemy import Column, ForeignKey, Index, MetaData, Sequence, create_engine, event
+from sqlalchemy import Boolean, DateTime, Float, Integer, String, Enum, func, inspect, or_, text
+from sqlalchemy import bindparam, select, union_all
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import object_session, sessionmaker
 
 from mipt_distencode import jobs_pb2, mgmt_messages_pb2
+from mipt_distencode.config import Config
+from mipt_distencode.metrics import REGISTRY
 
 
 metadata = MetaData()
 Base = declarative_base(metadata=metadata)
 Session = sessionmaker()
 
+DB_STATEMENT = REGISTRY.histogram(
+    'distenc_db_statement_seconds', 'Time of database statements by verb', ['verb'])
+
+
+def utcnow() -> datetime.datetime:
+    return datetime.datetime.utcnow()
+
+
+def unix_seconds(value: datetime.datetime) -> float:
+    return value.replace(tzinfo=datetime.timezone.utc).timestamp()
+
+
+def from_unix_seconds(value: float) -> datetime.datetime:
+    return datetime.datetime.fromtimestamp(value, datetime.timezone.utc).replace(tzinfo=None)
+
+
+def make_engine(url, pool_size):
+    """Engine for concurrent sessions, SQLite runs in WAL mode"""
+    if not url.startswith('sqlite'):
+        engine = create_engine(url, pool_size=pool_size, pool_pre_ping=True)
+        _time_statements(engine)
+        return engine
+    engine = create_engine(
+        url, pool_size=pool_size, max_overflow=0,
+        connect_args={'check_same_thread': False, 'timeout': 30})
+
+    @event.listens_for(engine, 'connect')
+    def _set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.execute('PRAGMA busy_timeout=30000')
+        cursor.close()
+
+    _time_statements(engine)
+    return engine
+
+
+def upgrade_schema(engine):
+    """Creates missing tables and brings those of an older version up to the
+    models: adds missing columns, indexes and PostgreSQL enum values. Nothing
+    is changed or dropped, so an older manager still runs on the result"""
+    metadata.create_all(engine)
+    with engine.begin() as connection:
+        inspector = inspect(connection)
+        for table in metadata.sorted_tables:
+            columns = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in columns:
+                    _add_column(connection, table, column)
+            indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in indexes:
+                    index.create(connection)
+        if connection.dialect.name == 'postgresql':
+            for column in _native_enum_columns():
+                for value in column.type.enums:
+                    connection.execute(text(
+                        f"ALTER TYPE {column.type.name} ADD VALUE IF NOT EXISTS '{value}'"))
+
+
+# Values of added NOT NULL columns without a default in existing rows
+_BACKFILL = {('WorkerRecord', 'version'): 1}
+
+
+def _add_column(connection, table, column):
+    """Added as nullable, ALTER TABLE of SQLite cannot add NOT NULL columns
+    without a constant default. Existing rows get the default of the column"""
+    preparer = connection.dialect.identifier_preparer
+    connection.execute(text('ALTER TABLE {} ADD COLUMN {} {}'.format(
+        preparer.format_table(table), preparer.format_column(column),
+        column.type.compile(dialect=connection.dialect))))
+    value = _BACKFILL.get((table.name, column.name))
+    if column.default is not None and column.default.is_scalar:
+        value = column.default.arg
+    elif column.default is not None and column.default.is_callable:
+        value = column.default.arg(None)
+    if value is not None:
+        connection.execute(table.update().values({column.name: value}))
+
+
+def _native_enum_columns() -> 'List[Column]':
+    return [
+        column for table in metadata.sorted_tables for column in table.columns
+        if isinstance(column.type, Enum) and column.type.native_enum
+    ]
+
+
+def _time_statements(engine):
+    @event.listens_for(engine, 'before_cursor_execute')
+    def _started(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('statement_started', []).append(time.perf_counter())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def _finished(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info['statement_started'].pop()
+        DB_STATEMENT.observe(time.perf_counter() - started, statement.split(None, 1)[0].upper())
+
 
 class WorkerState(enum.Enum):
     ACTIVE = 0
@@ -29,17 +134,24 @@ class WorkerRecord(Base):
     __tablename__ = 'WorkerRecord'
     hostname = Column(String, primary_key=True)
     state = Column(Enum(WorkerState), nullable=False)
+    # Manager replica that polls the worker and dispatches to it
+    owner = Column(String, nullable=True, index=True)
+    # Bumped on every update, a stale record does not overwrite a newer one
+    version = Column(Integer, nullable=False)
+    __mapper_args__ = {'version_id_col': version}
 
     def __repr__(self):
         attrs = {
             'hostname': self.hostname,
             'state': self.state
         }
+        if self.owner is not None:
+            attrs['owner'] = self.owner
         return f'WorkerRecord{repr(attrs)}'
 
     @classmethod
     def new_from_proto(cls, proto: mgmt_messages_pb2.WorkerSelfAnnouncement,
-                           session: Session) -> 'WorkerRecord':
+                           session: Session, owner=None) -> 'WorkerRecord':
         attr_mappers = {
             'hostname': lambda p: p.hostname,
             'state': lambda p: WorkerState.from_proto(p.newState)
@@ -47,6 +159,7 @@ class WorkerRecord(Base):
         attrs = {
             attr: mapper(proto) for attr, mapper in attr_mappers.items()
         }
+        attrs['owner'] = owner
         orm = cls(**attrs)
         session.add(orm)
         session.commit()
@@ -59,6 +172,59 @@ class WorkerRecord(Base):
             .filter(cls.hostname == proto.hostname) \
             .one_or_none()
 
+    def claim(self, session: Session, owner) -> bool:
+        """Compare-and-set of the owner on the version the record was read
+        with, False if another replica changed it since. Commits"""
+        updated = session.query(WorkerRecord) \
+            .filter(WorkerRecord.hostname == self.hostname,
+                    WorkerRecord.version == self.version) \
+            .update({'owner': owner, 'version': WorkerRecord.version + 1},
+                    synchronize_session=False)
+        session.commit()
+        return updated == 1
+
+
+class ManagerReplica(Base):
+    """Manager processes sharing the database, a replica is alive while it
+    renews its lease. Workers are owned by live replicas, jobs name the
+    replica holding their in-memory work"""
+    __tablename__ = 'ManagerReplica'
+    identity = Column(String, primary_key=True)
+    leaseDeadline = Column(DateTime, nullable=False)
+
+    def __repr__(self):
+        attrs = {
+            'identity': self.identity,
+            'leaseDeadline': self.leaseDeadline
+        }
+        return f'ManagerReplica{repr(attrs)}'
+
+    @classmethod
+    def renew(cls, session: Session, identity, duration: datetime.timedelta):
+        replica = session.get(cls, identity)
+        if replica is None:
+            replica = cls(identity=identity)
+            session.add(replica)
+        replica.leaseDeadline = utcnow() + duration
+
+    @classmethod
+    def live(cls, session: Session, now) -> 'List[str]':
+        return [identity for identity, in session.query(cls.identity)
+                .filter(cls.leaseDeadline >= now)
+                .order_by(cls.identity)]
+
+    @classmethod
+    def expired(cls, session: Session, now) -> 'List[str]':
+        return [identity for identity, in session.query(cls.identity)
+                .filter(cls.leaseDeadline < now)]
+
+    @classmethod
+    def take_over(cls, session: Session, identity, now) -> bool:
+        """Removes an expired lease, only one replica succeeds and adopts the work"""
+        return session.query(cls) \
+            .filter(cls.identity == identity, cls.leaseDeadline < now) \
+            .delete(synchronize_session=False) == 1
+
 
 class MeltJobState(enum.Enum):
     ACCEPTED = 1
@@ -67,16 +233,91 @@ class MeltJobState(enum.Enum):
     FAILED = 4
     VERIFICATION = 5
     FINISHED = 6
+    MERGING = 7
+    # Waits for an identical job or a copy of a cached result
+    COALESCED = 8
+    # Stopped on purpose, e.g. the losing copy of a speculative execution
+    CANCELLED = 9
+    # Rendered as an extra output of the melt run of the job in bundledWith
+    BUNDLED = 10
+
+    @classmethod
+    def from_proto(cls, proto: jobs_pb2.JobState):
+        return cls(int(proto))
+
+    def proto(self) -> jobs_pb2.JobState:
+        return getattr(jobs_pb2.JobState, self.name)
+
+
+# Encoding is over, finishedAt is set on entering these
+DONE_STATES = [
+    MeltJobState.VERIFICATION, MeltJobState.FINISHED, MeltJobState.FAILED,
+    MeltJobState.CANCELLED
+]
+# Jobs still to be encoded, checked or merged
+LIVE_STATES = [
+    state for state in MeltJobState
+    if state not in [MeltJobState.FINISHED, MeltJobState.FAILED, MeltJobState.CANCELLED]
+]
+# The manager replica that entered them merges, verifies or copies in memory
+FILE_WORK_STATES = [MeltJobState.MERGING, MeltJobState.VERIFICATION, MeltJobState.COALESCED]
 
 
 class MeltJobHandle(Base):
     __tablename__ = 'MeltJobHandle'
+    __table_args__ = (
+        # Queue order: next pending job, leasable jobs
+        Index('ix_MeltJobHandle_state_id', 'state', 'id'),
+        Index('ix_MeltJobHandle_worker_state', 'worker', 'state'),
+        Index('ix_MeltJobHandle_state_leaseDeadline', 'state', 'leaseDeadline'),
+        Index('ix_MeltJobHandle_state_projectPath', 'state', 'projectPath'),
+        # Segments of a job in frame order
+        Index('ix_MeltJobHandle_parentId_inFrame', 'parentId', 'inFrame'),
+        # ListJobs of a submitter
+        Index('ix_MeltJobHandle_submitter_id', 'submitter', 'id'),
+    )
     id = Column(Integer, Sequence('MeltJob_id_seq'),
                         primary_key=True)
     projectPath = Column(String, nullable=False)
     encodingPresetName = Column(String, nullable=False)
     resultPath = Column(String, nullable=False)
     state = Column(Enum(MeltJobState), nullable=False)
+    parentId = Column(Integer, ForeignKey('MeltJobHandle.id'), nullable=True)
+    inFrame = Column(Integer, nullable=True)
+    outFrame = Column(Integer, nullable=True)
+    # jobs_pb2.JobPriority value, ordered
+    priority = Column(Integer, nullable=False, default=jobs_pb2.NORMAL)
+    # Limit of a melt run, the worker default if unset
+    timeoutSeconds = Column(Integer, nullable=True)
+    # Cost units from the project and preset, see manager/cost.py
+    estimatedCost = Column(Float, nullable=True)
+    attempts = Column(Integer, nullable=False, default=0)
+    leaseOwner = Column(String, nullable=True)
+    leaseDeadline = Column(DateTime, nullable=True)
+    cacheKey = Column(String, nullable=True, index=True)
+    coalescedWith = Column(Integer, ForeignKey('MeltJobHandle.id'), nullable=True,
+                           index=True)
+    # Peer identity of the client that posted the job
+    submitter = Column(String, nullable=True)
+    # Worker of the latest attempt
+    worker = Column(String, nullable=True)
+    createdAt = Column(DateTime, nullable=False, default=utcnow, index=True)
+    # Sent to or leased by the worker
+    dispatchedAt = Column(DateTime, nullable=True)
+    # First progress report of the worker, melt is running
+    startedAt = Column(DateTime, nullable=True)
+    finishedAt = Column(DateTime, nullable=True)
+    # WAITING_RETRY jobs are not dispatched before this time
+    retryAt = Column(DateTime, nullable=True)
+    # Comma-separated workers where attempts failed, avoided on retry
+    failedWorkers = Column(String, nullable=True)
+    # Duplicate of a straggling job, writes next to its result
+    speculativeOf = Column(Integer, ForeignKey('MeltJobHandle.id'), nullable=True,
+                           index=True)
+    bundledWith = Column(Integer, ForeignKey('MeltJobHandle.id'), nullable=True,
+                         index=True)
+    # Manager replica that changed the state last
+    manager = Column(String, nullable=True, default=lambda: Config.identity)
 
     def __repr__(self):
         attrs = {
@@ -86,11 +327,26 @@ class MeltJobHandle(Base):
             'resultPath': self.resultPath,
             'state': self.state
         }
+        if self.worker is not None:
+            attrs['worker'] = self.worker
+        if self.parentId is not None:
+            attrs.update({
+                'parentId': self.parentId,
+                'inFrame': self.inFrame,
+                'outFrame': self.outFrame
+            })
+        if self.coalescedWith is not None:
+            attrs['coalescedWith'] = self.coalescedWith
+        if self.speculativeOf is not None:
+            attrs['speculativeOf'] = self.speculativeOf
+        if self.bundledWith is not None:
+            attrs['bundledWith'] = self.bundledWith
         return f'MeltJobHandle{repr(attrs)}'
 
     @classmethod
     def new_from_proto(cls, proto: jobs_pb2.MeltJob,
-                          session: Session) -> 'MeltJobHandle':
+                          session: Session, commit=True,
+                          submitter=None) -> 'MeltJobHandle':
         attr_mappers = {
             'projectPath': lambda p: p.projectPath,
             'encodingPresetName': lambda p: p.encodingPresetName,
@@ -99,12 +355,126 @@ class MeltJobHandle(Base):
         new_attrs = {
             attr: mapper(proto) for attr, mapper in attr_mappers.items()
         }
+        for attr in ['inFrame', 'outFrame', 'timeoutSeconds']:
+            if proto.HasField(attr):
+                new_attrs[attr] = getattr(proto, attr)
         new_attrs['state'] = MeltJobState.ACCEPTED
+        new_attrs['attempts'] = 0
+        new_attrs['submitter'] = submitter
+        new_attrs['priority'] = proto.priority
         orm = cls(**new_attrs)
         session.add(orm)
-        session.commit()
+        if commit:
+            session.commit()
+        return orm
+
+    def new_segment(self, result_path, in_frame, out_frame,
+                    session: Session) -> 'MeltJobHandle':
+        """Does not commit, segments are usually added in bulk"""
+        orm = MeltJobHandle(
+            projectPath=self.projectPath,
+            encodingPresetName=self.encodingPresetName,
+            resultPath=result_path,
+            state=MeltJobState.ACCEPTED,
+            parentId=self.id,
+            inFrame=in_frame,
+            outFrame=out_frame,
+            attempts=0,
+            submitter=self.submitter,
+            priority=self.priority,
+            timeoutSeconds=self.timeoutSeconds)
+        session.add(orm)
+        return orm
+
+    def new_output(self, preset_name, result_path,
+                   session: Session) -> 'MeltJobHandle':
+        """Another output of the same frames, does not commit"""
+        orm = MeltJobHandle(
+            projectPath=self.projectPath,
+            encodingPresetName=preset_name,
+            resultPath=result_path,
+            state=MeltJobState.ACCEPTED,
+            inFrame=self.inFrame,
+            outFrame=self.outFrame,
+            attempts=0,
+            submitter=self.submitter,
+            priority=self.priority,
+            timeoutSeconds=self.timeoutSeconds)
+        session.add(orm)
+        return orm
+
+    def new_speculative_copy(self, result_path,
+                             session: Session) -> 'MeltJobHandle':
+        orm = MeltJobHandle(
+            projectPath=self.projectPath,
+            encodingPresetName=self.encodingPresetName,
+            resultPath=result_path,
+            state=MeltJobState.ACCEPTED,
+            inFrame=self.inFrame,
+            outFrame=self.outFrame,
+            attempts=0,
+            submitter=self.submitter,
+            priority=self.priority,
+            timeoutSeconds=self.timeoutSeconds,
+            estimatedCost=self.estimatedCost,
+            failedWorkers=self.worker,
+            speculativeOf=self.id)
+        session.add(orm)
         return orm
 
+    def speculative_copies(self, session: Session) -> 'List[MeltJobHandle]':
+        return session.query(MeltJobHandle) \
+            .filter(MeltJobHandle.speculativeOf == self.id) \
+            .all()
+
+    def live_speculative_copy(self, session: Session) -> 'Optional[MeltJobHandle]':
+        for copy in self.speculative_copies(session):
+            if copy.state in [MeltJobState.ACCEPTED, MeltJobState.IN_PROGRESS,
+                              MeltJobState.WAITING_RETRY]:
+                return copy
+        return None
+
+    def bundled(self, session: Session) -> 'List[MeltJobHandle]':
+        return session.query(MeltJobHandle) \
+            .filter(MeltJobHandle.bundledWith == self.id,
+                    MeltJobHandle.state == MeltJobState.BUNDLED) \
+            .order_by(MeltJobHandle.id) \
+            .all()
+
+    def bundle_candidates(self, session: Session, exclude_presets,
+                          limit) -> 'List[MeltJobHandle]':
+        """Pending jobs rendering the same frames of the same project with other
+        presets. Jobs that failed somewhere run alone"""
+        query = session.query(MeltJobHandle) \
+            .filter(MeltJobHandle.state == MeltJobState.ACCEPTED,
+                    MeltJobHandle.projectPath == self.projectPath,
+                    MeltJobHandle.id != self.id,
+                    MeltJobHandle.encodingPresetName.notin_(exclude_presets),
+                    MeltJobHandle.speculativeOf.is_(None),
+                    MeltJobHandle.failedWorkers.is_(None))
+        for attr in ['inFrame', 'outFrame']:
+            column, value = getattr(MeltJobHandle, attr), getattr(self, attr)
+            query = query.filter(column.is_(None) if value is None else column == value)
+        return query.order_by(MeltJobHandle.id).limit(limit).all()
+
+    def failed_on(self) -> 'List[str]':
+        return self.failedWorkers.split(',') if self.failedWorkers else []
+
+    def add_failed_worker(self, hostname):
+        if hostname not in self.failed_on():
+            self.failedWorkers = ','.join(self.failed_on() + [hostname])
+
+    def segments(self, session: Session) -> 'List[MeltJobHandle]':
+        return session.query(MeltJobHandle) \
+            .filter(MeltJobHandle.parentId == self.id) \
+            .order_by(MeltJobHandle.inFrame) \
+            .all()
+
+    def parent(self, session: Session) -> 'Optional[MeltJobHandle]':
+        if self.parentId is None:
+            return None
+        return session.get(MeltJobHandle, self.parentId)
+
     @classmethod
     def lookup_from_proto(cls, proto: jobs_pb2.MeltJob,
                           session: Session) -> 'MeltJobHandle':
@@ -112,11 +482,403 @@ class MeltJobHandle(Base):
             .filter(cls.id == proto.id.id) \
             .one_or_none()
 
-    def proto_job(self) -> jobs_pb2.MeltJob:
+    @classmethod
+    def transition(cls, session: Session, job_id, from_states, to_state,
+                   **values) -> bool:
+        """Atomic compare-and-set of the job state, safe with concurrent sessions
+
+        Bypasses ORM events, so records history itself. The previous state is
+        only known when from_states has one element"""
+        if to_state in DONE_STATES:
+            values.setdefault('finishedAt', utcnow())
+        values.setdefault('manager', Config.identity)
+        updated = session.query(cls) \
+            .filter(cls.id == job_id, cls.state.in_(from_states)) \
+            .update({'state': to_state, **values}, synchronize_session='fetch')
+        if updated != 1:
+            return False
+        from_state = from_states[0] if len(from_states) == 1 else None
+        session.execute(MeltJobTransition.__table__.insert().values(
+            jobId=job_id, fromState=from_state, toState=to_state, at=utcnow(),
+            worker=values.get('worker')))
+        session.info['state_changed'] = True
+        return True
+
+    @classmethod
+    def submitted(cls, session: Session, states=(), submitter=None, created_after=None,
+                  created_before=None, before_id=None, limit=100) -> 'List[MeltJobHandle]':
+        """Jobs as posted, newest first, without segments and speculative copies"""
+        query = session.query(cls) \
+            .filter(cls.parentId.is_(None), cls.speculativeOf.is_(None))
+        if states:
+            query = query.filter(cls.state.in_(states))
+        if submitter is not None:
+            query = query.filter(cls.submitter == submitter)
+        if created_after is not None:
+            query = query.filter(cls.createdAt >= created_after)
+        if created_before is not None:
+            query = query.filter(cls.createdAt < created_before)
+        if before_id is not None:
+            query = query.filter(cls.id < before_id)
+        return query.order_by(cls.id.desc()).limit(limit).all()
+
+    @classmethod
+    def submitted_with_ids(cls, session: Session, job_ids) -> 'List[MeltJobHandle]':
+        return session.query(cls) \
+            .filter(cls.id.in_(job_ids), cls.parentId.is_(None),
+                    cls.speculativeOf.is_(None)) \
+            .order_by(cls.id) \
+            .all()
+
+    @classmethod
+    def in_flight_with_key(cls, session: Session, cache_key) -> 'Optional[MeltJobHandle]':
+        """A job encoding the same result right now, followers coalesce to it"""
+        return session.query(cls) \
+            .filter(cls.cacheKey == cache_key, cls.coalescedWith.is_(None)) \
+            .filter(cls.state.in_([
+                MeltJobState.ACCEPTED, MeltJobState.IN_PROGRESS,
+                MeltJobState.WAITING_RETRY, MeltJobState.MERGING, MeltJobState.BUNDLED,
+                MeltJobState.VERIFICATION])) \
+            .order_by(cls.id) \
+            .first()
+
+    def followers(self, session: Session) -> 'List[MeltJobHandle]':
+        return session.query(MeltJobHandle) \
+            .filter(MeltJobHandle.coalescedWith == self.id,
+                    MeltJobHandle.state == MeltJobState.COALESCED) \
+            .all()
+
+    @classmethod
+    def on_worker(cls, session: Session, worker, states) -> 'List[MeltJobHandle]':
+        return session.query(cls) \
+            .filter(cls.worker == worker, cls.state.in_(states)) \
+            .all()
+
+    @classmethod
+    def with_states(cls, session: Session, states) -> 'List[MeltJobHandle]':
+        return session.query(cls) \
+            .filter(cls.state.in_(states)) \
+            .order_by(cls.id) \
+            .all()
+
+    @classmethod
+    def next_pending(cls, session: Session) -> 'Optional[MeltJobHandle]':
+        return session.query(cls) \
+            .filter(cls.state == MeltJobState.ACCEPTED) \
+            .order_by(cls.id) \
+            .first()
+
+    def history(self, session: Session) -> 'List[MeltJobTransition]':
+        return session.query(MeltJobTransition) \
+            .filter(MeltJobTransition.jobId == self.id) \
+            .order_by(MeltJobTransition.id) \
+            .all()
+
+    @classmethod
+    def leasable(cls, session: Session, limit: int) -> 'List[Row]':
+        """(id, failedWorkers, submitter, priority, estimatedCost) of jobs ready to run: first
+        ones of every submitter and due retries, for the fair share to order.
+        One statement, a range of ix_MeltJobHandle_state_submitter_priority_id
+        per submitter with a pending job. Most candidates are claimed by others
+        or not needed, so rows are not loaded"""
+        return session.execute(
+            cls._leasable_statement(), {'limit': limit, 'now': utcnow()}).all()
+
+    @classmethod
+    @functools.lru_cache(maxsize=None)
+    def _leasable_statement(cls):
+        # Built once, building it costs more than running it
+        table = cls.__table__
+        submitters = select(table.c.submitter) \
+            .where(table.c.state == MeltJobState.ACCEPTED) \
+            .distinct() \
+            .subquery()
+        first = select(table.c.id) \
+            .where(table.c.state == MeltJobState.ACCEPTED,
+                   table.c.submitter.is_not_distinct_from(submitters.c.submitter)) \
+            .order_by(table.c.priority.desc(), table.c.id) \
+            .limit(bindparam('limit')) \
+            .correlate(submitters)
+        job = table.alias()
+        accepted = select(job.c.id, job.c.failedWorkers, job.c.submitter, job.c.priority,
+                          job.c.estimatedCost) \
+            .select_from(submitters) \
+            .join(job, job.c.id.in_(first.scalar_subquery()))
+        retries = select(table.c.id, table.c.failedWorkers, table.c.submitter,
+                         table.c.priority, table.c.estimatedCost) \
+            .where(table.c.state == MeltJobState.WAITING_RETRY) \
+            .where(or_(table.c.retryAt.is_(None), table.c.retryAt <= bindparam('now'))) \
+            .order_by(table.c.priority.desc(), table.c.id) \
+            .limit(bindparam('limit')) \
+            .subquery()
+        return union_all(accepted, select(retries))
+
+    @classmethod
+    def due_retries(cls, session: Session, limit: int) -> 'List[MeltJobHandle]':
+        return session.query(cls) \
+            .filter(cls.state == MeltJobState.WAITING_RETRY) \
+            .filter(or_(cls.retryAt.is_(None), cls.retryAt <= utcnow())) \
+            .order_by(cls.priority.desc(), cls.id) \
+            .limit(limit) \
+            .all()
+
+    @classmethod
+    def recently_encoded(cls, session: Session, limit) -> 'List[Row]':
+        """(encodingPresetName, worker, estimatedCost, seconds) of the last
+        successful attempts, oldest first"""
+        rows = session.query(cls.encodingPresetName, cls.worker, cls.estimatedCost,
+                             func.coalesce(cls.startedAt, cls.dispatchedAt), cls.finishedAt) \
+            .filter(cls.state.in_([MeltJobState.VERIFICATION, MeltJobState.FINISHED])) \
+            .filter(cls.dispatchedAt.isnot(None), cls.estimatedCost.isnot(None)) \
+            .order_by(cls.id.desc()) \
+            .limit(limit) \
+            .all()
+        return [
+            (preset, worker, cost, (finished_at - started_at).total_seconds())
+            for preset, worker, cost, started_at, finished_at in reversed(rows)
+        ]
+
+    @classmethod
+    def live_counts(cls, session: Session) -> 'List[Row]':
+        """(state, worker, count) of live jobs, a range of the state index
+        per state, finished history is not counted"""
+        return session.query(cls.state, cls.worker, func.count()) \
+            .filter(cls.state.in_(LIVE_STATES)) \
+            .group_by(cls.state, cls.worker) \
+            .all()
+
+    @classmethod
+    def held_by(cls, session: Session, managers, states) -> 'List[MeltJobHandle]':
+        return session.query(cls) \
+            .filter(cls.manager.in_(managers), cls.state.in_(states)) \
+            .all()
+
+    @classmethod
+    def reassign(cls, session: Session, manager, new_manager):
+        """Live jobs of a replica that is gone"""
+        session.query(cls) \
+            .filter(cls.manager == manager, cls.state.in_(LIVE_STATES)) \
+            .update({'manager': new_manager}, synchronize_session=False)
+
+    @classmethod
+    def attempts_of(cls, session: Session, job_ids) -> 'List[Row]':
+        """(id, state, attempts)"""
+        return session.query(cls.id, cls.state, cls.attempts) \
+            .filter(cls.id.in_(list(job_ids))) \
+            .all()
+
+    @classmethod
+    def running(cls, session: Session) -> 'List[MeltJobHandle]':
+        """Jobs with an attempt on some worker right now"""
+        return session.query(cls) \
+            .filter(cls.state == MeltJobState.IN_PROGRESS, cls.worker.isnot(None)) \
+            .all()
+
+    @classmethod
+    def expired_leases(cls, session: Session, now) -> 'List[MeltJobHandle]':
+        return session.query(cls) \
+            .filter(cls.state == MeltJobState.IN_PROGRESS) \
+            .filter(cls.leaseDeadline < now) \
+            .all()
+
+    def expire_lease(self, session: Session) -> bool:
+        """Clears the lease as read, False if it was renewed or expired by
+        another manager replica meanwhile"""
+        return session.query(MeltJobHandle) \
+            .filter(MeltJobHandle.id == self.id,
+                    MeltJobHandle.state == MeltJobState.IN_PROGRESS,
+                    MeltJobHandle.leaseOwner == self.leaseOwner,
+                    MeltJobHandle.leaseDeadline == self.leaseDeadline) \
+            .update({'leaseOwner': None, 'leaseDeadline': None},
+                    synchronize_session='fetch') == 1
+
+    @classmethod
+    def mark_started(cls, session: Session, job_id):
+        session.query(cls) \
+            .filter(cls.id == job_id, cls.startedAt.is_(None)) \
+            .update({'startedAt': utcnow()}, synchronize_session=False)
+
+    def grant_lease(self, owner, duration: datetime.timedelta):
+        self.leaseOwner = owner
+        self.leaseDeadline = utcnow() + duration
+
+    def clear_lease(self):
+        self.leaseOwner = None
+        self.leaseDeadline = None
+
+    def proto_job(self, extra_outputs=()) -> jobs_pb2.MeltJob:
+        """extra_outputs are jobs bundled with this one"""
         attrs = {
             'id': jobs_pb2.JobId(id=self.id),
             'projectPath': self.projectPath,
             'encodingPresetName': self.encodingPresetName,
             'resultPath': self.resultPath
         }
+        if self.inFrame is not None:
+            attrs['inFrame'] = self.inFrame
+        if self.outFrame is not None:
+            attrs['outFrame'] = self.outFrame
+        if self.priority is not None:
+            attrs['priority'] = self.priority
+        if self.timeoutSeconds is not None:
+            attrs['timeoutSeconds'] = self.timeoutSeconds
+        if extra_outputs:
+            attrs['extraOutputs'] = [
+                jobs_pb2.MeltOutput(
+                    id=jobs_pb2.JobId(id=output.id),
+                    encodingPresetName=output.encodingPresetName,
+                    resultPath=output.resultPath)
+                for output in extra_outputs
+            ]
         return jobs_pb2.MeltJob(**attrs)
+
+    def proto_status(self) -> jobs_pb2.JobStatus:
+        status = jobs_pb2.JobStatus(
+            id=jobs_pb2.JobId(id=self.id),
+            state=self.state.proto(),
+            projectPath=self.projectPath,
+            encodingPresetName=self.encodingPresetName,
+            resultPath=self.resultPath,
+            priority=self.priority,
+            attempts=self.attempts,
+            createdAt=unix_seconds(self.createdAt))
+        for attr in ['submitter', 'worker']:
+            if getattr(self, attr) is not None:
+                setattr(status, attr, getattr(self, attr))
+        for attr in ['startedAt', 'finishedAt']:
+            if getattr(self, attr) is not None:
+                setattr(status, attr, unix_seconds(getattr(self, attr)))
+        return status
+
+
+# Pull mode queue: per submitter by priority, then age
+Index('ix_MeltJobHandle_state_submitter_priority_id', MeltJobHandle.state,
+      MeltJobHandle.submitter, MeltJobHandle.priority.desc(), MeltJobHandle.id)
+
+
+class MeltJobTransition(Base):
+    """Append-only log of job state changes"""
+    __tablename__ = 'MeltJobTransition'
+    id = Column(Integer, Sequence('MeltJobTransition_id_seq'), primary_key=True)
+    jobId = Column(Integer, nullable=False, index=True)
+    fromState = Column(Enum(MeltJobState), nullable=True)
+    toState = Column(Enum(MeltJobState), nullable=False)
+    at = Column(DateTime, nullable=False)
+    worker = Column(String, nullable=True)
+
+    def __repr__(self):
+        attrs = {
+            'jobId': self.jobId,
+            'fromState': self.fromState,
+            'toState': self.toState,
+            'at': self.at,
+            'worker': self.worker
+        }
+        return f'MeltJobTransition{repr(attrs)}'
+
+    @classmethod
+    def last_id(cls, session: Session) -> int:
+        return session.query(func.max(cls.id)).scalar() or 0
+
+    @classmethod
+    def since(cls, session: Session, after_id, limit) -> 'List[MeltJobTransition]':
+        return session.query(cls) \
+            .filter(cls.id > after_id) \
+            .order_by(cls.id) \
+            .limit(limit) \
+            .all()
+
+    @classmethod
+    def with_ids(cls, session: Session, ids) -> 'List[MeltJobTransition]':
+        return session.query(cls).filter(cls.id.in_(ids)).order_by(cls.id).all()
+
+
+@event.listens_for(MeltJobHandle, 'before_update')
+def _on_state_change(mapper, connection, target):
+    if not inspect(target).attrs.state.history.has_changes():
+        return
+    target.manager = Config.identity
+    if target.state in DONE_STATES and target.finishedAt is None:
+        target.finishedAt = utcnow()
+
+
+@event.listens_for(MeltJobHandle, 'after_insert')
+@event.listens_for(MeltJobHandle, 'after_update')
+def _record_transition(mapper, connection, target):
+    history = inspect(target).attrs.state.history
+    if not history.has_changes():
+        return
+    connection.execute(MeltJobTransition.__table__.insert().values(
+        jobId=target.id,
+        fromState=history.deleted[0] if history.deleted else None,
+        toState=target.state,
+        at=utcnow(),
+        worker=target.worker))
+    # Wakes JobEvents once the session commits
+    object_session(target).info['state_changed'] = True
+
+
+class JobVerification(Base):
+    """Checks of a result file, a row per verified attempt"""
+    __tablename__ = 'JobVerification'
+    id = Column(Integer, Sequence('JobVerification_id_seq'), primary_key=True)
+    jobId = Column(Integer, nullable=False, index=True)
+    ok = Column(Boolean, nullable=False)
+    error = Column(String, nullable=True)
+    size = Column(Integer, nullable=True)
+    # sha256 of the result file
+    checksum = Column(String, nullable=True)
+    duration = Column(Float, nullable=True)
+    frames = Column(Integer, nullable=True)
+    expectedFrames = Column(Integer, nullable=True)
+    probeSeconds = Column(Float, nullable=True)
+    checksumSeconds = Column(Float, nullable=True)
+    verifiedAt = Column(DateTime, nullable=False, default=utcnow)
+
+    def __repr__(self):
+        attrs = {
+            'jobId': self.jobId,
+            'ok': self.ok,
+            'frames': self.frames,
+            'expectedFrames': self.expectedFrames,
+            'checksum': self.checksum
+        }
+        if self.error is not None:
+            attrs['error'] = self.error
+        return f'JobVerification{repr(attrs)}'
+
+    @classmethod
+    def of_job(cls, session: Session, job_id) -> 'List[JobVerification]':
+        return session.query(cls) \
+            .filter(cls.jobId == job_id) \
+            .order_by(cls.id) \
+            .all()
+
+
+class ResultCacheEntry(Base):
+    """Finished encode result by the content hash of its inputs"""
+    __tablename__ = 'ResultCacheEntry'
+    key = Column(String, primary_key=True)
+    path = Column(String, nullable=False)
+    size = Column(Integer, nullable=False)
+    mtime = Column(Float, nullable=False)
+    jobId = Column(Integer, nullable=False)
+    createdAt = Column(DateTime, nullable=False)
+    lastUsedAt = Column(DateTime, nullable=False, index=True)
+
+    def __repr__(self):
+        attrs = {
+            'key': self.key,
+            'path': self.path,
+            'size': self.size,
+            'jobId': self.jobId
+        }
+        return f'ResultCacheEntry{repr(attrs)}'
+
+    def is_valid(self) -> bool:
+        """The file may have been removed or overwritten outside of the cache"""
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return False
+        return stat.st_size == self.size and stat.st_mtime == self.mtime
@@ -0,0 +1,166 @@
+import collections
+import heapq
+import itertools
+
+from mipt_distencode.config import Config
+
+
+def parse_identity_values(spec, cast) -> 'Dict[str, Any]':
+    """Parse 'identity=value,...', e.g. 'dept-video=3,dept-lectures=1'"""
+    values = dict()
+    for item in filter(None, (part.strip() for part in (spec or '').split(','))):
+        identity, value = item.split('=', 1)
+        values[identity.strip()] = cast(value)
+    return values
+
+
+class FairShare:
+    """Weighted fair share of worker slots between submitter identities
+
+    Stride scheduling: a dispatch advances the identity's pass by 1/weight and
+    the identity with the lowest pass goes next. An identity returning after
+    idling starts at the current virtual time, idle share is not banked.
+    Priorities are strict, any queued job of a higher priority goes first.
+    Within an identity and priority jobs go in submission order, or cheapest
+    estimated first with shortest_first.
+
+    Jobs without a submitter share the '' identity. Not thread-safe,
+    the Scheduler calls it under its lock"""
+    def __init__(self, weights, limits, default_limit=0, shortest_first=False):
+        self.weights = weights
+        self.limits = limits
+        self.default_limit = default_limit
+        self.shortest_first = shortest_first
+        self.passes = dict()
+        self.virtual_time = 0.0
+        # Job id -> identity, of jobs holding a slot
+        self.owners = dict()
+        self.inflight = collections.Counter()
+
+    @classmethod
+    def from_config(cls) -> 'FairShare':
+        return cls(parse_identity_values(Config.fair_share_weights, float),
+                   parse_identity_values(Config.fair_share_limits, int),
+                   Config.fair_share_max_inflight,
+                   shortest_first=Config.queue_order == 'sjf')
+
+    def weight(self, identity) -> float:
+        return self.weights.get(identity, 1.0)
+
+    def limit(self, identity) -> int:
+        """Jobs the identity may have in flight, 0 is unlimited"""
+        return self.limits.get(identity, self.default_limit)
+
+    def can_start(self, identity, inflight=None) -> bool:
+        identity = identity or ''
+        limit = self.limit(identity)
+        count = self.inflight[identity] if inflight is None else inflight[identity]
+        return limit <= 0 or count < limit
+
+    def pass_of(self, identity) -> float:
+        return max(self.passes.get(identity, 0.0), self.virtual_time)
+
+    def started(self, job_id, identity):
+        if job_id in self.owners:
+            return
+        identity = identity or ''
+        self.owners[job_id] = identity
+        self.inflight[identity] += 1
+        self.virtual_time = self.pass_of(identity)
+        self.passes[identity] = self.virtual_time + 1 / self.weight(identity)
+
+    def finished(self, job_id):
+        identity = self.owners.pop(job_id, None)
+        if identity is None:
+            return
+        self.inflight[identity] -= 1
+        if self.inflight[identity] <= 0:
+            del self.inflight[identity]
+
+    def choose(self, heads, inflight=None, passes=None) -> 'Optional[str]':
+        """Identity to serve next from {identity: priority of its first job}"""
+        passes = passes or {}
+        allowed = [
+            identity for identity in heads if self.can_start(identity, inflight)
+        ]
+        if not allowed:
+            return None
+        return min(allowed, key=lambda identity: (
+            -heads[identity], passes.get(identity, self.pass_of(identity)),
+            identity))
+
+    def rank(self, priority, cost) -> tuple:
+        """Sort key of a job among jobs of its identity"""
+        return -priority, (cost or 0.0) if self.shortest_first else 0.0
+
+    def order(self, candidates) -> list:
+        """Candidates with .submitter, .priority and .estimatedCost in fair
+        dispatch order, ones over the in-flight limit of their identity are left out"""
+        queues = collections.defaultdict(collections.deque)
+        for candidate in sorted(
+                candidates, key=lambda c: self.rank(c.priority, c.estimatedCost)):
+            queues[candidate.submitter or ''].append(candidate)
+        inflight = collections.Counter(self.inflight)
+        passes = {identity: self.pass_of(identity) for identity in queues}
+        ordered = list()
+        while queues:
+            heads = {identity: queue[0].priority for identity, queue in queues.items()}
+            identity = self.choose(heads, inflight, passes)
+            if identity is None:
+                break
+            ordered.append(queues[identity].popleft())
+            if not queues[identity]:
+                del queues[identity]
+            inflight[identity] += 1
+            passes[identity] += 1 / self.weight(identity)
+        return ordered
+
+
+class FairShareQueue:
+    """Pending job ids, a queue per priority and identity"""
+    def __init__(self, fair_share):
+        self.fair_share = fair_share
+        # (priority, identity) -> heap of (rank, sequence number, job id)
+        self.queues = collections.defaultdict(list)
+        self.queued = set()
+        self.sequence = itertools.count()
+
+    def __len__(self):
+        return len(self.queued)
+
+    def __contains__(self, job_id):
+        return job_id in self.queued
+
+    def append(self, job_id, identity, priority, cost=None):
+        if job_id in self.queued:
+            return
+        self.queued.add(job_id)
+        heapq.heappush(self.queues[(priority, identity or '')], (
+            self.fair_share.rank(priority, cost), next(self.sequence), job_id))
+
+    def pop(self) -> 'Optional[int]':
+        """Next job id, None if empty or all identities are at their limits"""
+        key = self._next_key()
+        if key is None:
+            return None
+        _, _, job_id = heapq.heappop(self.queues[key])
+        if not self.queues[key]:
+            del self.queues[key]
+        self.queued.discard(job_id)
+        return job_id
+
+    def peek(self) -> 'Optional[Tuple[int, int]]':
+        """(job id, priority) of the job pop() returns"""
+        key = self._next_key()
+        if key is None:
+            return None
+        return self.queues[key][0][2], key[0]
+
+    def _next_key(self) -> 'Optional[Tuple[int, str]]':
+        heads = dict()
+        for priority, identity in self.queues:
+            heads[identity] = max(heads.get(identity, priority), priority)
+        identity = self.fair_share.choose(heads)
+        if identity is None:
+            return None
+        return heads[identity], identity
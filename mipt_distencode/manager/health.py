@@ -0,0 +1,78 @@
+import logging
+import threading
+from concurrent import futures
+
+import grpc
+
+from mipt_distencode.config import Config
+from mipt_distencode.manager.db_models import utcnow
+from mipt_distencode.mgmt_messages_pb2 import WorkerIdentity
+from mipt_distencode.worker.client import make_client as make_worker_client
+
+
+class HealthMonitor(threading.Thread):
+    """Polls Worker.GetState of all known workers concurrently
+
+    A worker failing max_failures polls in a row is reported down once,
+    it keeps being polled and is reported alive again when it answers"""
+    def __init__(self, servicer, interval, timeout, max_failures):
+        super().__init__(name='HealthMonitor', daemon=True)
+        self.servicer = servicer
+        self.interval = interval
+        self.timeout = timeout
+        self.max_failures = max_failures
+        # Hostname -> consecutive failed polls
+        self.failures = dict()
+        self.lock = threading.Lock()
+        self.pool = futures.ThreadPoolExecutor(
+            max_workers=16, thread_name_prefix='health')
+        self.stopping = threading.Event()
+        self.logger = logging.getLogger(__name__)
+
+    def add(self, hostname):
+        with self.lock:
+            self.failures[hostname] = 0
+
+    def discard(self, hostname):
+        with self.lock:
+            self.failures.pop(hostname, None)
+
+    def hostnames(self) -> 'Set[str]':
+        with self.lock:
+            return set(self.failures)
+
+    def run(self):
+        while not self.stopping.wait(self.interval):
+            try:
+                self.poll()
+            except Exception:
+                self.logger.exception('Health poll failed')
+
+    def stop(self):
+        self.stopping.set()
+        self.join()
+
+    def poll(self, recovering=False):
+        polled_at = utcnow()
+        with self.lock:
+            hostnames = list(self.failures)
+        states = self.pool.map(self._get_state, hostnames)
+        for hostname, state in zip(hostnames, states):
+            with self.lock:
+                if hostname not in self.failures:
+                    continue  # Unregistered meanwhile
+                failures = 0 if state is not None else self.failures[hostname] + 1
+                self.failures[hostname] = failures
+            if state is not None:
+                self.servicer.worker_alive(state, polled_at, recovering)
+            elif failures == self.max_failures:
+                self.servicer.worker_down(hostname)
+
+    def _get_state(self, hostname) -> 'Optional[WorkerSelfAnnouncement]':
+        client = make_worker_client(endpoint=f'{hostname}:50053', secure=True)
+        try:
+            return client.GetState(WorkerIdentity(hostname=hostname, manager=Config.identity),
+                                   timeout=self.timeout)
+        except grpc.RpcError as e:
+            self.logger.debug('Worker %s did not answer: %s', hostname, e.code())
+            return None
@@ -0,0 +1,137 @@
+import logging
+import threading
+import time
+
+from sqlalchemy import event
+
+from mipt_distencode.manager.db_models import MeltJobHandle, MeltJobTransition, Session
+
+
+class JobWatcher:
+    """Filter of JobStatus messages for one WatchJobs stream, passed to
+    deliver from the JobEvents thread, None ends the stream"""
+    def __init__(self, job_ids, submitter, deliver):
+        self.job_ids = set(job_ids)
+        self.submitter = submitter
+        self.deliver = deliver
+
+    def offer(self, status):
+        if status.id.id in self.job_ids \
+                or (self.submitter is not None and status.submitter == self.submitter):
+            self.deliver(status)
+
+    def close(self):
+        self.deliver(None)
+
+
+class JobEvents(threading.Thread):
+    """Fans state changes of posted jobs out to watchers
+
+    One thread tails MeltJobTransition for all of them: woken by commits of
+    this replica that changed a state, and every poll_interval for changes by
+    other replicas sharing the database. A batch of transitions costs one query
+    for the jobs they touched, however many watchers there are. Watchers get
+    the job status as of that query, changes in between are coalesced.
+
+    Ids are taken when a transaction inserts a transition, not when it
+    commits, so with concurrent writers a lower id can show up after the
+    cursor passed it. Skipped ids below the cursor are looked up again every
+    round for gap_interval, longer transactions or rolled back ids are
+    given up on"""
+    BATCH = 500
+
+    def __init__(self, poll_interval, gap_interval, max_watchers):
+        super().__init__(name='JobEvents', daemon=True)
+        self.poll_interval = poll_interval
+        self.gap_interval = gap_interval
+        self.max_watchers = max_watchers
+        self.watchers = set()
+        self.lock = threading.Lock()
+        # Id of the last transition fanned out, None while nobody watches
+        self.cursor = None
+        # Skipped ids below the cursor to their monotonic deadlines
+        self.gaps = dict()
+        self.changed = threading.Event()
+        self.stopping = threading.Event()
+        self.logger = logging.getLogger(__name__)
+        event.listen(Session, 'after_commit', self._on_commit)
+
+    def subscribe(self, job_ids, submitter, deliver) -> 'Optional[JobWatcher]':
+        """Changes committed from now on are passed to deliver, None if there
+        are max_watchers already"""
+        with self.lock:
+            if len(self.watchers) >= self.max_watchers:
+                return None
+            if self.cursor is None:
+                with Session() as session:
+                    self.cursor = MeltJobTransition.last_id(session)
+            watcher = JobWatcher(job_ids, submitter, deliver)
+            self.watchers.add(watcher)
+        return watcher
+
+    def unsubscribe(self, watcher):
+        with self.lock:
+            self.watchers.discard(watcher)
+        watcher.close()
+
+    def watcher_count(self) -> int:
+        with self.lock:
+            return len(self.watchers)
+
+    def run(self):
+        while not self.stopping.is_set():
+            self.changed.wait(self.poll_interval)
+            self.changed.clear()
+            try:
+                self._fan_out()
+            except Exception:
+                # The cursor stays, the next round retries the same batch
+                self.logger.exception('Cannot fan out job state changes')
+
+    def stop(self):
+        self.stopping.set()
+        self.changed.set()
+        self.join()
+        with self.lock:
+            watchers, self.watchers = self.watchers, set()
+        for watcher in watchers:
+            watcher.close()
+
+    def _on_commit(self, session):
+        if session.info.pop('state_changed', False):
+            self.changed.set()
+
+    def _fan_out(self):
+        with self.lock:
+            if not self.watchers:
+                self.cursor = None
+                self.gaps.clear()
+                return
+            cursor = self.cursor
+        now = time.monotonic()
+        self.gaps = {id: deadline for id, deadline in self.gaps.items() if deadline > now}
+        with Session() as session:
+            transitions = MeltJobTransition.since(session, cursor, self.BATCH)
+            late = MeltJobTransition.with_ids(session, list(self.gaps)) if self.gaps else []
+            if not transitions and not late:
+                return
+            statuses = [
+                job_handle.proto_status() for job_handle in MeltJobHandle.submitted_with_ids(
+                    session, {transition.jobId for transition in transitions + late})
+            ]
+        for transition in late:
+            del self.gaps[transition.id]
+        seen = {transition.id for transition in transitions}
+        last = transitions[-1].id if transitions else cursor
+        for id in range(cursor + 1, last):
+            if id not in seen:
+                self.gaps[id] = now + self.gap_interval
+        with self.lock:
+            if self.cursor is not None:
+                self.cursor = max(self.cursor, last)
+            watchers = list(self.watchers)
+        for status in statuses:
+            for watcher in watchers:
+                watcher.offer(status)
+        if len(transitions) == self.BATCH:
+            self.changed.set()
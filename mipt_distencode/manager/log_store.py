@@ -0,0 +1,50 @@
+import gzip
+import os
+
+
+READ_CHUNK_SIZE = 64 * 1024
+
+
+class LogStore:
+    """Compressed job logs as files under a directory, outside the job table"""
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, job_id) -> str:
+        return os.path.join(self.root, f'job-{job_id}.log.gz')
+
+    def exists(self, job_id) -> bool:
+        return os.path.exists(self.path(job_id))
+
+    def write(self, job_id, chunks) -> int:
+        """Store (offset, data) chunks of a gzip stream, returns its size
+
+        Written to a temporary file first, a broken upload leaves the old log"""
+        path = self.path(job_id)
+        partial = f'{path}.partial'
+        size = 0
+        with open(partial, 'wb') as log_file:
+            for offset, data in chunks:
+                if offset != size:
+                    raise ValueError(f'Expected chunk at offset {size}, got {offset}')
+                log_file.write(data)
+                size += len(data)
+        os.replace(partial, path)
+        return size
+
+    def read(self, job_id, offset=0, length=None):
+        """Yields (offset, data) of the decompressed log in the given range"""
+        end = None if not length else offset + length
+        position = 0
+        with gzip.open(self.path(job_id), 'rb') as log_file:
+            while end is None or position < end:
+                data = log_file.read(READ_CHUNK_SIZE)
+                if not data:
+                    return
+                chunk_start, position = position, position + len(data)
+                if position <= offset:
+                    continue
+                start = max(offset - chunk_start, 0)
+                stop = len(data) if end is None else min(end - chunk_start, len(data))
+                yield chunk_start + start, data[start:stop]
@@ -1,25 +1,129 @@
-import collections
+import datetime
+import itertools
 import logging
+import math
+import os
+import threading
+import time
+from concurrent import futures
 
 import grpc
 
 from mipt_distencode import jobs_pb2, mgmt_messages_pb2
+from mipt_distencode.config import Config
 from mipt_distencode.manager import manager_pb2_grpc
+from mipt_distencode.manager.cost import CostModel, analyze_project, estimate_cost, job_frames
 from mipt_distencode.manager.db_models import (
-    MeltJobHandle, MeltJobState, Session, WorkerRecord, WorkerState
+    FILE_WORK_STATES, LIVE_STATES, JobVerification, ManagerReplica, MeltJobHandle,
+    MeltJobState, Session, WorkerRecord, WorkerState, from_unix_seconds, utcnow
 )
+from mipt_distencode.manager.health import HealthMonitor
+from mipt_distencode.manager.job_events import JobEvents
+from mipt_distencode.manager.log_store import LogStore
+from mipt_distencode.manager.merge import SegmentMerger, segment_path, split_frames
+from mipt_distencode.manager.result_cache import ResultCache, compute_cache_key, materialize
+from mipt_distencode.manager.result_upload import ResultUploadStore
+from mipt_distencode.manager.retry import RetryPolicy, speculative_path
+from mipt_distencode.manager.scheduler import Scheduler
+from mipt_distencode.manager.supervisor import JobSupervisor
+from mipt_distencode.manager.verify import ResultVerifier
+from mipt_distencode.metrics import REGISTRY
+from mipt_distencode.mlt_project import MltProject
 from mipt_distencode.pb_common import PeerIdentityMixin
 from mipt_distencode.worker.client import make_client as make_worker_client
 
 
+JOBS = REGISTRY.gauge('distenc_jobs', 'Jobs not finished, failed or cancelled', ['state'])
+WORKER_JOBS = REGISTRY.gauge('distenc_worker_jobs', 'Jobs in progress per worker', ['worker'])
+WORKER_SLOTS = REGISTRY.gauge(
+    'distenc_worker_slots', 'Slots and jobs holding them per worker, push mode',
+    ['worker', 'kind'])
+PENDING_JOBS = REGISTRY.gauge(
+    'distenc_pending_jobs', 'Jobs queued until a worker has a free slot, push mode')
+QUEUE_WAIT = REGISTRY.histogram(
+    'distenc_job_queue_wait_seconds', 'Time from submission to the first dispatch',
+    buckets=(1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600, 7200, 14400, 43200, 86400))
+ENCODE_FPS = REGISTRY.histogram(
+    'distenc_encode_fps', 'Project frames per second of successful encodes',
+    ['preset'], buckets=(1, 2, 5, 10, 25, 50, 100, 250, 500, 1000))
+REALTIME_FACTOR = REGISTRY.histogram(
+    'distenc_encode_realtime_factor', 'Seconds of video encoded per second',
+    ['preset'], buckets=(.1, .25, .5, 1, 2, 4, 8, 16, 32, 64))
+ENCODED_FRAMES = REGISTRY.counter(
+    'distenc_encoded_frames_total', 'Project frames of successful encodes', ['preset'])
+JOB_WATCHERS = REGISTRY.gauge('distenc_job_watchers', 'Open WatchJobs streams')
+
+
+def sees_all_jobs(peer_id) -> bool:
+    """Manager replicas and admins see the jobs of every submitter"""
+    return peer_id in Config.manager_addresses or peer_id in Config.admin_identities
+
+
 class ManagerServicer(manager_pb2_grpc.ManagerServicer, PeerIdentityMixin):
-    """Not thread-safe, use only with single-threaded RPC server"""
+    """Thread-safe: in-memory state lives in the Scheduler, job state changes
+    that may race are compare-and-set updates in the database
+
+    Replicas may share the database, each owns some workers and dispatches to
+    them, see _renew_replica"""
+    LEASE_OVERFETCH = 32
+    # Finished attempts the cost model is calibrated on at startup
+    CALIBRATION_HISTORY = 1000
+    DEFAULT_PAGE_SIZE = 100
+    MAX_PAGE_SIZE = 1000
+
     def __init__(self):
         super().__init__()
-        self.workers = collections.deque()
+        self.cost_model = CostModel()
+        self.scheduler = Scheduler.from_config(Config.scheduler_policy, self.cost_model)
+        self.push_dispatch = Config.dispatch_mode == 'push'
+        self.lease_duration = datetime.timedelta(seconds=Config.lease_seconds)
+        self.replica_lease = datetime.timedelta(seconds=Config.replica_lease_seconds)
+        # As of the last supervision round
+        self.live_replicas = [Config.identity]
+        # Workers owned by other live replicas, their jobs are checked there
+        self.foreign_workers = set()
+        self.jobs_available = threading.Condition()
+        self.log_store = LogStore(Config.log_dir)
+        self.result_uploads = ResultUploadStore()
+        # Ids of melt runs that are over and upload their outputs, slots are free
+        self.uploading = set()
+        # Latest JobProgress of running jobs by id and when it arrived
+        self.progress = dict()
+        self.progress_seen = dict()
+        self.retry_policy = RetryPolicy.from_config()
+        self.supervisor = JobSupervisor(self, Config.supervise_interval_seconds)
+        self.job_events = JobEvents(
+            Config.watch_poll_seconds, Config.watch_gap_seconds, Config.max_watchers)
+        self.health = HealthMonitor(
+            self, Config.health_interval_seconds, Config.health_timeout_seconds,
+            Config.health_max_failures)
+        # Job id -> health polls in a row its worker did not list it
+        self.missing_jobs = dict()
+        # Segment merges and result copies, kept off the RPC threads
+        self.file_pool = futures.ThreadPoolExecutor(
+            max_workers=2, thread_name_prefix='files')
+        self.verifier = ResultVerifier(
+            Config.verify_threads, Config.melt_preset_dir, Config.verify_frame_tolerance)
+        self.result_cache = None
+        if Config.result_cache_dir and Config.melt_preset_dir:
+            self.result_cache = ResultCache(
+                Config.result_cache_dir,
+                max_bytes=int(Config.result_cache_max_gb * 2**30),
+                max_age=datetime.timedelta(days=Config.result_cache_max_age_days))
         self.logger = logging.getLogger(__name__)
         self.logger.setLevel(logging.DEBUG)
-        self._reset_workers()  # TODO request state from workers
+        JOBS.set_function(self._job_counts)
+        WORKER_JOBS.set_function(self._worker_job_counts)
+        WORKER_SLOTS.set_function(self._slot_usage)
+        PENDING_JOBS.set_function(lambda: {(): self.scheduler.usage()[1]})
+        JOB_WATCHERS.set_function(lambda: {(): self.job_events.watcher_count()})
+        self._restore_workers()
+        with Session() as session:
+            self.cost_model.warm_up(
+                MeltJobHandle.recently_encoded(session, self.CALIBRATION_HISTORY))
+        if self.result_cache is not None:
+            with Session() as session:
+                self.result_cache.evict(session)
 
     def WorkerAnnounce(self, announcement, context):
         peer_id = self.identify_peer(context)
@@ -40,20 +144,43 @@ class ManagerServicer(manager_pb2_grpc.ManagerServicer, PeerIdentityMixin):
 
     def PostMeltJob(self, proto, context):
         peer_id = self.identify_peer(context)
-        if proto.HasField('id'):
-            context.abort(
-                grpc.StatusCode.INVALID_ARGUMENT, f'Id must not be provided')
+        error = _validate_new_job(proto)
+        if error is not None:
+            context.abort(grpc.StatusCode.INVALID_ARGUMENT, error)
         with Session() as session:
-            job_handle = MeltJobHandle.new_from_proto(proto, session)
-            worker = self._choose_worker()
-            self.logger.info(f'Accepted job: {job_handle}, chosen worker: {worker}')
-            worker_client = make_worker_client(
-                endpoint=f'{worker}:50053', secure=True)
-            accepted_id = worker_client.PostMeltJob(job_handle.proto_job())
-            assert accepted_id.id == job_handle.id
-            job_handle.state = MeltJobState.IN_PROGRESS
+            job_handles = self._new_jobs(proto, session, peer_id)
+            session.commit()
+            for job_handle in job_handles:
+                self.logger.info(f'Accepted job: {job_handle}')
+            self._schedule_new_jobs([(job_handle, proto) for job_handle in job_handles],
+                                    session)
+            self._notify_jobs_available()
+            return jobs_pb2.JobId(id=job_handles[0].id)
+
+    def PostMeltJobs(self, batch, context):
+        peer_id = self.identify_peer(context)
+        result = jobs_pb2.MeltJobBatchResult()
+        accepted = list()
+        with Session() as session:
+            for proto in batch.jobs:
+                submission = result.submissions.add()
+                error = _validate_new_job(proto)
+                if error is not None:
+                    submission.error = error
+                    continue
+                accepted.append((submission, proto, self._new_jobs(proto, session, peer_id)))
             session.commit()
-            return accepted_id
+            self.logger.info('Accepted %s of %s jobs from %s',
+                             len(accepted), len(batch.jobs), peer_id)
+            for submission, _, job_handles in accepted:
+                submission.id.id = job_handles[0].id
+            # Scheduled together, so that jobs of the batch can share melt runs
+            self._schedule_new_jobs([
+                (job_handle, proto)
+                for _, proto, job_handles in accepted for job_handle in job_handles
+            ], session)
+            self._notify_jobs_available()
+        return result
 
     def PostMeltJobResult(self, proto, context):
         peer_id = self.identify_peer(context)
@@ -63,39 +190,390 @@ class ManagerServicer(manager_pb2_grpc.ManagerServicer, PeerIdentityMixin):
                 message = f'Job id={proto.id.id} not found'
                 self.logger.error(message)
                 context.abort(grpc.StatusCode.NOT_FOUND, message)
-            if job_handle.state != MeltJobState.IN_PROGRESS:
+            if job_handle.state == MeltJobState.WAITING_RETRY and proto.success \
+                    and proto.HasField('resultPath') \
+                    and self._accept_late_result(job_handle, peer_id, session):
+                self.logger.info('Job id=%s: late result from %s accepted',
+                                 job_handle.id, peer_id)
+            elif job_handle.state != MeltJobState.IN_PROGRESS:
                 message = f'Job id={job_handle.id} is in invalid state {job_handle.state}'
                 self.logger.error(message)
                 context.abort(grpc.StatusCode.FAILED_PRECONDITION, message)
-            elif not proto.success:
-                job_handle.state = MeltJobState.FAILED
-                session.commit()
-                message = 'Job id={} failed, error: {}, log: {}'.format(
-                    job_handle.id, proto.error, proto.log)
-                self.logger.warning(message)
-                return proto
-            elif not proto.HasField('resultPath'):
+            elif job_handle.leaseOwner not in [None, peer_id]:
+                message = f'Job id={job_handle.id} is leased by {job_handle.leaseOwner}'
+                self.logger.error(message)
+                context.abort(grpc.StatusCode.FAILED_PRECONDITION, message)
+            elif job_handle.worker not in [None, peer_id]:
+                message = f'Job id={job_handle.id} is running on {job_handle.worker}'
+                self.logger.error(message)
+                context.abort(grpc.StatusCode.FAILED_PRECONDITION, message)
+            elif not proto.HasField('resultPath') and proto.success:
                 message = f'Job id={job_handle.id}: missing field: resultPath'
                 self.logger.error(message)
                 context.abort(grpc.StatusCode.INVALID_ARGUMENT, message)
+            self._end_attempt(job_handle)
+            if not proto.success:
+                message = 'Job id={} failed, error: {}, log: {}'.format(
+                    job_handle.id, _tail(proto.error), _tail(proto.log))
+                self.logger.warning(message)
+                if proto.timedOut and job_handle.speculativeOf is None:
+                    # Another attempt would run out of time just the same
+                    self._fail_job(job_handle, session)
+                    session.commit()
+                    self._notify_jobs_available()
+                else:
+                    self._on_job_failed(job_handle, session)
             else:
-                job_handle.state = MeltJobState.VERIFICATION
-                session.commit()
                 self.logger.info(
-                    'Job id=%s successfully finished: error=%s, log=%s, result=%s',
-                    job_handle.id, proto.error, proto.log, proto.resultPath)
-                return proto
+                    'Job id=%s successfully finished: log=%s, result=%s',
+                    job_handle.id, _tail(proto.log), proto.resultPath)
+                self._on_job_succeeded(job_handle, session)
+            self._dispatch_pending(session)
+            return proto
+
+    def CancelJob(self, job_id, context):
+        peer_id = self.identify_peer(context)
+        with Session() as session:
+            job_handle = session.get(MeltJobHandle, job_id.id)
+            if job_handle is None:
+                context.abort(grpc.StatusCode.NOT_FOUND, f'Job id={job_id.id} not found')
+            if job_handle.submitter not in [None, peer_id]:
+                context.abort(grpc.StatusCode.PERMISSION_DENIED,
+                              f'Job id={job_handle.id} was posted by {job_handle.submitter}')
+            # A segment is cancelled with the whole job
+            job_handle = job_handle.parent(session) or job_handle
+            if job_handle.state not in LIVE_STATES:
+                context.abort(grpc.StatusCode.FAILED_PRECONDITION,
+                              f'Job id={job_handle.id} is already {job_handle.state.name}')
+            if not self._cancel_job(job_handle, session):
+                context.abort(grpc.StatusCode.ABORTED,
+                              f'Job id={job_handle.id} changed state, try again')
+            session.commit()
+            self.logger.info('Job id=%s cancelled by %s', job_handle.id, peer_id)
+            self._dispatch_pending(session)
+            self._notify_jobs_available()
+            return jobs_pb2.JobId(id=job_handle.id)
+
+    def GetJob(self, job_id, context):
+        peer_id = self.identify_peer(context)
+        with Session() as session:
+            job_handle = session.get(MeltJobHandle, job_id.id)
+            if job_handle is None:
+                context.abort(grpc.StatusCode.NOT_FOUND, f'Job id={job_id.id} not found')
+            if job_handle.submitter not in [None, peer_id] and not sees_all_jobs(peer_id):
+                context.abort(grpc.StatusCode.PERMISSION_DENIED,
+                              f'Job id={job_handle.id} was posted by {job_handle.submitter}')
+            return self.job_status(job_handle)
+
+    def ListJobs(self, query, context):
+        peer_id = self.identify_peer(context)
+        submitter = query.submitter if query.HasField('submitter') else None
+        if not sees_all_jobs(peer_id):
+            if submitter not in [None, peer_id]:
+                context.abort(grpc.StatusCode.PERMISSION_DENIED,
+                              f'{peer_id} may only list its own jobs')
+            submitter = peer_id
+        page_size = min(query.pageSize or self.DEFAULT_PAGE_SIZE, self.MAX_PAGE_SIZE)
+        filters = {
+            'states': [MeltJobState.from_proto(state) for state in query.states],
+            'submitter': submitter,
+            'created_after': from_unix_seconds(query.createdAfter)
+                if query.HasField('createdAfter') else None,
+            'created_before': from_unix_seconds(query.createdBefore)
+                if query.HasField('createdBefore') else None,
+        }
+        if query.pageToken:
+            if not query.pageToken.isdigit():
+                context.abort(grpc.StatusCode.INVALID_ARGUMENT,
+                              f'Invalid pageToken: {query.pageToken}')
+            filters['before_id'] = int(query.pageToken)
+        with Session() as session:
+            # One more to know if there is a next page
+            job_handles = MeltJobHandle.submitted(session, limit=page_size + 1, **filters)
+            result = jobs_pb2.JobList(jobs=[
+                self.job_status(job_handle) for job_handle in job_handles[:page_size]
+            ])
+        if len(job_handles) > page_size:
+            result.nextPageToken = str(job_handles[page_size - 1].id)
+        return result
+
+    def job_status(self, job_handle) -> jobs_pb2.JobStatus:
+        status = job_handle.proto_status()
+        # Bundled outputs report progress of the melt run they are rendered in
+        progress = self.progress.get(job_handle.bundledWith or job_handle.id)
+        if progress is not None:
+            status.progress.CopyFrom(progress)
+        return status
+
+    def _accept_late_result(self, job_handle, peer_id, session) -> bool:
+        """A result journaled through an outage after the job was requeued
+        is still good unless another attempt has started"""
+        accepted = MeltJobHandle.transition(
+            session, job_handle.id, [MeltJobState.WAITING_RETRY], MeltJobState.IN_PROGRESS,
+            worker=peer_id)
+        session.commit()
+        session.refresh(job_handle)
+        return accepted
+
+    def UploadJobLog(self, chunks, context):
+        peer_id = self.identify_peer(context)
+        first = next(chunks, None)
+        if first is None:
+            context.abort(grpc.StatusCode.INVALID_ARGUMENT, 'Empty log upload')
+        job_id = first.id.id
+        with Session() as session:
+            if session.get(MeltJobHandle, job_id) is None:
+                context.abort(grpc.StatusCode.NOT_FOUND, f'Job id={job_id} not found')
+        try:
+            size = self.log_store.write(
+                job_id, ((c.offset, c.data) for c in itertools.chain([first], chunks)))
+        except ValueError as e:
+            context.abort(grpc.StatusCode.INVALID_ARGUMENT, str(e))
+        self.logger.info('Job id=%s: stored %s bytes of log from %s', job_id, size, peer_id)
+        return jobs_pb2.LogUploadStatus(id=first.id, size=size)
+
+    def GetResultUpload(self, job_id, context):
+        peer_id = self.identify_peer(context)
+        with Session() as session:
+            job_handle, running_id = self._upload_target(job_id.id, peer_id, session, context)
+            offset = self.result_uploads.offset(job_handle.resultPath, peer_id)
+            if running_id not in self.uploading:
+                # Encoding is over, the slot takes the next job during the transfer
+                self.uploading.add(running_id)
+                self.scheduler.release(running_id)
+                self._dispatch_pending(session)
+        return jobs_pb2.ResultUploadStatus(id=job_id, offset=offset, complete=False)
+
+    def UploadResult(self, chunks, context):
+        peer_id = self.identify_peer(context)
+        first = next(chunks, None)
+        if first is None or not first.HasField('totalSize'):
+            context.abort(grpc.StatusCode.INVALID_ARGUMENT,
+                          'The first chunk must carry totalSize')
+        with Session() as session:
+            job_handle, running_id = self._upload_target(
+                first.id.id, peer_id, session, context)
+            result_path = job_handle.resultPath
+
+        def received():
+            for chunk in itertools.chain([first], chunks):
+                # A long transfer is not a stalled job
+                self.progress_seen[running_id] = time.monotonic()
+                yield chunk.offset, chunk.data
+
+        try:
+            size, complete = self.result_uploads.write(
+                result_path, peer_id, first.totalSize, received())
+        except ValueError as e:
+            context.abort(grpc.StatusCode.OUT_OF_RANGE, str(e))
+        except RuntimeError as e:
+            context.abort(grpc.StatusCode.ABORTED, str(e))
+        except OSError as e:
+            self.logger.error('Job id=%s: cannot store uploaded result: %s', first.id.id, e)
+            context.abort(grpc.StatusCode.INTERNAL, str(e))
+        if complete:
+            self.logger.info('Job id=%s: %s bytes of result uploaded by %s to %s',
+                             first.id.id, size, peer_id, result_path)
+        return jobs_pb2.ResultUploadStatus(id=first.id, offset=size, complete=complete)
+
+    def _upload_target(self, job_id, peer_id, session, context) -> 'Tuple[MeltJobHandle, int]':
+        """The job and the id of the melt run producing it, uploads are only
+        taken from the worker running it"""
+        job_handle = session.get(MeltJobHandle, job_id)
+        if job_handle is None:
+            context.abort(grpc.StatusCode.NOT_FOUND, f'Job id={job_id} not found')
+        running = job_handle
+        if job_handle.state == MeltJobState.BUNDLED:
+            running = session.get(MeltJobHandle, job_handle.bundledWith)
+        if running.state != MeltJobState.IN_PROGRESS or running.worker != peer_id:
+            context.abort(grpc.StatusCode.FAILED_PRECONDITION,
+                          f'Job id={job_id} is not running on {peer_id}')
+        return job_handle, running.id
+
+    def GetJobLog(self, log_range, context):
+        self.identify_peer(context)
+        if not self.log_store.exists(log_range.id.id):
+            context.abort(grpc.StatusCode.NOT_FOUND, f'No log for job id={log_range.id.id}')
+        for offset, data in self.log_store.read(
+                log_range.id.id, log_range.offset, log_range.length):
+            yield jobs_pb2.LogChunk(id=log_range.id, offset=offset, data=data)
+
+    def PostJobProgress(self, proto, context):
+        peer_id = self.identify_peer(context)
+        if peer_id != proto.hostname:
+            message = f'Peer {context.peer()} identified as {peer_id} is not {proto.hostname}'
+            context.abort(grpc.StatusCode.INVALID_ARGUMENT, message)
+        if proto.id.id not in self.progress:
+            with Session() as session:
+                MeltJobHandle.mark_started(session, proto.id.id)
+                session.commit()
+        self.progress[proto.id.id] = proto
+        self.progress_seen[proto.id.id] = time.monotonic()
+        self.scheduler.record_speed(peer_id, proto.fps)
+        self.logger.debug(
+            'Job id=%s on %s: %s%%, %.1f fps, eta %.0fs',
+            proto.id.id, peer_id, proto.percent, proto.fps, proto.etaSeconds)
+        return proto
+
+    def LeaseJobs(self, request, context):
+        peer_id = self.identify_peer(context)
+        if peer_id != request.hostname:
+            message = f'Peer {context.peer()} identified as {peer_id} is not {request.hostname}'
+            context.abort(grpc.StatusCode.INVALID_ARGUMENT, message)
+        response = jobs_pb2.LeaseResponse(leaseSeconds=Config.lease_seconds)
+        deadline = time.monotonic() + min(request.waitSeconds, Config.lease_wait_seconds)
+        while True:
+            with Session() as session:
+                self._expire_leases(session)
+                self._lease_jobs(peer_id, request.maxJobs, response, session)
+            remaining = deadline - time.monotonic()
+            if response.jobs or remaining <= 0 or not context.is_active():
+                return response
+            if len(self.live_replicas) > 1:
+                # Jobs posted to other replicas do not notify this one
+                remaining = min(remaining, Config.lease_poll_seconds)
+            with self.jobs_available:
+                self.jobs_available.wait(remaining)
+
+    def RenewLeases(self, renewal, context):
+        peer_id = self.identify_peer(context)
+        renewed = jobs_pb2.LeaseRenewal(hostname=peer_id)
+        with Session() as session:
+            for job_id in renewal.ids:
+                job_handle = session.get(MeltJobHandle, job_id.id)
+                if job_handle is None or job_handle.leaseOwner != peer_id \
+                        or job_handle.state != MeltJobState.IN_PROGRESS:
+                    self.logger.warning('Job id=%s: %s holds no lease', job_id.id, peer_id)
+                    continue
+                job_handle.grant_lease(peer_id, self.lease_duration)
+                renewed.ids.append(job_id)
+            session.commit()
+        return renewed
+
+    def post_start(self):
+        with Session() as session:
+            self._renew_replica(session)
+        self._reconcile()
+        self.supervisor.start()
+        self.job_events.start()
+        self.health.start()
+
+    def supervise(self):
+        """Called periodically by JobSupervisor"""
+        with Session() as session:
+            self._renew_replica(session)
+            self._expire_leases(session)
+            self._check_running(session)
+            if self.push_dispatch:
+                self._release_ended_attempts(session)
+                for job_handle in MeltJobHandle.due_retries(session, self.LEASE_OVERFETCH):
+                    self._dispatch(job_handle, session)
+                session.commit()
+                if len(self.live_replicas) > 1:
+                    self._dispatch_shared(session)
+
+    def _renew_replica(self, session):
+        """Renew the lease row of this replica, take over replicas that stopped
+        renewing theirs and balance workers between the live ones"""
+        now = utcnow()
+        ManagerReplica.renew(session, Config.identity, self.replica_lease)
+        session.commit()
+        for identity in ManagerReplica.expired(session, now):
+            if ManagerReplica.take_over(session, identity, now):
+                session.commit()
+                self._take_over(identity, session)
+        self.live_replicas = ManagerReplica.live(session, now)
+        self._balance_workers(session)
+
+    def _take_over(self, identity, session):
+        """The replica is gone: its jobs waiting for a merge, verification or
+        copy are redone here, its workers are claimed by balancing"""
+        self.logger.warning('Manager replica %s is gone, taking over its jobs', identity)
+        job_handles = MeltJobHandle.held_by(session, [identity], FILE_WORK_STATES)
+        MeltJobHandle.reassign(session, identity, Config.identity)
+        session.commit()
+        self._resume_file_work(job_handles, session)
+        session.commit()
+
+    def _balance_workers(self, session):
+        """Every live replica owns its share of the workers: workers nobody
+        alive owns are claimed up to the share, idle ones beyond it are
+        released for the others to claim"""
+        records = session.query(WorkerRecord).order_by(WorkerRecord.hostname).all()
+        share = math.ceil(len(records) / len(self.live_replicas))
+        owners = {record.hostname: record.owner for record in records}
+        owned = [record for record in records if record.owner == Config.identity]
+        for record in records:
+            if len(owned) >= share:
+                break
+            owner = owners[record.hostname]
+            if owner != Config.identity and owner not in self.live_replicas \
+                    and record.claim(session, Config.identity):
+                self.logger.info('Claimed worker %s of %s', record.hostname, owner or 'nobody')
+                owned.append(record)
+        inflight = self.scheduler.usage()[0]
+        for record in owned[share:]:
+            if inflight.get(record.hostname, (0, 0))[0] == 0 \
+                    and record.claim(session, None):
+                self.logger.info('Released worker %s to other replicas', record.hostname)
+                owned.remove(record)
+        hostnames = {record.hostname for record in owned}
+        polled = self.health.hostnames()
+        for hostname in hostnames - polled:
+            self.health.add(hostname)
+        for hostname in polled - hostnames:
+            self.logger.info('Worker %s is managed by another replica', hostname)
+            self.scheduler.remove_worker(hostname)
+            self.health.discard(hostname)
+        self.foreign_workers = {
+            hostname for hostname, owner in owners.items()
+            if owner in self.live_replicas and owner != Config.identity
+        }
+
+    def _release_ended_attempts(self, session):
+        """Results of jobs on workers of this replica may reach another one,
+        which cannot free their slots here"""
+        attempts = self.scheduler.inflight_attempts()
+        if not attempts:
+            return
+        for job_id, state, job_attempts in MeltJobHandle.attempts_of(session, attempts):
+            if job_attempts > attempts[job_id] or job_attempts == attempts[job_id] \
+                    and state != MeltJobState.IN_PROGRESS and job_id not in self.uploading:
+                self.scheduler.release(job_id)
+
+    def _dispatch_shared(self, session):
+        """Jobs queued at other replicas, or at one that is gone, take free
+        slots of the workers of this one"""
+        free = self.scheduler.free_slots()
+        if free <= 0:
+            return
+        for job_id, *_ in self.scheduler.fair_order(MeltJobHandle.leasable(session, free)):
+            job_handle = session.get(MeltJobHandle, job_id)
+            if job_handle.state in [MeltJobState.ACCEPTED, MeltJobState.WAITING_RETRY]:
+                self._dispatch(job_handle, session)
+        session.commit()
 
     def add_worker(self, proto, context):
         with Session() as session:
             worker_record = WorkerRecord.lookup_from_proto(proto, session)
             if worker_record is None:
-                worker_record = WorkerRecord.new_from_proto(proto, session)
+                worker_record = WorkerRecord.new_from_proto(
+                    proto, session, owner=Config.identity)
             else:
                 message = f'Duplicate worker: {worker_record.hostname}, peer={context.peer()}'
                 self.logger.warning(message)
-            self.workers.append(worker_record.hostname)
-            self.logger.info('Successfully registered worker: %s', worker_record.hostname)
+            owner = worker_record.owner
+            if owner != Config.identity and (
+                    owner in ManagerReplica.live(session, utcnow())
+                    or not worker_record.claim(session, Config.identity)):
+                self.logger.info('Worker %s is managed by replica %s', proto.hostname, owner)
+                return proto
+            slots = proto.slots if proto.HasField('slots') else 1
+            self.scheduler.add_worker(worker_record.hostname, slots)
+            self.health.add(worker_record.hostname)
+            self.logger.info('Successfully registered worker: %s, slots: %s',
+                             worker_record.hostname, slots)
+            self._dispatch_pending(session)
         return proto
 
     def remove_worker(self, proto, context):
@@ -108,20 +586,775 @@ class ManagerServicer(manager_pb2_grpc.ManagerServicer, PeerIdentityMixin):
             host = worker_record.hostname
             session.delete(worker_record)
             session.commit()
-            self.workers.remove(host)
+            self.scheduler.remove_worker(host)
+            self.health.discard(host)
             self.logger.info('Successfully unregistered worker: %s', host)
         return proto
 
-    def _reset_workers(self):
-        self.logger.info('Resetting worker info at startup...')
+    def worker_alive(self, state, polled_at, recovering=False):
+        """Called by HealthMonitor with the GetState response of a worker
+
+        Jobs the worker holds are adopted, when recovering after a restart the
+        jobs it does not know were lost while the manager was away"""
+        hostname = state.hostname
+        if WorkerState.from_proto(state.newState) == WorkerState.STOPPING:
+            self.scheduler.remove_worker(hostname)
+            return
+        if not self.scheduler.has_worker(hostname):
+            self.logger.info('Worker %s is up, slots: %s', hostname, state.slots)
+        self.scheduler.add_worker(hostname, state.slots or 1)
+        active = set(state.activeJobIds)
         with Session() as session:
-            for worker in session.query(WorkerRecord).all():
-                self.logger.warning('Found: %s', worker)
-                session.delete(worker)
+            for job_handle in MeltJobHandle.on_worker(
+                    session, hostname, [MeltJobState.IN_PROGRESS]):
+                if job_handle.id in active:
+                    self.missing_jobs.pop(job_handle.id, None)
+                    if job_handle.id not in self.uploading:
+                        self.scheduler.adopt(hostname, job_handle)
+                    if recovering:
+                        self.logger.info('Job id=%s: adopted on %s', job_handle.id, hostname)
+                        if job_handle.leaseOwner is not None:
+                            job_handle.leaseDeadline = utcnow() + self.lease_duration
+                    continue
+                # Jobs dispatched after the poll started may not have arrived yet
+                if not recovering and (job_handle.dispatchedAt is None
+                                       or job_handle.dispatchedAt >= polled_at):
+                    self.missing_jobs.pop(job_handle.id, None)
+                    continue
+                misses = self.missing_jobs.get(job_handle.id, 0) + 1
+                self.missing_jobs[job_handle.id] = misses
+                if recovering or misses >= Config.health_max_failures:
+                    del self.missing_jobs[job_handle.id]
+                    self.logger.warning('Job id=%s is lost by %s, requeueing',
+                                        job_handle.id, hostname)
+                    self._requeue(job_handle, session)
             session.commit()
+            self._dispatch_pending(session)
+
+    def worker_down(self, hostname):
+        """Called by HealthMonitor when a worker stops answering"""
+        self.logger.warning('Worker %s is not responding, excluding from scheduling', hostname)
+        self.scheduler.remove_worker(hostname)
+        with Session() as session:
+            for job_handle in MeltJobHandle.on_worker(
+                    session, hostname, [MeltJobState.IN_PROGRESS]):
+                self.logger.warning('Job id=%s was running on %s, requeueing',
+                                    job_handle.id, hostname)
+                self._requeue(job_handle, session)
+            session.commit()
+
+    def _requeue(self, job_handle, session):
+        """The attempt is lost with its worker, retry now rather than after a backoff"""
+        self._end_attempt(job_handle)
+        if job_handle.speculativeOf is not None:
+            self._on_job_failed(job_handle, session)
+            return
+        self._retry_or_fail(job_handle, session, backoff=False)
+        if job_handle.state == MeltJobState.WAITING_RETRY:
+            self._dispatch(job_handle, session)
+        session.commit()
+        self._notify_jobs_available()
+
+    def _reconcile(self):
+        """Startup: adopt jobs that workers still hold, requeue the ones they lost
+        and redo the file work the previous manager process had in memory
+
+        Jobs on workers that do not answer wait for HealthMonitor to give up"""
+        self.logger.info('Reconciling jobs with workers...')
+        self.health.poll(recovering=True)
+        with Session() as session:
+            self._resume_file_work(
+                MeltJobHandle.held_by(session, [Config.identity], FILE_WORK_STATES), session)
+            for job_handle in MeltJobHandle.with_states(session, [MeltJobState.IN_PROGRESS]):
+                segments = job_handle.segments(session)
+                if job_handle.worker is None and segments \
+                        and all(s.state == MeltJobState.FINISHED for s in segments) \
+                        and MeltJobHandle.transition(
+                            session, job_handle.id, [MeltJobState.IN_PROGRESS],
+                            MeltJobState.MERGING):
+                    session.commit()
+                    self._merge_segments(job_handle, session)
+            session.commit()
+            if self.push_dispatch:
+                for job_handle in MeltJobHandle.with_states(session, [MeltJobState.ACCEPTED]):
+                    self._dispatch(job_handle, session)
+                session.commit()
         self.logger.info('Done')
 
-    def _choose_worker(self):
-        chosen = self.workers.popleft()
-        self.workers.append(chosen)
-        return chosen
+    def _resume_file_work(self, job_handles, session):
+        for job_handle in job_handles:
+            if job_handle.state == MeltJobState.MERGING:
+                self.logger.info('Job id=%s: merging segments again', job_handle.id)
+                self._merge_segments(job_handle, session)
+            elif job_handle.state == MeltJobState.VERIFICATION:
+                self.verifier.submit(job_handle, self._on_verification_done)
+            elif job_handle.state == MeltJobState.COALESCED:
+                self._resume_coalesced(job_handle, session)
+
+    def _resume_coalesced(self, job_handle, session):
+        if job_handle.coalescedWith is not None:
+            leader = session.get(MeltJobHandle, job_handle.coalescedWith)
+            if leader.state == MeltJobState.FAILED:
+                job_handle.state = MeltJobState.FAILED
+            elif leader.state == MeltJobState.FINISHED:
+                self._copy_result(job_handle.id, leader.resultPath, job_handle.resultPath)
+            return  # Otherwise resolved when the leader finishes
+        entry = None
+        if self.result_cache is not None and job_handle.cacheKey is not None:
+            entry = self.result_cache.lookup(session, job_handle.cacheKey)
+        if entry is not None:
+            self._copy_result(job_handle.id, entry.path, job_handle.resultPath)
+        else:
+            self.logger.info('Job id=%s: cached result is gone, encoding', job_handle.id)
+            job_handle.state = MeltJobState.ACCEPTED
+
+    def _restore_workers(self):
+        """Registered workers are polled and rejoin scheduling once they answer,
+        except ones another live replica owns"""
+        with Session() as session:
+            live = ManagerReplica.live(session, utcnow())
+            for worker in session.query(WorkerRecord).all():
+                if worker.owner != Config.identity and (
+                        worker.owner in live or not worker.claim(session, Config.identity)):
+                    continue
+                self.logger.info('Known worker: %s', worker)
+                self.health.add(worker.hostname)
+
+    def _job_counts(self) -> 'Dict[Tuple[str], int]':
+        counts = {(state.name,): 0 for state in LIVE_STATES}
+        with Session() as session:
+            for state, _, count in MeltJobHandle.live_counts(session):
+                counts[(state.name,)] += count
+        return counts
+
+    def _worker_job_counts(self) -> 'Dict[Tuple[str], int]':
+        with Session() as session:
+            return {
+                (worker,): count
+                for state, worker, count in MeltJobHandle.live_counts(session)
+                if state == MeltJobState.IN_PROGRESS and worker is not None
+            }
+
+    def _slot_usage(self) -> 'Dict[Tuple[str, str], int]':
+        usage = dict()
+        for hostname, (inflight, slots) in self.scheduler.usage()[0].items():
+            usage[(hostname, 'total')] = slots
+            usage[(hostname, 'used')] = inflight
+        return usage
+
+    @staticmethod
+    def _record_queue_wait(job_handle):
+        if job_handle.attempts <= 1:
+            QUEUE_WAIT.observe((utcnow() - job_handle.createdAt).total_seconds())
+
+    @staticmethod
+    def _record_throughput(job_handle, seconds):
+        stats = analyze_project(job_handle.projectPath)
+        if stats is None or seconds <= 0:
+            return
+        frames = job_frames(job_handle)
+        preset = job_handle.encodingPresetName
+        ENCODE_FPS.observe(frames / seconds, preset)
+        REALTIME_FACTOR.observe(float(frames / stats.frame_rate) / seconds, preset)
+        ENCODED_FRAMES.inc(preset, amount=frames)
+
+    @staticmethod
+    def _new_jobs(proto, session, submitter) -> 'List[MeltJobHandle]':
+        """The job and a job per extra output, each output has its own result
+        and state, dispatching bundles them back into one melt run"""
+        job_handle = MeltJobHandle.new_from_proto(
+            proto, session, commit=False, submitter=submitter)
+        return [job_handle] + [
+            job_handle.new_output(output.encodingPresetName, output.resultPath, session)
+            for output in proto.extraOutputs
+        ]
+
+    def _schedule_new_jobs(self, jobs, session):
+        """jobs are (MeltJobHandle, MeltJob), all of them are queued before the
+        first is dispatched"""
+        ready = list()
+        for job_handle, proto in jobs:
+            job_handle.estimatedCost = estimate_cost(job_handle, Config.melt_preset_dir)
+            if self._reuse_result(job_handle, session):
+                continue
+            segments = self._split_job(job_handle, proto, session)
+            if segments:
+                job_handle.state = MeltJobState.IN_PROGRESS
+                ready.extend(segments)
+            else:
+                ready.append(job_handle)
+        session.commit()
+        for job_handle in ready:
+            if job_handle.state == MeltJobState.ACCEPTED:  # Not bundled meanwhile
+                self._dispatch(job_handle, session)
+        session.commit()
+
+    def _reuse_result(self, job_handle, session) -> bool:
+        """Serve the job from the result cache or attach it to an identical one"""
+        if self.result_cache is None:
+            return False
+        job_handle.cacheKey = compute_cache_key(job_handle, Config.melt_preset_dir)
+        if job_handle.cacheKey is None:
+            self.logger.info('Job id=%s: inputs unreadable, not cached', job_handle.id)
+            return False
+        entry = self.result_cache.lookup(session, job_handle.cacheKey)
+        if entry is not None:
+            self.logger.info('Job id=%s: cache hit, reusing result of job id=%s',
+                             job_handle.id, entry.jobId)
+            job_handle.state = MeltJobState.COALESCED
+            session.commit()
+            self._copy_result(job_handle.id, entry.path, job_handle.resultPath)
+            return True
+        leader = MeltJobHandle.in_flight_with_key(session, job_handle.cacheKey)
+        if leader is None or leader.id == job_handle.id:
+            session.commit()
+            return False
+        self.logger.info('Job id=%s: coalesced with identical job id=%s',
+                         job_handle.id, leader.id)
+        job_handle.state = MeltJobState.COALESCED
+        job_handle.coalescedWith = leader.id
+        session.commit()
+        # The leader may have finished before the follower was committed
+        session.refresh(leader)
+        if leader.state in [MeltJobState.FINISHED, MeltJobState.FAILED]:
+            self._resolve_followers(leader, session)
+            session.commit()
+        return True
+
+    def _resolve_followers(self, leader, session):
+        for follower in leader.followers(session):
+            if leader.state == MeltJobState.FAILED:
+                self.logger.warning('Job id=%s failed, failing coalesced job id=%s',
+                                    leader.id, follower.id)
+                follower.state = MeltJobState.FAILED
+            else:
+                self._copy_result(follower.id, leader.resultPath, follower.resultPath)
+
+    def _copy_result(self, job_id, source, destination):
+        future = self.file_pool.submit(materialize, source, destination)
+        future.add_done_callback(
+            lambda f, job_id=job_id: self._on_copy_done(job_id, f))
+
+    def _on_copy_done(self, job_id, future):
+        with Session() as session:
+            if future.exception() is None:
+                self.logger.info('Job id=%s: result reused at %s', job_id, future.result())
+                MeltJobHandle.transition(
+                    session, job_id, [MeltJobState.COALESCED], MeltJobState.FINISHED)
+                session.commit()
+                return
+            self.logger.warning('Job id=%s: cannot reuse result, encoding: %s',
+                                job_id, future.exception())
+            requeued = MeltJobHandle.transition(
+                session, job_id, [MeltJobState.COALESCED], MeltJobState.ACCEPTED,
+                coalescedWith=None)
+            session.commit()
+            if requeued:
+                self._dispatch(session.get(MeltJobHandle, job_id), session)
+                session.commit()
+                self._notify_jobs_available()
+
+    def _on_result_ready(self, job_handle, session):
+        if job_handle.cacheKey is None or self.result_cache is None:
+            return
+        try:
+            self.result_cache.store(
+                session, job_handle.cacheKey, job_handle.id, job_handle.resultPath)
+        except OSError as e:
+            self.logger.warning('Job id=%s: result not cached: %s', job_handle.id, e)
+        self._resolve_followers(job_handle, session)
+        session.commit()
+
+    def _split_job(self, job_handle, proto, session) -> 'List[MeltJobHandle]':
+        segment_frames = proto.segmentFrames if proto.HasField('segmentFrames') \
+            else Config.segment_frames
+        if segment_frames <= 0 or job_handle.inFrame is not None \
+                or job_handle.outFrame is not None:
+            return []
+        try:
+            frame_count = MltProject.load(job_handle.projectPath).frame_count()
+        except (OSError, ValueError) as e:
+            self.logger.warning(
+                'Job id=%s: cannot split project, encoding as a whole: %s',
+                job_handle.id, e)
+            return []
+        ranges = split_frames(frame_count, segment_frames)
+        if len(ranges) < 2:
+            return []
+        segments = [
+            job_handle.new_segment(
+                segment_path(job_handle.resultPath, index), in_frame, out_frame, session)
+            for index, (in_frame, out_frame) in enumerate(ranges)
+        ]
+        for segment in segments:
+            segment.estimatedCost = estimate_cost(segment, Config.melt_preset_dir)
+        session.flush()
+        self.logger.info('Job id=%s split into %s segments', job_handle.id, len(segments))
+        return segments
+
+    def _dispatch(self, job_handle, session) -> bool:
+        """Send the job to a worker with a free slot or queue it"""
+        if not self.push_dispatch:
+            return False  # Workers pick it up via LeaseJobs
+        while True:
+            worker = self.scheduler.reserve(job_handle, exclude=job_handle.failed_on())
+            if worker is None:
+                self.logger.info('No free slots, job id=%s is pending', job_handle.id)
+                self.scheduler.enqueue(job_handle, exclude=job_handle.failed_on())
+                return False
+            # Commit before sending, the result may arrive before the call returns.
+            # Another replica may have dispatched the job meanwhile
+            previous = job_handle.state, job_handle.worker, job_handle.dispatchedAt
+            if not MeltJobHandle.transition(
+                    session, job_handle.id, [job_handle.state], MeltJobState.IN_PROGRESS,
+                    attempts=MeltJobHandle.attempts + 1, worker=worker,
+                    dispatchedAt=utcnow(), startedAt=None):
+                session.commit()
+                self.scheduler.release(job_handle.id)
+                self.logger.info('Job id=%s is no longer pending', job_handle.id)
+                return False
+            session.commit()
+            outputs = self._bundle(job_handle, session)
+            self.logger.info(f'Dispatching job: {job_handle}, chosen worker: {worker}')
+            worker_client = make_worker_client(
+                endpoint=f'{worker}:50053', secure=True)
+            try:
+                accepted_id = worker_client.PostMeltJob(job_handle.proto_job(outputs))
+            except grpc.RpcError as e:
+                self.scheduler.release(job_handle.id)
+                job_handle.state, job_handle.worker, job_handle.dispatchedAt = previous
+                job_handle.attempts -= 1
+                session.commit()
+                if e.code() == grpc.StatusCode.RESOURCE_EXHAUSTED:
+                    self.logger.info('Worker %s is out of resources: %s', worker, e.details())
+                    self.scheduler.saturate(worker)
+                    continue
+                if e.code() == grpc.StatusCode.UNAVAILABLE:
+                    self.logger.warning(
+                        'Worker %s is unavailable, excluding from scheduling: %s',
+                        worker, e.details())
+                    self.scheduler.remove_worker(worker)
+                    continue
+                self.logger.error(
+                    'Worker %s rejected job id=%s: %s', worker, job_handle.id, e.details())
+                if outputs:
+                    self._unbundle(job_handle, session, failed_on=worker)
+                    session.commit()
+                    continue
+                self._fail_job(job_handle, session)
+                return False
+            assert accepted_id.id == job_handle.id
+            self._record_queue_wait(job_handle)
+            return True
+
+    def _dispatch_pending(self, session):
+        while (job_id := self.scheduler.pop_pending()) is not None:
+            job_handle = session.get(MeltJobHandle, job_id)
+            if job_handle is None or job_handle.state not in \
+                    [MeltJobState.ACCEPTED, MeltJobState.WAITING_RETRY]:
+                continue
+            self._dispatch(job_handle, session)
+        session.commit()
+
+    def _lease_jobs(self, peer_id, max_jobs, response, session):
+        # Concurrent leasers see the same head of the queue, look further
+        # than max_jobs so that losing a claim does not leave a worker idle
+        candidates = self.scheduler.fair_order(
+            MeltJobHandle.leasable(session, max_jobs + self.LEASE_OVERFETCH))
+        for job_id, failed_workers, submitter, *_ in candidates:
+            if len(response.jobs) >= max_jobs:
+                break
+            failed_on = failed_workers.split(',') if failed_workers else []
+            if peer_id in failed_on and self.scheduler.has_workers_besides(failed_on):
+                continue
+            claimed = MeltJobHandle.transition(
+                session, job_id,
+                [MeltJobState.ACCEPTED, MeltJobState.WAITING_RETRY],
+                MeltJobState.IN_PROGRESS,
+                attempts=MeltJobHandle.attempts + 1,
+                leaseOwner=peer_id,
+                leaseDeadline=utcnow() + self.lease_duration,
+                worker=peer_id,
+                dispatchedAt=utcnow(),
+                startedAt=None)
+            session.commit()
+            if not claimed:
+                continue  # Leased concurrently by another worker
+            self.scheduler.claim(job_id, submitter)
+            job_handle = session.get(MeltJobHandle, job_id)
+            self._record_queue_wait(job_handle)
+            response.jobs.append(job_handle.proto_job(self._bundle(job_handle, session)))
+            self.logger.info('Leased job: %s to %s', job_handle, peer_id)
+
+    def _bundle(self, job_handle, session) -> 'List[MeltJobHandle]':
+        """Render pending jobs of the same project and frames with other presets
+        in the melt run of the job, the timeline is decoded and composited once.
+        Returns the jobs bundled with it"""
+        outputs = job_handle.bundled(session)
+        room = Config.max_outputs_per_job - 1 - len(outputs)
+        if room <= 0 or job_handle.speculativeOf is not None or job_handle.failedWorkers:
+            return outputs
+        presets = {job_handle.encodingPresetName} | {o.encodingPresetName for o in outputs}
+        added = list()
+        for candidate in job_handle.bundle_candidates(session, presets, room):
+            if candidate.encodingPresetName in presets:
+                continue
+            # Concurrent dispatches may bundle or start the candidate first
+            if not MeltJobHandle.transition(
+                    session, candidate.id, [MeltJobState.ACCEPTED], MeltJobState.BUNDLED,
+                    bundledWith=job_handle.id):
+                continue
+            presets.add(candidate.encodingPresetName)
+            added.append(candidate)
+            self._record_queue_wait(candidate)
+            if job_handle.estimatedCost is not None and candidate.estimatedCost is not None:
+                job_handle.estimatedCost += candidate.estimatedCost
+        session.commit()
+        if added:
+            self.logger.info('Job id=%s: rendering jobs %s as extra outputs', job_handle.id,
+                             ', '.join(f'id={o.id}' for o in added))
+        return outputs + added
+
+    def _unbundle(self, job_handle, session, failed_on=None):
+        """A failed run does not tell which output broke it, the bundled
+        jobs go back to the queue to run alone"""
+        for output in job_handle.bundled(session):
+            self.logger.warning('Job id=%s: unbundled from job id=%s, encoding alone',
+                                output.id, job_handle.id)
+            output.state = MeltJobState.ACCEPTED
+            output.bundledWith = None
+            if failed_on is not None:
+                output.add_failed_worker(failed_on)
+            if job_handle.estimatedCost is not None and output.estimatedCost is not None:
+                job_handle.estimatedCost -= output.estimatedCost
+            if self.push_dispatch:
+                self.scheduler.enqueue(output, exclude=output.failed_on())
+        self._notify_jobs_available()
+
+    def _expire_leases(self, session):
+        expired = MeltJobHandle.expired_leases(session, utcnow())
+        for job_handle in expired:
+            owner = job_handle.leaseOwner
+            if not job_handle.expire_lease(session):
+                continue  # Renewed, or expired by another replica
+            self.logger.warning('Job id=%s: lease of %s expired', job_handle.id, owner)
+            self._end_attempt(job_handle)
+            self._on_job_failed(job_handle, session)
+        session.commit()
+
+    def _notify_jobs_available(self):
+        if not self.push_dispatch:
+            with self.jobs_available:
+                self.jobs_available.notify_all()
+
+    def _fail_job(self, job_handle, session):
+        job_handle.state = MeltJobState.FAILED
+        self._unbundle(job_handle, session, failed_on=job_handle.worker)
+        parent = job_handle.parent(session)
+        if parent is not None:
+            self.logger.warning(
+                'Segment id=%s failed, failing job id=%s', job_handle.id, parent.id)
+            parent.state = MeltJobState.FAILED
+            self._cancel_siblings(job_handle, parent, session)
+        self._resolve_followers(parent or job_handle, session)
+
+    def _cancel_siblings(self, segment, parent, session):
+        """The failed job is not merged, its other segments and their copies
+        stop in the transaction of the caller"""
+        for sibling in parent.segments(session):
+            for job_handle in [sibling] + sibling.speculative_copies(session):
+                if job_handle.id == segment.id or job_handle.state not in LIVE_STATES:
+                    continue
+                previous = job_handle.state
+                if not MeltJobHandle.transition(
+                        session, job_handle.id, [previous], MeltJobState.CANCELLED):
+                    continue
+                if previous == MeltJobState.IN_PROGRESS and job_handle.worker is not None:
+                    self._cancel_on_worker(job_handle)
+                    self._end_attempt(job_handle)
+                self._unbundle(job_handle, session)
+
+    def _on_job_failed(self, job_handle, session):
+        if job_handle.speculativeOf is not None:
+            job_handle.state = MeltJobState.FAILED
+            original = session.get(MeltJobHandle, job_handle.speculativeOf)
+            if original.state == MeltJobState.IN_PROGRESS and original.worker is None:
+                self.logger.warning('Speculative copy id=%s failed, so does job id=%s',
+                                    job_handle.id, original.id)
+                self._fail_job(original, session)
+        else:
+            self._retry_or_fail(job_handle, session)
+        session.commit()
+        self._notify_jobs_available()
+
+    def _retry_or_fail(self, job_handle, session, backoff=True):
+        self._unbundle(job_handle, session, failed_on=job_handle.worker)
+        if job_handle.worker is not None:
+            job_handle.add_failed_worker(job_handle.worker)
+        if self.retry_policy.should_retry(job_handle):
+            delay = self.retry_policy.delay(job_handle.attempts) if backoff \
+                else datetime.timedelta()
+            self.logger.info(
+                'Job id=%s: attempt %s failed, retrying in %ss avoiding %s',
+                job_handle.id, job_handle.attempts, delay.total_seconds(),
+                job_handle.failedWorkers)
+            job_handle.state = MeltJobState.WAITING_RETRY
+            job_handle.retryAt = utcnow() + delay
+            job_handle.finishedAt = None
+        elif job_handle.live_speculative_copy(session) is not None:
+            self.logger.warning('Job id=%s: out of attempts, waiting for its speculative copy',
+                                job_handle.id)
+            job_handle.worker = None
+        else:
+            self.logger.warning('Job id=%s: failed after %s attempts',
+                                job_handle.id, job_handle.attempts)
+            self._fail_job(job_handle, session)
+
+    def _end_attempt(self, job_handle):
+        self.scheduler.release(job_handle.id)
+        self.progress.pop(job_handle.id, None)
+        self.progress_seen.pop(job_handle.id, None)
+        self.uploading.discard(job_handle.id)
+        job_handle.clear_lease()
+
+    def _check_running(self, session):
+        now = time.monotonic()
+        for job_handle in MeltJobHandle.running(session):
+            if job_handle.worker in self.foreign_workers:
+                continue  # Progress goes to the replica owning the worker
+            last_seen = self.progress_seen.setdefault(job_handle.id, now)
+            if job_handle.startedAt is not None \
+                    and now - last_seen > Config.job_stall_seconds:
+                self.logger.warning('Job id=%s: no progress from %s for %.0fs',
+                                    job_handle.id, job_handle.worker, now - last_seen)
+                self._cancel_on_worker(job_handle)
+                self._end_attempt(job_handle)
+                self._on_job_failed(job_handle, session)
+            else:
+                self._maybe_speculate(job_handle, session)
+        session.commit()
+
+    def _maybe_speculate(self, job_handle, session):
+        """Duplicate a job running much longer than expected onto an idle worker"""
+        if Config.speculation_factor <= 0 or job_handle.speculativeOf is not None \
+                or job_handle.startedAt is None or job_handle.id in self.uploading:
+            return
+        progress = self.progress.get(job_handle.id)
+        if progress is not None and progress.suspended:
+            return  # Slow because an urgent job runs in its place
+        # Over all workers, a slow worker is what speculation is for
+        expected = self.cost_model.expected_seconds(
+            job_handle.encodingPresetName, job_handle.estimatedCost)
+        elapsed = (utcnow() - job_handle.startedAt).total_seconds()
+        if expected is None or elapsed < Config.speculation_factor * expected:
+            return
+        if job_handle.speculative_copies(session) or job_handle.bundled(session):
+            return  # One duplicate per job, of one output
+        if self.push_dispatch:
+            if self.scheduler.idle_worker(exclude=[job_handle.worker]) is None:
+                return
+        elif MeltJobHandle.next_pending(session) is not None:
+            return  # Workers are busy with the queue
+        copy = job_handle.new_speculative_copy(
+            speculative_path(job_handle.resultPath), session)
+        session.commit()
+        self.logger.info(
+            'Job id=%s on %s runs %.0fs, expected %.0fs: started speculative copy id=%s',
+            job_handle.id, job_handle.worker, elapsed, expected, copy.id)
+        self._dispatch(copy, session)
+        session.commit()
+        self._notify_jobs_available()
+
+    def _on_speculation_won(self, copy, session):
+        copy.state = MeltJobState.FINISHED
+        session.commit()
+        original = session.get(MeltJobHandle, copy.speculativeOf)
+        if original.state not in [MeltJobState.ACCEPTED, MeltJobState.IN_PROGRESS,
+                                  MeltJobState.WAITING_RETRY]:
+            self.logger.info('Job id=%s already %s, dropping speculative copy id=%s',
+                             original.id, original.state, copy.id)
+            _remove_quietly(copy.resultPath)
+            return
+        # The original must not write its result any more before it is replaced
+        if original.state == MeltJobState.IN_PROGRESS and original.worker is not None:
+            self._cancel_on_worker(original)
+            self._end_attempt(original)
+            session.commit()
+        session.refresh(original)
+        if original.state in [MeltJobState.VERIFICATION, MeltJobState.FINISHED]:
+            _remove_quietly(copy.resultPath)
+            return
+        os.replace(copy.resultPath, original.resultPath)
+        self.logger.info('Speculative copy id=%s on %s won over job id=%s',
+                         copy.id, copy.worker, original.id)
+        original.worker = copy.worker
+        original.startedAt = copy.startedAt
+        self._on_job_succeeded(original, session)
+
+    def _cancel_speculative_copy(self, job_handle, session):
+        copy = job_handle.live_speculative_copy(session)
+        if copy is None:
+            return
+        self.logger.info('Job id=%s finished first, cancelling speculative copy id=%s',
+                         job_handle.id, copy.id)
+        if copy.state == MeltJobState.IN_PROGRESS:
+            self._cancel_on_worker(copy)
+            self._end_attempt(copy)
+        copy.state = MeltJobState.CANCELLED
+        session.commit()
+        _remove_quietly(copy.resultPath)
+
+    def _cancel_job(self, job_handle, session) -> bool:
+        """Cancel the job, its segments and speculative copies. False if the
+        job changed state concurrently"""
+        previous = job_handle.state
+        if not MeltJobHandle.transition(
+                session, job_handle.id, [previous], MeltJobState.CANCELLED):
+            return False
+        if previous == MeltJobState.IN_PROGRESS and job_handle.worker is not None:
+            self._cancel_on_worker(job_handle)
+            self._end_attempt(job_handle)
+        self._unbundle(job_handle, session)
+        for child in job_handle.segments(session) + job_handle.speculative_copies(session):
+            if child.state in LIVE_STATES:
+                self._cancel_job(child, session)
+        session.commit()
+        # Identical jobs waiting for this one encode on their own
+        for follower in job_handle.followers(session):
+            if MeltJobHandle.transition(
+                    session, follower.id, [MeltJobState.COALESCED], MeltJobState.ACCEPTED,
+                    coalescedWith=None):
+                session.commit()
+                self._dispatch(follower, session)
+        session.commit()
+        return True
+
+    def _cancel_on_worker(self, job_handle) -> bool:
+        worker_client = make_worker_client(
+            endpoint=f'{job_handle.worker}:50053', secure=True)
+        try:
+            worker_client.CancelJob(jobs_pb2.JobId(id=job_handle.id))
+        except grpc.RpcError as e:
+            self.logger.warning('Cannot cancel job id=%s on %s: %s',
+                                job_handle.id, job_handle.worker, e.details())
+            return False
+        return True
+
+    def _on_job_succeeded(self, job_handle, session):
+        if job_handle.speculativeOf is not None:
+            self._on_speculation_won(job_handle, session)
+            return
+        self._cancel_speculative_copy(job_handle, session)
+        # Jobs shorter than the progress interval never report a start
+        started_at = job_handle.startedAt or job_handle.dispatchedAt
+        seconds = (utcnow() - started_at).total_seconds() if started_at is not None else None
+        # Outputs first: if the manager stops in between, the job is still
+        # running and its result is sent again
+        for output in job_handle.bundled(session):
+            if not MeltJobHandle.transition(
+                    session, output.id, [MeltJobState.BUNDLED], MeltJobState.IN_PROGRESS,
+                    worker=job_handle.worker):
+                continue  # Cancelled meanwhile
+            session.commit()
+            self.logger.info('Job id=%s: rendered with job id=%s, result=%s',
+                             output.id, job_handle.id, output.resultPath)
+            if seconds is not None:
+                self._record_throughput(output, seconds)
+            self._on_job_succeeded(output, session)
+        if seconds is not None:
+            self.cost_model.record(
+                job_handle.encodingPresetName, job_handle.worker, job_handle.estimatedCost,
+                seconds)
+            self._record_throughput(job_handle, seconds)
+        job_handle.state = MeltJobState.VERIFICATION
+        session.commit()
+        self.verifier.submit(job_handle, self._on_verification_done)
+
+    def _on_verification_done(self, job_id, future):
+        with Session() as session:
+            verification = future.result() if future.exception() is None \
+                else JobVerification(jobId=job_id, ok=False, error=repr(future.exception()))
+            session.add(verification)
+            session.commit()
+            job_handle = session.get(MeltJobHandle, job_id)
+            if job_handle.state != MeltJobState.VERIFICATION:
+                return  # Cancelled meanwhile
+            if verification.ok:
+                self.logger.info(
+                    'Job id=%s: result verified, %s frames, sha256 %s, probe %.1fs, hash %.1fs',
+                    job_id, verification.frames, verification.checksum,
+                    verification.probeSeconds or 0, verification.checksumSeconds or 0)
+                self._on_verified(job_handle, session)
+                return
+            self.logger.warning('Job id=%s: result verification failed: %s',
+                                job_id, verification.error)
+            if job_handle.segments(session):
+                # Segments are gone after the merge, there is nothing to retry
+                self._fail_job(job_handle, session)
+            else:
+                self._retry_or_fail(job_handle, session)
+            session.commit()
+            self._notify_jobs_available()
+
+    def _on_verified(self, job_handle, session):
+        job_handle.state = MeltJobState.FINISHED
+        session.commit()
+        parent = job_handle.parent(session)
+        if parent is None:
+            self._on_result_ready(job_handle, session)
+            return
+        segments = parent.segments(session)
+        if any(s.state != MeltJobState.FINISHED for s in segments):
+            return
+        # Siblings finishing concurrently race here, only one starts the merge
+        merging = MeltJobHandle.transition(
+            session, parent.id, [MeltJobState.IN_PROGRESS], MeltJobState.MERGING)
+        session.commit()
+        if not merging:
+            return
+        self._merge_segments(parent, session)
+
+    def _merge_segments(self, parent, session):
+        segments = parent.segments(session)
+        future = self.file_pool.submit(
+            SegmentMerger.merge, [s.resultPath for s in segments], parent.resultPath)
+        future.add_done_callback(
+            lambda f, job_id=parent.id: self._on_merge_done(job_id, f))
+
+    def _on_merge_done(self, job_id, future):
+        with Session() as session:
+            job_handle = session.get(MeltJobHandle, job_id)
+            if job_handle.state != MeltJobState.MERGING:
+                return  # Cancelled meanwhile
+            if future.exception() is not None:
+                self.logger.error(
+                    'Job id=%s: merging segments failed: %s', job_id, future.exception())
+                self._fail_job(job_handle, session)
+                session.commit()
+                return
+            self.logger.info('Job id=%s: segments merged into %s',
+                             job_id, future.result())
+            job_handle.state = MeltJobState.VERIFICATION
+            session.commit()
+            self.verifier.submit(job_handle, self._on_verification_done)
+
+
+def _remove_quietly(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _validate_new_job(proto) -> 'Optional[str]':
+    if proto.HasField('id'):
+        return 'Id must not be provided'
+    for field in ['projectPath', 'encodingPresetName', 'resultPath']:
+        if not proto.HasField(field):
+            return f'Missing field: {field}'
+    return None
+
+
+def _tail(data: bytes, limit=512) -> bytes:
+    """Keeps job logs out of the manager log"""
+    return data if len(data) <= limit else b'...' + data[-limit:]
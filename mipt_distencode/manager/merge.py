@@ -0,0 +1,45 @@
+import logging
+import os
+import subprocess
+
+from mipt_distencode.config import Config
+
+
+def segment_path(result_path, index) -> str:
+    root, ext = os.path.splitext(result_path)
+    return f'{root}.part{index:04d}{ext}'
+
+
+def split_frames(frame_count, segment_frames) -> 'List[Tuple[int, int]]':
+    """Split [0, frame_count) into inclusive (in, out) ranges"""
+    return [
+        (start, min(start + segment_frames, frame_count) - 1)
+        for start in range(0, frame_count, segment_frames)
+    ]
+
+
+class SegmentMerger:
+    """Concatenates encoded segments without re-encoding via ffmpeg concat demuxer"""
+    logger = logging.getLogger(__name__)
+
+    @classmethod
+    def build_cmdline(cls, list_path, result_path):
+        return [
+            Config.ffmpeg_path, '-y', '-loglevel', 'error',
+            '-f', 'concat', '-safe', '0', '-i', list_path,
+            '-c', 'copy', result_path
+        ]
+
+    @classmethod
+    def merge(cls, segment_paths, result_path):
+        list_path = f'{os.path.splitext(result_path)[0]}.parts.txt'
+        with open(list_path, 'w') as list_file:
+            for path in segment_paths:
+                escaped = os.path.abspath(path).replace("'", "'\\''")
+                list_file.write(f"file '{escaped}'\n")
+        cmdline = cls.build_cmdline(list_path, result_path)
+        cls.logger.info('Merging %s segments: %s', len(segment_paths), cmdline)
+        subprocess.check_call(cmdline)
+        for path in [*segment_paths, list_path]:
+            os.remove(path)
+        return result_path
@@ -0,0 +1,121 @@
+import datetime
+import hashlib
+import logging
+import os
+import shutil
+import xml.etree.ElementTree as ET
+
+from sqlalchemy import func
+
+from mipt_distencode.manager.db_models import ResultCacheEntry, utcnow
+from mipt_distencode.mlt_project import MltProject
+
+
+def compute_cache_key(job_handle, preset_dir) -> 'Optional[str]':
+    """sha256 of everything melt reads to produce the result, None if unreadable
+
+    Media files are identified by size and mtime, hashing them is too slow"""
+    digest = hashlib.sha256()
+    try:
+        with open(job_handle.projectPath, 'rb') as project_file:
+            project_xml = project_file.read()
+        project = MltProject(ET.fromstring(project_xml), job_handle.projectPath)
+        with open(os.path.join(preset_dir, f'{job_handle.encodingPresetName}.json'),
+                  'rb') as preset_file:
+            preset = preset_file.read()
+        media = [(path, os.stat(path)) for path in project.media_paths()]
+    except (OSError, ET.ParseError, ValueError):
+        return None
+    digest.update(project_xml)
+    digest.update(b'\0preset\0' + preset)
+    for path, stat in media:
+        digest.update(f'\0media\0{path}\0{stat.st_size}\0{stat.st_mtime_ns}'.encode())
+    digest.update(f'\0range\0{job_handle.inFrame}\0{job_handle.outFrame}'.encode())
+    return digest.hexdigest()
+
+
+def materialize(source, destination) -> str:
+    """Make the cached result appear at destination: hard link, copy if impossible"""
+    if os.path.abspath(source) == os.path.abspath(destination):
+        return destination
+    partial = f'{destination}.partial'
+    if os.path.lexists(partial):
+        os.remove(partial)
+    try:
+        os.link(source, partial)
+    except OSError:
+        shutil.copyfile(source, partial)
+    os.replace(partial, destination)
+    return destination
+
+
+class ResultCache:
+    """Content-addressed index of finished results in the manager database
+
+    Results are hard linked into root so that they outlive the client's file,
+    on another filesystem the cache refers to the original result instead"""
+    def __init__(self, root, max_bytes, max_age: datetime.timedelta):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.logger = logging.getLogger(__name__)
+        os.makedirs(root, exist_ok=True)
+
+    def lookup(self, session, cache_key) -> 'Optional[ResultCacheEntry]':
+        entry = session.get(ResultCacheEntry, cache_key)
+        if entry is None:
+            return None
+        if not entry.is_valid():
+            self.logger.info('Dropping stale cache entry: %s', entry)
+            self._remove(session, entry)
+            session.commit()
+            return None
+        entry.lastUsedAt = utcnow()
+        session.commit()
+        return entry
+
+    def store(self, session, cache_key, job_id, result_path):
+        cached_path = os.path.join(
+            self.root, cache_key + os.path.splitext(result_path)[1])
+        try:
+            if os.path.lexists(cached_path):
+                os.remove(cached_path)
+            os.link(result_path, cached_path)
+        except OSError as e:
+            self.logger.info('Cannot link %s into the cache, referring to it: %s',
+                             result_path, e)
+            cached_path = result_path
+        stat = os.stat(cached_path)
+        now = utcnow()
+        session.merge(ResultCacheEntry(
+            key=cache_key, path=cached_path, size=stat.st_size, mtime=stat.st_mtime,
+            jobId=job_id, createdAt=now, lastUsedAt=now))
+        session.commit()
+        self.logger.info('Job id=%s: result cached, key=%s', job_id, cache_key)
+        self.evict(session)
+
+    def evict(self, session):
+        """Drops entries unused for max_age, then least recently used over max_bytes"""
+        expired = session.query(ResultCacheEntry) \
+            .filter(ResultCacheEntry.lastUsedAt < utcnow() - self.max_age) \
+            .all()
+        for entry in expired:
+            self._remove(session, entry)
+        total = session.query(func.coalesce(func.sum(ResultCacheEntry.size), 0)).scalar()
+        if total > self.max_bytes:
+            for entry in session.query(ResultCacheEntry) \
+                    .order_by(ResultCacheEntry.lastUsedAt):
+                if total <= self.max_bytes:
+                    break
+                total -= entry.size
+                self._remove(session, entry)
+        session.commit()
+
+    def _remove(self, session, entry):
+        self.logger.info('Evicting cache entry: %s', entry)
+        if os.path.dirname(os.path.abspath(entry.path)) == os.path.abspath(self.root):
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+        session.delete(entry)
@@ -0,0 +1,54 @@
+import os
+import threading
+
+
+class ResultUploadStore:
+    """Results streamed by workers that do not mount the result storage
+
+    Chunks are appended to a partial file next to the result, named after the
+    uploading worker: an interrupted upload resumes at its size and a job
+    reassigned to another worker does not continue a foreign file"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Partial files being written, one stream per file at a time
+        self.active = set()
+
+    @staticmethod
+    def partial_path(result_path, worker) -> str:
+        return f'{result_path}.{worker}.upload'
+
+    def offset(self, result_path, worker) -> int:
+        try:
+            return os.path.getsize(self.partial_path(result_path, worker))
+        except FileNotFoundError:
+            return 0
+
+    def write(self, result_path, worker, total_size, chunks) -> 'Tuple[int, bool]':
+        """Append (offset, data) chunks, returns the stored size and whether the
+        file is complete. Raises ValueError on a gap or overrun, RuntimeError if
+        another stream writes the file"""
+        partial = self.partial_path(result_path, worker)
+        with self.lock:
+            if partial in self.active:
+                raise RuntimeError(f'{partial} is being uploaded')
+            self.active.add(partial)
+        try:
+            size = self.offset(result_path, worker)
+            with open(partial, 'ab') as partial_file:
+                for offset, data in chunks:
+                    if offset != size:
+                        raise ValueError(f'Expected chunk at offset {size}, got {offset}')
+                    if size + len(data) > total_size:
+                        raise ValueError(f'Chunk at {offset} overruns {total_size} bytes')
+                    partial_file.write(data)
+                    # What a resumed upload skips must be on disk, not in a buffer
+                    partial_file.flush()
+                    size += len(data)
+                if size < total_size:
+                    return size, False
+                os.fsync(partial_file.fileno())
+            os.replace(partial, result_path)
+            return size, True
+        finally:
+            with self.lock:
+                self.active.discard(partial)
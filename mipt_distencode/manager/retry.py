@@ -0,0 +1,29 @@
+import datetime
+import os
+
+from mipt_distencode.config import Config
+
+
+def speculative_path(result_path) -> str:
+    root, ext = os.path.splitext(result_path)
+    return f'{root}.spec{ext}'
+
+
+class RetryPolicy:
+    """Attempt limit and exponential backoff between attempts"""
+    def __init__(self, max_attempts, backoff_seconds, backoff_max_seconds):
+        self.max_attempts = max_attempts
+        self.backoff_seconds = backoff_seconds
+        self.backoff_max_seconds = backoff_max_seconds
+
+    @classmethod
+    def from_config(cls) -> 'RetryPolicy':
+        return cls(Config.job_max_attempts, Config.retry_backoff_seconds,
+                   Config.retry_backoff_max_seconds)
+
+    def should_retry(self, job_handle) -> bool:
+        return job_handle.attempts < self.max_attempts
+
+    def delay(self, attempts) -> datetime.timedelta:
+        seconds = self.backoff_seconds * 2 ** max(attempts - 1, 0)
+        return datetime.timedelta(seconds=min(seconds, self.backoff_max_seconds))
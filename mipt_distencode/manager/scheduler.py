@@ -0,0 +1,301 @@
+import collections
+import logging
+import threading
+
+from mipt_distencode.config import Config
+from mipt_distencode.jobs_pb2 import BULK, URGENT
+from mipt_distencode.manager.fair_share import FairShare, FairShareQueue
+
+
+class WorkerSlots:
+    def __init__(self, hostname, slots):
+        self.hostname = hostname
+        self.slots = slots
+        self.inflight = set()
+        # In-flight bulk jobs, workers suspend them to run urgent ones
+        self.bulk = set()
+        # Set when the worker ran out of resources before slots
+        self.saturated_at = None
+        # Smoothed encode speed reported in job progress, 0 if unknown
+        self.fps = 0.0
+        # In-flight job id -> expected seconds, kept by MakespanPolicy
+        self.backlog = dict()
+
+    def __repr__(self):
+        return f'WorkerSlots({self.hostname}, {len(self.inflight)}/{self.slots})'
+
+    @property
+    def free(self) -> int:
+        limit = self.slots if self.saturated_at is None else self.saturated_at
+        return max(limit - len(self.inflight), 0)
+
+    def free_for(self, priority, preempt_bulk=False) -> int:
+        if priority != URGENT or not preempt_bulk:
+            return self.free
+        limit = self.slots if self.saturated_at is None else self.saturated_at
+        return max(limit + len(self.bulk) - len(self.inflight), 0)
+
+    @property
+    def load(self) -> float:
+        return len(self.inflight) / self.slots
+
+
+class SchedulingPolicy:
+    name = None
+
+    def __init__(self, cost_model=None):
+        self.cost_model = cost_model
+
+    def choose(self, candidates, job_handle) -> WorkerSlots:
+        raise NotImplementedError
+
+    def assigned(self, worker, job_handle):
+        pass
+
+
+class LeastLoadedPolicy(SchedulingPolicy):
+    """Spread jobs evenly, prefer workers with the lowest slot utilization,
+    then faster ones"""
+    name = 'least-loaded'
+
+    def choose(self, candidates, job_handle) -> WorkerSlots:
+        return min(candidates, key=lambda w: (w.load, -w.free, -w.fps, w.hostname))
+
+
+class BinPackingPolicy(SchedulingPolicy):
+    """Fill busy workers up first, keeping the rest idle for big jobs"""
+    name = 'bin-packing'
+
+    def choose(self, candidates, job_handle) -> WorkerSlots:
+        return min(candidates, key=lambda w: (w.free, w.hostname))
+
+
+class MediaAffinityPolicy(LeastLoadedPolicy):
+    """Prefer the worker that already processed the same project"""
+    name = 'affinity'
+    MAX_REMEMBERED = 4096
+
+    def __init__(self, cost_model=None):
+        super().__init__(cost_model)
+        self.last_worker = collections.OrderedDict()
+
+    def choose(self, candidates, job_handle) -> WorkerSlots:
+        hostname = self.last_worker.get(job_handle.projectPath)
+        for worker in candidates:
+            if worker.hostname == hostname:
+                return worker
+        return super().choose(candidates, job_handle)
+
+    def assigned(self, worker, job_handle):
+        self.last_worker[job_handle.projectPath] = worker.hostname
+        self.last_worker.move_to_end(job_handle.projectPath)
+        if len(self.last_worker) > self.MAX_REMEMBERED:
+            self.last_worker.popitem(last=False)
+
+
+class MakespanPolicy(SchedulingPolicy):
+    """Earliest expected completion: work queued on the worker per slot plus
+    the job's expected time there, calibrated per worker by the cost model"""
+    name = 'makespan'
+
+    def choose(self, candidates, job_handle) -> WorkerSlots:
+        return min(candidates, key=lambda w: (self._finish_in(w, job_handle), w.hostname))
+
+    def assigned(self, worker, job_handle):
+        worker.backlog[job_handle.id] = self._seconds(worker, job_handle)
+
+    def _finish_in(self, worker, job_handle) -> float:
+        return sum(worker.backlog.values()) / worker.slots + self._seconds(worker, job_handle)
+
+    def _seconds(self, worker, job_handle) -> float:
+        cost = job_handle.estimatedCost or 0.0
+        expected = None
+        if self.cost_model is not None:
+            expected = self.cost_model.expected_seconds(
+                job_handle.encodingPresetName, cost, worker.hostname)
+        # Before calibration cost units still rank jobs and workers
+        return expected if expected is not None else cost
+
+
+POLICIES = {
+    policy.name: policy
+    for policy in [LeastLoadedPolicy, BinPackingPolicy, MediaAffinityPolicy, MakespanPolicy]
+}
+
+
+class Scheduler:
+    """Tracks worker slots and in-flight jobs, queues jobs when all slots are taken
+
+    Pending jobs are served by priority, then by fair share of their submitters.
+    Thread-safe, all methods hold the scheduler lock
+    """
+    def __init__(self, policy, fair_share=None, preempt_bulk=False):
+        self.policy = policy
+        self.fair_share = fair_share or FairShare({}, {})
+        # Urgent jobs may take the slots of bulk jobs, the worker suspends them
+        self.preempt_bulk = preempt_bulk
+        self.workers = dict()
+        self.assignments = dict()
+        # In-flight job id -> its attempt holding the slot
+        self.attempts = dict()
+        self.pending = FairShareQueue(self.fair_share)
+        # Pending job id -> workers to avoid, as given to reserve
+        self.pending_exclude = dict()
+        self.lock = threading.Lock()
+        self.logger = logging.getLogger(__name__)
+
+    @classmethod
+    def from_config(cls, policy_name, cost_model=None) -> 'Scheduler':
+        if policy_name not in POLICIES:
+            raise ValueError(f'Unknown scheduler policy: {policy_name}')
+        return cls(POLICIES[policy_name](cost_model), FairShare.from_config(),
+                   Config.preempt_bulk_jobs)
+
+    def add_worker(self, hostname, slots):
+        with self.lock:
+            worker = self.workers.get(hostname)
+            if worker is None:
+                self.workers[hostname] = WorkerSlots(hostname, max(slots, 1))
+            else:
+                worker.slots = max(slots, 1)
+
+    def has_worker(self, hostname) -> bool:
+        with self.lock:
+            return hostname in self.workers
+
+    def remove_worker(self, hostname) -> 'Set[int]':
+        """Returns ids of jobs that were in flight on the worker"""
+        with self.lock:
+            worker = self.workers.pop(hostname, None)
+            if worker is None:
+                return set()
+            for job_id in worker.inflight:
+                del self.assignments[job_id]
+                self.attempts.pop(job_id, None)
+            return worker.inflight
+
+    def reserve(self, job_handle, exclude=()) -> 'Optional[str]':
+        """Take a slot for the job, returns None if no worker has one
+
+        Excluded workers are used only if there are no other workers at all,
+        None also if the submitter has its in-flight limit of jobs"""
+        with self.lock:
+            if not self.fair_share.can_start(job_handle.submitter):
+                return None
+            candidates = self._candidates(job_handle.priority, exclude)
+            if not candidates:
+                return None
+            worker = self.policy.choose(candidates, job_handle)
+            worker.inflight.add(job_handle.id)
+            if job_handle.priority == BULK:
+                worker.bulk.add(job_handle.id)
+            self.assignments[job_handle.id] = worker.hostname
+            self.attempts[job_handle.id] = job_handle.attempts + 1
+            self.policy.assigned(worker, job_handle)
+            self.fair_share.started(job_handle.id, job_handle.submitter)
+            return worker.hostname
+
+    def _candidates(self, priority, exclude) -> 'List[WorkerSlots]':
+        allowed = [w for w in self.workers.values() if w.hostname not in exclude] \
+            or self.workers.values()
+        return [w for w in allowed if w.free_for(priority, self.preempt_bulk) > 0]
+
+    def adopt(self, hostname, job_handle):
+        """Account for a job found running on the worker, even beyond its slots"""
+        with self.lock:
+            worker = self.workers.get(hostname)
+            if worker is None or self.assignments.get(job_handle.id) == hostname:
+                return
+            worker.inflight.add(job_handle.id)
+            if job_handle.priority == BULK:
+                worker.bulk.add(job_handle.id)
+            self.assignments[job_handle.id] = hostname
+            self.attempts[job_handle.id] = job_handle.attempts
+            self.fair_share.started(job_handle.id, job_handle.submitter)
+
+    def claim(self, job_id, submitter):
+        """Pull mode: account for a job leased by a worker"""
+        with self.lock:
+            self.fair_share.started(job_id, submitter)
+
+    def fair_order(self, candidates) -> list:
+        """Pull mode: candidate rows in the order pending jobs would be served"""
+        with self.lock:
+            return self.fair_share.order(candidates)
+
+    def idle_worker(self, exclude=()) -> 'Optional[str]':
+        with self.lock:
+            for worker in self.workers.values():
+                if not worker.inflight and worker.free > 0 \
+                        and worker.hostname not in exclude:
+                    return worker.hostname
+            return None
+
+    def has_workers_besides(self, exclude) -> bool:
+        with self.lock:
+            return any(hostname not in exclude for hostname in self.workers)
+
+    def release(self, job_id):
+        with self.lock:
+            self.fair_share.finished(job_id)
+            hostname = self.assignments.pop(job_id, None)
+            self.attempts.pop(job_id, None)
+            if hostname is not None:
+                worker = self.workers[hostname]
+                worker.inflight.discard(job_id)
+                worker.bulk.discard(job_id)
+                worker.backlog.pop(job_id, None)
+                worker.saturated_at = None
+
+    def record_speed(self, hostname, fps, weight=0.2):
+        with self.lock:
+            worker = self.workers.get(hostname)
+            if worker is None or fps <= 0:
+                return
+            if worker.fps == 0:
+                worker.fps = fps
+            else:
+                worker.fps = (1 - weight) * worker.fps + weight * fps
+
+    def saturate(self, hostname):
+        """Stop sending jobs to the worker until one of its jobs finishes"""
+        with self.lock:
+            worker = self.workers.get(hostname)
+            if worker is not None:
+                worker.saturated_at = len(worker.inflight)
+
+    def inflight_attempts(self) -> 'Dict[int, int]':
+        with self.lock:
+            return dict(self.attempts)
+
+    def free_slots(self) -> int:
+        with self.lock:
+            return sum(worker.free for worker in self.workers.values())
+
+    def usage(self) -> 'Tuple[Dict[str, Tuple[int, int]], int]':
+        """({hostname: (in-flight jobs, slots)}, pending jobs) for metrics"""
+        with self.lock:
+            return {
+                hostname: (len(worker.inflight), worker.slots)
+                for hostname, worker in self.workers.items()
+            }, len(self.pending)
+
+    def enqueue(self, job_handle, exclude=()):
+        with self.lock:
+            self.pending.append(job_handle.id, job_handle.submitter, job_handle.priority,
+                                job_handle.estimatedCost)
+            if exclude:
+                self.pending_exclude[job_handle.id] = tuple(exclude)
+
+    def pop_pending(self) -> 'Optional[int]':
+        """Next pending job id if reserve would find a slot for it, the
+        same workers are excluded and in-flight limits apply"""
+        with self.lock:
+            head = self.pending.peek()
+            if head is None:
+                return None
+            job_id, priority = head
+            if not self._candidates(priority, self.pending_exclude.get(job_id, ())):
+                return None
+            self.pending_exclude.pop(job_id, None)
+            return self.pending.pop()
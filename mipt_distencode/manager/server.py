@@ -2,36 +2,47 @@ import logging
 from concurrent import futures
 
 import grpc
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
 
 
-from mipt_distencode.manager.db_models import Base, Session
+from mipt_distencode.manager.db_models import Session, make_engine, upgrade_schema
 from mipt_distencode.manager.manager_pb2_grpc import add_ManagerServicer_to_server
 from mipt_distencode.manager.manager import ManagerServicer
-from mipt_distencode.pb_common import add_endpoint_to_server
+from mipt_distencode.manager.verify import check_ffprobe
+from mipt_distencode.manager.watch import WatchServer
+from mipt_distencode.metrics import MetricsInterceptor, MetricsServer
+from mipt_distencode.pb_common import SERVER_OPTIONS, add_endpoint_to_server
 from mipt_distencode.config import Config
 
 
 class ManagerServer:
-    def __init__(self, endpoint, secure=False):
-        self.db = create_engine(Config.db)
-        Base.metadata.create_all(self.db)
+    def __init__(self, endpoint, watch_endpoint, secure=False):
+        check_ffprobe()
+        self.db = make_engine(Config.db, pool_size=Config.manager_threads)
+        upgrade_schema(self.db)
         Session.configure(bind=self.db)
-        self.server = grpc.server(futures.ThreadPoolExecutor(max_workers=1))
-        add_ManagerServicer_to_server(
-            ManagerServicer(), self.server)
+        self.server = grpc.server(
+            futures.ThreadPoolExecutor(max_workers=Config.manager_threads),
+            interceptors=[MetricsInterceptor()],
+            options=SERVER_OPTIONS)
+        self.metrics = MetricsServer(Config.metrics_address, Config.manager_metrics_port)
+        self.servicer = ManagerServicer()
+        add_ManagerServicer_to_server(self.servicer, self.server)
         add_endpoint_to_server(self.server, endpoint, secure)
+        self.watch_server = WatchServer(self.servicer, watch_endpoint, secure)
 
     def start(self):
         self.server.start()
+        self.watch_server.start()
+        self.metrics.start()
+        self.servicer.post_start()
 
     def wait_for_termination(self):
         self.server.wait_for_termination()
 
 
 def server_main():
-    manager_server = ManagerServer(f'{Config.identity}:50052', secure=True)
+    manager_server = ManagerServer(
+        f'{Config.identity}:50052', f'{Config.identity}:50054', secure=True)
     manager_server.start()
     try:
         manager_server.wait_for_termination()
@@ -0,0 +1,24 @@
+import logging
+import threading
+
+
+class JobSupervisor(threading.Thread):
+    """Periodically runs the manager's checks of running and retried jobs"""
+    def __init__(self, servicer, interval):
+        super().__init__(name='JobSupervisor', daemon=True)
+        self.servicer = servicer
+        self.interval = interval
+        self.stopping = threading.Event()
+        self.logger = logging.getLogger(__name__)
+
+    def run(self):
+        while not self.stopping.wait(self.interval):
+            try:
+                self.servicer.supervise()
+            except Exception:
+                # Keep supervising, the next round sees fresh state
+                self.logger.exception('Job supervision failed')
+
+    def stop(self):
+        self.stopping.set()
+        self.join()
@@ -0,0 +1,146 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import subprocess
+import time
+from concurrent import futures
+
+from mipt_distencode.config import Config
+from mipt_distencode.manager.cost import analyze_project, job_frames, load_preset
+from mipt_distencode.manager.db_models import JobVerification, utcnow
+
+
+CHECKSUM_CHUNK_BYTES = 2**20
+# Audio priming and padding make the container longer than the video
+DURATION_SLACK_SECONDS = 0.5
+
+
+class VerificationError(Exception):
+    """The result is not what the job should have produced"""
+
+
+class Expectation:
+    """What the result of a job should look like, None where unknown"""
+    def __init__(self, frames=None, frame_rate=None, audio=None):
+        self.frames = frames
+        self.frame_rate = frame_rate
+        self.audio = audio
+
+    @classmethod
+    def of_job(cls, job, preset_dir) -> 'Expectation':
+        stats = analyze_project(job.projectPath)
+        if stats is None:
+            return cls()
+        preset = load_preset(preset_dir, job.encodingPresetName)
+        audio = 'acodec' in preset.get('audio', {}) if preset else None
+        return cls(round(stats.output_frames(job_frames(job), preset)),
+                   stats.output_frame_rate(preset), audio)
+
+
+class ResultTarget:
+    """Fields of the job the check needs, ORM objects stay on their thread"""
+    def __init__(self, job_handle):
+        self.id = job_handle.id
+        self.projectPath = job_handle.projectPath
+        self.encodingPresetName = job_handle.encodingPresetName
+        self.resultPath = job_handle.resultPath
+        self.inFrame = job_handle.inFrame
+        self.outFrame = job_handle.outFrame
+
+
+def check_ffprobe():
+    """Raises RuntimeError unless DISTENC_FFPROBE names an executable"""
+    if shutil.which(Config.ffprobe_path) is None:
+        raise RuntimeError(
+            f'Cannot run {Config.ffprobe_path}, results cannot be verified, set DISTENC_FFPROBE')
+
+
+def probe(path) -> 'Dict':
+    """ffprobe of format and streams with packets counted"""
+    cmdline = [
+        Config.ffprobe_path, '-v', 'error', '-print_format', 'json',
+        '-show_format', '-show_streams', '-count_packets', path
+    ]
+    try:
+        output = subprocess.run(cmdline, capture_output=True, check=True).stdout
+    except OSError as e:
+        raise VerificationError(f'Cannot run ffprobe: {e}')
+    except subprocess.CalledProcessError as e:
+        raise VerificationError('ffprobe failed: {}'.format(
+            e.stderr.decode('utf-8', 'replace').strip()))
+    return json.loads(output)
+
+
+def file_checksum(path) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as result_file:
+        while chunk := result_file.read(CHECKSUM_CHUNK_BYTES):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def check_probe(probed, expectation, frame_tolerance) -> 'Tuple[int, float]':
+    """Video frames and duration of the probed file, raises VerificationError"""
+    streams = probed.get('streams', [])
+    video = [s for s in streams if s.get('codec_type') == 'video']
+    if not video:
+        raise VerificationError('No video stream')
+    if expectation.audio and not any(s.get('codec_type') == 'audio' for s in streams):
+        raise VerificationError('No audio stream')
+    count = video[0].get('nb_frames') or video[0].get('nb_read_packets')
+    frames = int(count) if count else None
+    duration = float(probed.get('format', {}).get('duration', 0))
+    if expectation.frames is None:
+        return frames, duration
+    if frames is None or abs(frames - expectation.frames) > frame_tolerance:
+        raise VerificationError(f'{frames} frames, expected {expectation.frames}')
+    expected_duration = float(expectation.frames / expectation.frame_rate)
+    slack = float(frame_tolerance / expectation.frame_rate) + DURATION_SLACK_SECONDS
+    if abs(duration - expected_duration) > slack:
+        raise VerificationError(
+            f'Duration {duration:.3f}s, expected {expected_duration:.3f}s')
+    return frames, duration
+
+
+class ResultVerifier:
+    """Checks result files on a bounded pool, off the RPC threads
+
+    A check probes the streams, frame count and duration with ffprobe and
+    hashes the file. A result ffprobe cannot be run on fails the check,
+    the manager does not start without a runnable ffprobe"""
+    def __init__(self, threads, preset_dir, frame_tolerance):
+        self.preset_dir = preset_dir
+        self.frame_tolerance = frame_tolerance
+        self.pool = futures.ThreadPoolExecutor(
+            max_workers=threads, thread_name_prefix='verify')
+        self.logger = logging.getLogger(__name__)
+
+    def submit(self, job_handle, callback):
+        """callback(job id, future of JobVerification) runs on the pool"""
+        target = ResultTarget(job_handle)
+        future = self.pool.submit(self.verify, target)
+        future.add_done_callback(lambda f: callback(target.id, f))
+
+    def verify(self, target) -> JobVerification:
+        verification = JobVerification(jobId=target.id, ok=False)
+        try:
+            verification.size = os.stat(target.resultPath).st_size
+            if verification.size == 0:
+                raise VerificationError('Empty result file')
+            expectation = Expectation.of_job(target, self.preset_dir)
+            verification.expectedFrames = expectation.frames
+            started = time.monotonic()
+            probed = probe(target.resultPath)
+            verification.probeSeconds = time.monotonic() - started
+            verification.frames, verification.duration = check_probe(
+                probed, expectation, self.frame_tolerance)
+            started = time.monotonic()
+            verification.checksum = file_checksum(target.resultPath)
+            verification.checksumSeconds = time.monotonic() - started
+            verification.ok = True
+        except (OSError, ValueError, VerificationError) as e:
+            verification.error = str(e)
+        verification.verifiedAt = utcnow()
+        return verification
@@ -0,0 +1,132 @@
+import asyncio
+import logging
+import threading
+from concurrent import futures
+
+import grpc
+
+from mipt_distencode import jobs_pb2
+from mipt_distencode.config import Config
+from mipt_distencode.manager.db_models import LIVE_STATES, MeltJobHandle, MeltJobState, Session
+from mipt_distencode.manager.manager import sees_all_jobs
+from mipt_distencode.metrics import AioMetricsInterceptor
+from mipt_distencode.pb_common import SERVER_OPTIONS, PeerIdentityMixin, add_endpoint_to_server
+
+
+class WatchServicer:
+    """WatchJobs of the manager on a grpc.aio server
+
+    An open stream is a coroutine awaiting a queue that JobEvents feeds from
+    its thread, so idle streams hold no thread. The other calls stay on the
+    thread pool of the manager endpoint"""
+    def __init__(self, servicer):
+        self.servicer = servicer
+        self.job_events = servicer.job_events
+        self.logger = logging.getLogger(__name__)
+
+    def handler(self) -> grpc.GenericRpcHandler:
+        return grpc.method_handlers_generic_handler('mipt_distencode.Manager', {
+            'WatchJobs': grpc.unary_stream_rpc_method_handler(
+                self.WatchJobs,
+                request_deserializer=jobs_pb2.JobWatch.FromString,
+                response_serializer=jobs_pb2.JobStatus.SerializeToString),
+        })
+
+    async def WatchJobs(self, watch, context):
+        auth_ctx = context.auth_context()
+        if auth_ctx.get('security_level') != PeerIdentityMixin.ALLOWED_SECURITY_LEVEL:
+            self.logger.error('Cannot proceed without peer identification')
+            await context.abort(grpc.StatusCode.UNAUTHENTICATED, 'Insufficient security_level')
+        peer_id = auth_ctx['x509_common_name'][0].decode()
+        job_ids = {job_id.id for job_id in watch.ids}
+        submitter = watch.submitter if watch.HasField('submitter') else None
+        if not job_ids and submitter is None:
+            await context.abort(grpc.StatusCode.INVALID_ARGUMENT, 'Set ids or submitter to watch')
+        sees_all = sees_all_jobs(peer_id)
+        if submitter not in [None, peer_id] and not sees_all:
+            await context.abort(grpc.StatusCode.PERMISSION_DENIED,
+                                f'{peer_id} may only watch its own jobs')
+        loop = asyncio.get_running_loop()
+        changes = asyncio.Queue()
+        watcher = self.job_events.subscribe(
+            job_ids, submitter,
+            lambda status: loop.call_soon_threadsafe(changes.put_nowait, status))
+        if watcher is None:
+            await context.abort(grpc.StatusCode.RESOURCE_EXHAUSTED,
+                                f'{Config.max_watchers} watchers already, try again later')
+        # The coroutine is cancelled when the client goes away
+        try:
+            # Read after subscribing, so that no change in between is lost
+            statuses = await loop.run_in_executor(None, self._current_statuses, job_ids)
+            missing = job_ids - {status.id.id for status in statuses}
+            if missing:
+                await context.abort(grpc.StatusCode.NOT_FOUND,
+                                    f'No posted jobs with ids {sorted(missing)}')
+            foreign = sorted(status.id.id for status in statuses
+                             if status.HasField('submitter') and status.submitter != peer_id)
+            if foreign and not sees_all:
+                await context.abort(grpc.StatusCode.PERMISSION_DENIED,
+                                    f'Jobs {foreign} were posted by others')
+            for status in statuses:
+                yield status
+                if self._over(status, job_ids, submitter):
+                    return
+            while (status := await changes.get()) is not None:
+                yield status
+                if self._over(status, job_ids, submitter):
+                    return
+        finally:
+            self.job_events.unsubscribe(watcher)
+
+    def _current_statuses(self, job_ids) -> 'List[jobs_pb2.JobStatus]':
+        with Session() as session:
+            return [
+                self.servicer.job_status(job_handle)
+                for job_handle in MeltJobHandle.submitted_with_ids(session, job_ids)
+            ]
+
+    @staticmethod
+    def _over(status, job_ids, submitter) -> bool:
+        if MeltJobState.from_proto(status.state) not in LIVE_STATES:
+            job_ids.discard(status.id.id)
+        return not job_ids and submitter is None
+
+
+class WatchServer(threading.Thread):
+    """Runs the grpc.aio server of WatchServicer in an event loop of its own"""
+    def __init__(self, servicer, endpoint, secure=False):
+        super().__init__(name='WatchServer', daemon=True)
+        self.servicer = WatchServicer(servicer)
+        self.endpoint = endpoint
+        self.secure = secure
+        self.loop = asyncio.new_event_loop()
+        self.server = None
+        self.started = futures.Future()
+
+    def start(self):
+        """Returns once the endpoint is bound, raises if it cannot be"""
+        super().start()
+        self.started.result()
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self._serve())
+        except Exception as e:
+            if not self.started.done():
+                self.started.set_exception(e)
+            raise
+
+    def stop(self, grace=None):
+        if self.server is not None:
+            asyncio.run_coroutine_threadsafe(self.server.stop(grace), self.loop).result()
+        self.join()
+
+    async def _serve(self):
+        self.server = grpc.aio.server(
+            interceptors=[AioMetricsInterceptor()], options=SERVER_OPTIONS)
+        self.server.add_generic_rpc_handlers([self.servicer.handler()])
+        add_endpoint_to_server(self.server, self.endpoint, self.secure)
+        await self.server.start()
+        self.started.set_result(None)
+        await self.server.wait_for_termination()
@@ -0,0 +1,315 @@
+"""Process metrics in the Prometheus text format, served over plain HTTP
+
+Counters and histograms are updated on hot paths under a lock per metric.
+Gauges of state held elsewhere (the job table, scheduler slots) are functions
+evaluated when the endpoint is scraped, so keeping them costs nothing"""
+import asyncio
+import bisect
+import http.server
+import logging
+import math
+import threading
+import time
+
+import grpc
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()) -> str:
+    pairs = [*zip(names, values), *extra]
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _format_value(value) -> str:
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value))
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.lock = threading.Lock()
+
+    def render(self) -> 'List[str]':
+        return [f'# HELP {self.name} {self.documentation}',
+                f'# TYPE {self.name} {self.type}']
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def __init__(self, name, documentation, label_names=()):
+        super().__init__(name, documentation, label_names)
+        self.values = dict()
+
+    def inc(self, *label_values, amount=1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self) -> 'List[str]':
+        with self.lock:
+            values = sorted(self.values.items())
+        return super().render() + [
+            f'{self.name}{_format_labels(self.label_names, labels)} {_format_value(value)}'
+            for labels, value in values
+        ]
+
+
+class Gauge(Metric):
+    """Either set directly or computed at scrape time by a function returning
+    {label values: value}"""
+    type = 'gauge'
+
+    def __init__(self, name, documentation, label_names=()):
+        super().__init__(name, documentation, label_names)
+        self.values = dict()
+        self.function = None
+
+    def set(self, value, *label_values):
+        with self.lock:
+            self.values[label_values] = value
+
+    def set_function(self, function):
+        self.function = function
+
+    def render(self) -> 'List[str]':
+        if self.function is not None:
+            values = self.function()
+        else:
+            with self.lock:
+                values = dict(self.values)
+        return super().render() + [
+            f'{self.name}{_format_labels(self.label_names, labels)} {_format_value(value)}'
+            for labels, value in sorted(values.items())
+        ]
+
+
+class Histogram(Metric):
+    type = 'histogram'
+    # Seconds, from a cheap RPC to a stuck one
+    LATENCY_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self, name, documentation, label_names=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(sorted(buckets))
+        # Label values -> [count per bucket, the last one +Inf], sum
+        self.values = dict()
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.values.get(label_values)
+            if series is None:
+                series = self.values[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def render(self) -> 'List[str]':
+        with self.lock:
+            values = sorted((labels, (list(counts), total))
+                            for labels, (counts, total) in self.values.items())
+        lines = super().render()
+        for labels, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip((*self.buckets, math.inf), counts):
+                cumulative += count
+                lines.append('{}_bucket{} {}'.format(
+                    self.name,
+                    _format_labels(self.label_names, labels, [('le', _format_value(bound))]),
+                    cumulative))
+            suffix = _format_labels(self.label_names, labels)
+            lines.append(f'{self.name}_sum{suffix} {_format_value(total)}')
+            lines.append(f'{self.name}_count{suffix} {cumulative}')
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = dict()
+        self.lock = threading.Lock()
+        self.logger = logging.getLogger(__name__)
+
+    def register(self, metric) -> Metric:
+        """Returns the metric registered under the name first, so modules
+        imported again or servicers created twice share their metrics"""
+        with self.lock:
+            return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, documentation, label_names=()) -> Counter:
+        return self.register(Counter(name, documentation, label_names))
+
+    def gauge(self, name, documentation, label_names=()) -> Gauge:
+        return self.register(Gauge(name, documentation, label_names))
+
+    def histogram(self, name, documentation, label_names=(),
+                  buckets=Histogram.LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, label_names, buckets))
+
+    def render(self) -> str:
+        with self.lock:
+            metrics = sorted(self.metrics.values(), key=lambda metric: metric.name)
+        lines = list()
+        for metric in metrics:
+            try:
+                lines.extend(metric.render())
+            except Exception:
+                # A broken gauge function must not hide the other metrics
+                self.logger.exception('Cannot collect metric %s', metric.name)
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+RPC_DURATION = REGISTRY.histogram(
+    'distenc_rpc_duration_seconds',
+    'Time gRPC methods take to handle a call, streams until the last message',
+    ['method'])
+RPC_TOTAL = REGISTRY.counter(
+    'distenc_rpc_total', 'Handled gRPC calls by status code', ['method', 'code'])
+
+
+def _status_code(context, error=None) -> str:
+    if isinstance(error, (GeneratorExit, asyncio.CancelledError)):
+        return grpc.StatusCode.CANCELLED.name  # Client went away mid-stream
+    code = context.code()
+    if code is None:
+        code = grpc.StatusCode.OK if error is None else grpc.StatusCode.UNKNOWN
+    return code.name
+
+
+class MetricsInterceptor(grpc.ServerInterceptor):
+    """Records latency and status code of every call. context.abort sets the
+    code before raising, exceptions without one are UNKNOWN like in grpc"""
+    def intercept_service(self, continuation, handler_call_details):
+        handler = continuation(handler_call_details)
+        if handler is None:
+            return None
+        method = handler_call_details.method
+        if handler.unary_unary is not None:
+            return handler._replace(unary_unary=self._unary(method, handler.unary_unary))
+        if handler.stream_unary is not None:
+            return handler._replace(stream_unary=self._unary(method, handler.stream_unary))
+        if handler.unary_stream is not None:
+            return handler._replace(unary_stream=self._stream(method, handler.unary_stream))
+        return handler._replace(stream_stream=self._stream(method, handler.stream_stream))
+
+    @staticmethod
+    def _record(method, started, context, error=None):
+        RPC_DURATION.observe(time.perf_counter() - started, method)
+        RPC_TOTAL.inc(method, _status_code(context, error))
+
+    def _unary(self, method, behavior):
+        def wrapper(request, context):
+            started = time.perf_counter()
+            try:
+                response = behavior(request, context)
+            except BaseException as e:
+                self._record(method, started, context, e)
+                raise
+            self._record(method, started, context)
+            return response
+        return wrapper
+
+    def _stream(self, method, behavior):
+        def wrapper(request, context):
+            started = time.perf_counter()
+            try:
+                yield from behavior(request, context)
+            except BaseException as e:
+                self._record(method, started, context, e)
+                raise
+            self._record(method, started, context)
+        return wrapper
+
+
+class AioMetricsInterceptor(grpc.aio.ServerInterceptor):
+    """MetricsInterceptor of a grpc.aio server, its handlers are coroutines
+    and async generators"""
+    async def intercept_service(self, continuation, handler_call_details):
+        handler = await continuation(handler_call_details)
+        if handler is None:
+            return None
+        method = handler_call_details.method
+        if handler.unary_unary is not None:
+            return handler._replace(unary_unary=self._unary(method, handler.unary_unary))
+        if handler.stream_unary is not None:
+            return handler._replace(stream_unary=self._unary(method, handler.stream_unary))
+        if handler.unary_stream is not None:
+            return handler._replace(unary_stream=self._stream(method, handler.unary_stream))
+        return handler._replace(stream_stream=self._stream(method, handler.stream_stream))
+
+    def _unary(self, method, behavior):
+        async def wrapper(request, context):
+            started = time.perf_counter()
+            try:
+                response = await behavior(request, context)
+            except BaseException as e:
+                MetricsInterceptor._record(method, started, context, e)
+                raise
+            MetricsInterceptor._record(method, started, context)
+            return response
+        return wrapper
+
+    def _stream(self, method, behavior):
+        async def wrapper(request, context):
+            started = time.perf_counter()
+            try:
+                async for response in behavior(request, context):
+                    yield response
+            except BaseException as e:
+                MetricsInterceptor._record(method, started, context, e)
+                raise
+            MetricsInterceptor._record(method, started, context)
+        return wrapper
+
+
+class _MetricsHandler(http.server.BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # Scraped every few seconds, not worth a log line
+
+
+class MetricsServer:
+    """GET /metrics on its own thread, port 0 disables it"""
+    def __init__(self, address, port):
+        self.httpd = None
+        if port:
+            self.httpd = http.server.ThreadingHTTPServer((address, port), _MetricsHandler)
+            self.httpd.daemon_threads = True
+        self.thread = None
+
+    def start(self):
+        if self.httpd is None:
+            return
+        self.thread = threading.Thread(
+            target=self.httpd.serve_forever, name='metrics', daemon=True)
+        self.thread.start()
+        logging.getLogger(__name__).info(
+            'Serving metrics on http://%s:%s/metrics', *self.httpd.server_address[:2])
+
+    def stop(self):
+        if self.httpd is not None:
+            self.httpd.shutdown()
+            self.httpd.server_close()
@@ -0,0 +1,133 @@
+import os
+import re
+import xml.etree.ElementTree as ET
+from fractions import Fraction
+
+
+DEFAULT_FRAME_RATE = Fraction(25)
+
+_CLOCK_RE = re.compile(r'^(?:(\d+):)?(\d+):(\d+(?:\.\d+)?)$')
+_SMPTE_RE = re.compile(r'^(\d+):(\d+):(\d+)[:;](\d+)$')
+
+
+def parse_time(value: str, frame_rate: Fraction) -> int:
+    """Convert MLT time value (frames, clock or SMPTE timecode) to frames"""
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+    match = _SMPTE_RE.match(value)
+    if match:
+        hours, minutes, seconds, frames = map(int, match.groups())
+        return round((hours * 3600 + minutes * 60 + seconds) * frame_rate) + frames
+    match = _CLOCK_RE.match(value)
+    if match:
+        hours, minutes, seconds = match.groups()
+        total = int(hours or 0) * 3600 + int(minutes) * 60 + Fraction(seconds)
+        return round(total * frame_rate)
+    raise ValueError(f'Unsupported MLT time value: {value}')
+
+
+class MltProject:
+    """Read-only view of an MLT XML project"""
+    TOPLEVEL_SERVICES = ('producer', 'playlist', 'tractor')
+    MEDIA_SERVICES = ('producer', 'chain')
+
+    def __init__(self, root: ET.Element, path=None):
+        self.root = root
+        self.path = path
+        self.frame_rate = self._parse_frame_rate()
+
+    @classmethod
+    def load(cls, path) -> 'MltProject':
+        return cls(ET.parse(path).getroot(), path)
+
+    def media_paths(self) -> 'List[str]':
+        """Absolute paths of existing files referenced as producer resources"""
+        return sorted({path for _, path in self._media_properties()})
+
+    def relocate_media(self, local_paths: 'Dict[str, str]'):
+        """Point producers at local copies, other relative paths keep resolving
+        against the original location wherever the project is saved"""
+        base = self._base_dir()
+        if base is not None:
+            self.root.set('root', base)
+        for prop, path in self._media_properties():
+            if path in local_paths:
+                prop.text = local_paths[path]
+
+    def save(self, path):
+        ET.ElementTree(self.root).write(path, encoding='utf-8', xml_declaration=True)
+
+    def main_service(self) -> ET.Element:
+        """Last top-level service not retained for bookkeeping only, as melt does"""
+        candidates = [
+            elem for elem in self.root
+            if elem.tag in self.TOPLEVEL_SERVICES and not self._is_retained(elem)
+        ]
+        if not candidates:
+            raise ValueError('Project has no top-level producer')
+        return candidates[-1]
+
+    def frame_count(self) -> int:
+        service = self.main_service()
+        if service.get('out') is not None:
+            in_frame = parse_time(service.get('in', '0'), self.frame_rate)
+            out_frame = parse_time(service.get('out'), self.frame_rate)
+            return out_frame - in_frame + 1
+        length = self._property(service, 'length')
+        if length is not None:
+            return parse_time(length, self.frame_rate)
+        raise ValueError(f'Cannot determine length of {service.tag} {service.get("id")}')
+
+    def resolution(self) -> 'Optional[Tuple[int, int]]':
+        profile = self.root.find('profile')
+        if profile is None or not profile.get('width') or not profile.get('height'):
+            return None
+        return int(profile.get('width')), int(profile.get('height'))
+
+    def track_count(self) -> int:
+        """Tracks of all tractors and multitracks, 1 for a plain producer"""
+        return max(len(self.root.findall('.//track')), 1)
+
+    def filter_count(self) -> int:
+        """Filters and transitions, each one is work on every frame it covers"""
+        return sum(1 for _ in self.root.iter('filter')) \
+            + sum(1 for _ in self.root.iter('transition'))
+
+    def _parse_frame_rate(self) -> Fraction:
+        profile = self.root.find('profile')
+        if profile is None or profile.get('frame_rate_num') is None:
+            return DEFAULT_FRAME_RATE
+        return Fraction(
+            int(profile.get('frame_rate_num')),
+            int(profile.get('frame_rate_den', '1')))
+
+    def _base_dir(self) -> 'Optional[str]':
+        base = self.root.get('root')
+        if base is None and self.path is not None:
+            base = os.path.dirname(os.path.abspath(self.path))
+        return base
+
+    def _media_properties(self):
+        """Yields (resource property element, absolute path) of existing files"""
+        base = self._base_dir()
+        for tag in self.MEDIA_SERVICES:
+            for elem in self.root.iter(tag):
+                for prop in elem.findall('property'):
+                    if prop.get('name') != 'resource' or not prop.text \
+                            or prop.text.startswith('<'):
+                        continue
+                    path = os.path.join(base or '', prop.text)
+                    if os.path.isfile(path):
+                        yield prop, os.path.abspath(path)
+
+    @staticmethod
+    def _property(elem, name):
+        for prop in elem.findall('property'):
+            if prop.get('name') == name:
+                return prop.text
+        return None
+
+    @classmethod
+    def _is_retained(cls, elem) -> bool:
+        return cls._property(elem, 'xml_retain') == '1'
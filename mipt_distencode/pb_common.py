@@ -1,4 +1,6 @@
+import functools
 import logging
+import threading
 
 import grpc
 
@@ -9,6 +11,17 @@ ROOT_CERTCHAIN_PATH = 'config/ca.pem'
 PRIVKEY_PATH = f'config/{Config.identity}-private.pem'
 CERTCHAIN_PATH = f'config/{Config.identity}-cert.pem'
 
+CHANNEL_OPTIONS = [
+    ('grpc.keepalive_time_ms', 30000),
+    ('grpc.keepalive_timeout_ms', 10000),
+    ('grpc.keepalive_permit_without_calls', 1),
+    ('grpc.http2.max_pings_without_data', 0),
+]
+SERVER_OPTIONS = [
+    ('grpc.keepalive_permit_without_calls', 1),
+    ('grpc.http2.min_ping_interval_without_data_ms', 20000),
+]
+
 
 def _load_pems():
     logging.debug('Loading CA PEM: %s', ROOT_CERTCHAIN_PATH)
@@ -23,6 +36,7 @@ def _load_pems():
     return ca, private, cert
 
 
+@functools.lru_cache(maxsize=None)
 def load_channel_creds() -> grpc.ChannelCredentials:
     ca, private, cert = _load_pems()
     return grpc.ssl_channel_credentials(
@@ -39,13 +53,43 @@ def load_server_creds() -> grpc.ServerCredentials:
         require_client_auth=True)
 
 
-def make_channel(endpoint, secure=False, creds=None) -> grpc.Channel:
+def make_channel(endpoint, secure=False, creds=None, options=CHANNEL_OPTIONS) -> grpc.Channel:
     if secure:
         if creds is None:
             creds = load_channel_creds()
-        return grpc.secure_channel(endpoint, creds)
+        return grpc.secure_channel(endpoint, creds, options=options)
     else:
-        return grpc.insecure_channel(endpoint)
+        return grpc.insecure_channel(endpoint, options=options)
+
+
+class ChannelPool:
+    """Long-lived channels keyed by endpoint
+
+    Channels are never closed by the pool: one without calls for idle_seconds
+    drops its connection by itself and reconnects on the next call. gRPC
+    counts the calls, so a long stream keeps its connection"""
+    def __init__(self, idle_seconds):
+        self.options = CHANNEL_OPTIONS + [
+            ('grpc.client_idle_timeout_ms', int(idle_seconds * 1000))]
+        self.channels = dict()
+        self.lock = threading.Lock()
+
+    def get(self, endpoint, secure=False) -> grpc.Channel:
+        with self.lock:
+            key = (endpoint, secure)
+            if key not in self.channels:
+                logging.debug('Opening pooled channel: %s', endpoint)
+                self.channels[key] = make_channel(endpoint, secure, options=self.options)
+            return self.channels[key]
+
+    def close(self):
+        with self.lock:
+            for channel in self.channels.values():
+                channel.close()
+            self.channels.clear()
+
+
+channel_pool = ChannelPool(Config.channel_idle_seconds)
 
 
 def add_endpoint_to_server(server, endpoint, secure=False, creds=None):
@@ -6,14 +6,14 @@ from google.protobuf.text_format import MessageToString
 
 from mipt_distencode.worker.worker_pb2_grpc import WorkerStub
 from mipt_distencode import jobs_pb2, mgmt_messages_pb2
-from mipt_distencode.pb_common import make_channel
+from mipt_distencode.pb_common import channel_pool, make_channel
 
 
 def make_client(channel=None, **kwargs) -> WorkerStub:
     if channel and kwargs:
         raise ValueError('Specify either channel or construction kwargs')
     if channel is None:
-        channel = make_channel(**kwargs)
+        channel = channel_pool.get(**kwargs)
     return WorkerStub(channel)
 
 
@@ -30,6 +30,13 @@ def client_main(argv):
             encodingPresetName=encodingPresetName,
             resultPath=resultPath)
         response = client.PostMeltJob(job)
+    elif command == 'WatchJob':
+        jobId, = args
+        for response in client.WatchJob(jobs_pb2.JobId(id=int(jobId))):
+            print('Progress:', MessageToString(response, as_one_line=True))
+    elif command == 'CancelJob':
+        jobId, = args
+        response = client.CancelJob(jobs_pb2.JobId(id=int(jobId)))
     else:
         raise ValueError('Unknown command:', command)
     print('Response:', MessageToString(response, as_one_line=True))
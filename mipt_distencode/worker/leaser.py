@@ -0,0 +1,69 @@
+import logging
+import threading
+import time
+
+import grpc
+
+from mipt_distencode.config import Config
+from mipt_distencode.jobs_pb2 import JobId, LeaseRenewal, LeaseRequest
+from mipt_distencode.manager.client import make_replica_client
+
+
+class JobLeaser(threading.Thread):
+    """Pull mode: long-polls the manager for jobs while the worker has free slots"""
+    def __init__(self, servicer):
+        super().__init__(name='JobLeaser', daemon=True)
+        self.servicer = servicer
+        self.lease_seconds = Config.lease_seconds
+        self.stopping = threading.Event()
+        self.wakeup = threading.Event()
+        self.logger = logging.getLogger(__name__)
+        self.logger.setLevel(logging.DEBUG)
+
+    def run(self):
+        renew_at = time.monotonic()
+        while not self.stopping.is_set():
+            client = make_replica_client()
+            try:
+                if time.monotonic() >= renew_at:
+                    self._renew(client)
+                    renew_at = time.monotonic() + self.lease_seconds / 3
+                if self._lease(client):
+                    continue  # Already waited in the long poll
+            except grpc.RpcError as e:
+                self.logger.warning('Leasing failed: %s %s', e.code(), e.details())
+            self.wakeup.wait(Config.lease_poll_seconds)
+            self.wakeup.clear()
+
+    def wake(self):
+        """Called when a slot frees up"""
+        self.wakeup.set()
+
+    def stop(self):
+        self.stopping.set()
+        self.wakeup.set()
+        self.join()
+
+    def _lease(self, client) -> bool:
+        free = self.servicer.free_slots()
+        if free <= 0:
+            return False
+        # Wake up in time to renew leases of running jobs
+        wait_seconds = max(1, int(min(Config.lease_wait_seconds, self.lease_seconds / 3)))
+        response = client.LeaseJobs(
+            LeaseRequest(hostname=Config.identity, maxJobs=free, waitSeconds=wait_seconds),
+            timeout=wait_seconds + 10)
+        self.lease_seconds = response.leaseSeconds
+        for job in response.jobs:
+            self.servicer.accept_leased(job)
+        return True
+
+    def _renew(self, client):
+        running = self.servicer.running_job_ids()
+        if not running:
+            return
+        renewal = LeaseRenewal(
+            hostname=Config.identity, ids=[JobId(id=job_id) for job_id in running])
+        renewed = {job_id.id for job_id in client.RenewLeases(renewal).ids}
+        for job_id in set(running) - renewed:
+            self.logger.warning('Lost lease on job id=%s', job_id)
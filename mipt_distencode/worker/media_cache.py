@@ -0,0 +1,193 @@
+import collections
+import hashlib
+import logging
+import os
+import shutil
+import threading
+from concurrent import futures
+
+from mipt_distencode.mlt_project import MltProject
+
+
+class MediaCacheStats:
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        self.bytes_fetched = 0
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def __str__(self):
+        return 'hit rate {:.0%} ({} hits, {} misses), {} MiB saved, {} MiB fetched'.format(
+            self.hit_rate, self.hits, self.misses,
+            self.bytes_saved // 2**20, self.bytes_fetched // 2**20)
+
+
+class MediaCache:
+    """Local LRU copies of source media, keyed by path, size and mtime
+
+    Media of accepted jobs is copied in the background while earlier jobs
+    encode, melt then reads a project rewritten to point at the copies"""
+    PROJECTS_DIR = 'projects'
+
+    def __init__(self, root, max_bytes, prefetch_threads):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.pool = futures.ThreadPoolExecutor(
+            max_workers=prefetch_threads, thread_name_prefix='prefetch')
+        self.lock = threading.Lock()
+        # Cached file name -> size, least recently used first
+        self.entries = collections.OrderedDict()
+        self.fetching = dict()
+        # Cached file name -> number of jobs using it, never evicted while used
+        self.pinned = collections.Counter()
+        # Job id -> {source path: future of the local path}
+        self.jobs = dict()
+        self.stats = MediaCacheStats()
+        self.logger = logging.getLogger(__name__)
+        os.makedirs(os.path.join(root, self.PROJECTS_DIR), exist_ok=True)
+        self._scan()
+
+    def prefetch(self, job):
+        """Start copying media of the job, no-op if already started"""
+        with self.lock:
+            if job.id.id in self.jobs:
+                return
+            self.jobs[job.id.id] = dict()
+        try:
+            paths = MltProject.load(job.projectPath).media_paths()
+        except Exception as e:
+            # melt reports a broken project better than we can
+            self.logger.warning('Job id=%s: cannot prefetch media: %s', job.id.id, e)
+            return
+        for path in paths:
+            try:
+                future = self._fetch(path)
+            except OSError as e:
+                self.logger.warning('Job id=%s: cannot stat %s: %s', job.id.id, path, e)
+                continue
+            with self.lock:
+                self.jobs[job.id.id][path] = future
+
+    def localize(self, job) -> str:
+        """Waits for the job's media, returns the path of the rewritten project"""
+        self.prefetch(job)
+        with self.lock:
+            fetches = dict(self.jobs.get(job.id.id, {}))
+        local_paths = dict()
+        for path, future in fetches.items():
+            try:
+                local_paths[path] = future.result()
+            except OSError as e:
+                self.logger.warning(
+                    'Job id=%s: reading %s from the share, copy failed: %s',
+                    job.id.id, path, e)
+        if not local_paths:
+            return job.projectPath
+        project = MltProject.load(job.projectPath)
+        project.relocate_media(local_paths)
+        project_path = self._project_path(job.id.id)
+        project.save(project_path)
+        return project_path
+
+    def release(self, job_id):
+        with self.lock:
+            fetches = self.jobs.pop(job_id, {})
+        for future in fetches.values():
+            future.add_done_callback(self._unpin)
+        try:
+            os.remove(self._project_path(job_id))
+        except FileNotFoundError:
+            pass
+        self.logger.info('Job id=%s: media cache %s', job_id, self.stats)
+
+    def _fetch(self, path) -> futures.Future:
+        stat = os.stat(path)
+        name = self._cache_name(path, stat)
+        with self.lock:
+            self.pinned[name] += 1
+            if name in self.entries:
+                self.entries.move_to_end(name)
+                self.stats.hits += 1
+                self.stats.bytes_saved += stat.st_size
+                future = futures.Future()
+                future.set_result(os.path.join(self.root, name))
+                future.cache_name = name
+                return future
+            if name in self.fetching:
+                self.stats.hits += 1
+                self.stats.bytes_saved += stat.st_size
+                return self.fetching[name]
+            self.stats.misses += 1
+            future = self.pool.submit(self._copy, path, name)
+            future.cache_name = name
+            self.fetching[name] = future
+            return future
+
+    def _copy(self, path, name) -> str:
+        local_path = os.path.join(self.root, name)
+        partial = f'{local_path}.partial'
+        try:
+            shutil.copyfile(path, partial)
+            os.replace(partial, local_path)
+        except OSError:
+            with self.lock:
+                del self.fetching[name]
+            raise
+        size = os.path.getsize(local_path)
+        with self.lock:
+            del self.fetching[name]
+            self.entries[name] = size
+            self.stats.bytes_fetched += size
+            self._evict()
+        self.logger.debug('Cached %s as %s', path, name)
+        return local_path
+
+    def _unpin(self, future):
+        with self.lock:
+            self.pinned[future.cache_name] -= 1
+            if self.pinned[future.cache_name] <= 0:
+                del self.pinned[future.cache_name]
+            self._evict()
+
+    def _evict(self):
+        """Drops least recently used unpinned copies over max_bytes, holds the lock"""
+        total = sum(self.entries.values())
+        for name in list(self.entries):
+            if total <= self.max_bytes:
+                break
+            if name in self.pinned:
+                continue
+            total -= self.entries.pop(name)
+            try:
+                os.remove(os.path.join(self.root, name))
+            except FileNotFoundError:
+                pass
+
+    def _scan(self):
+        """Picks up copies left by a previous run, oldest access first"""
+        found = list()
+        for entry in os.scandir(self.root):
+            if not entry.is_file():
+                continue
+            if entry.name.endswith('.partial'):
+                os.remove(entry.path)
+                continue
+            stat = entry.stat()
+            found.append((stat.st_atime, entry.name, stat.st_size))
+        for _, name, size in sorted(found):
+            self.entries[name] = size
+        with self.lock:
+            self._evict()
+
+    def _project_path(self, job_id) -> str:
+        return os.path.join(self.root, self.PROJECTS_DIR, f'job-{job_id}.mlt')
+
+    @staticmethod
+    def _cache_name(path, stat) -> str:
+        key = hashlib.sha1(f'{path}\0{stat.st_size}\0{stat.st_mtime_ns}'.encode()).hexdigest()
+        return key + os.path.splitext(path)[1]
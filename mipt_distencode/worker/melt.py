@@ -4,19 +4,43 @@ from mipt_distencode.config import Config
 
 
 class MeltHelper:
+    # Preset keys that are not consumer properties, see README
+    RESERVED_SECTIONS = ['resources', 'cost']
+
     @classmethod
-    def _build_consumer(cls, preset, target_path):
+    def _build_consumer(cls, preset, target_path, index=None):
+        """Properties of the index-th consumer of the multi consumer if index is set"""
+        prefix = '' if index is None else f'{index}.'
         cmdline = list()
-        cmdline.extend(['-consumer', f'avformat:{target_path}'])
+        if index is None:
+            cmdline.extend(['-consumer', f'avformat:{target_path}'])
+        else:
+            cmdline.append(f'{index}=avformat:{target_path}')
         for section, options in preset.items():
+            # Scalars are settings of the manager, not property sections
+            if section in cls.RESERVED_SECTIONS or not isinstance(options, dict):
+                continue
             for key, value in options.items():
-                cmdline.append(f'{key}={value}')
+                cmdline.append(f'{prefix}{key}={value}')
         return cmdline
 
     @classmethod
-    def build_cmdline(cls, project_path, preset, result_path):
+    def build_cmdline(cls, project_path, preset, result_path,
+                      in_frame=None, out_frame=None, extra_outputs=()):
+        """extra_outputs are (preset, result_path) encoded from the same frames"""
         cmdline = list()
         cmdline.append(Config.melt_path)
+        cmdline.append('-progress')
         cmdline.append(project_path)
-        cmdline.extend(cls._build_consumer(preset, result_path))
+        if in_frame is not None:
+            cmdline.append(f'in={in_frame}')
+        if out_frame is not None:
+            cmdline.append(f'out={out_frame}')
+        if not extra_outputs:
+            cmdline.extend(cls._build_consumer(preset, result_path))
+            return cmdline
+        cmdline.extend(['-consumer', 'multi'])
+        outputs = [(preset, result_path), *extra_outputs]
+        for index, (output_preset, output_path) in enumerate(outputs):
+            cmdline.extend(cls._build_consumer(output_preset, output_path, index))
         return cmdline
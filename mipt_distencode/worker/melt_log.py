@@ -0,0 +1,76 @@
+import collections
+import gzip
+import logging
+import os
+
+import grpc
+
+from mipt_distencode.config import Config
+from mipt_distencode.jobs_pb2 import JobId, LogChunk
+from mipt_distencode.manager.client import make_replica_client
+from mipt_distencode.worker.progress import PROGRESS_RE
+
+
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+
+class MeltLog:
+    """melt output of one job: a bounded in-memory tail plus a gzip file on disk"""
+    def __init__(self, job_id, tail_bytes=None):
+        self.job_id = job_id
+        self.tail_bytes = Config.log_tail_bytes if tail_bytes is None else tail_bytes
+        self.tail = collections.deque()
+        self.tail_size = 0
+        os.makedirs(Config.log_dir, exist_ok=True)
+        self.path = os.path.join(Config.log_dir, f'{Config.identity}-job-{job_id}.log.gz')
+        self.file = gzip.open(self.path, 'wb')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def write(self, chunk: bytes):
+        # Progress updates are tracked separately and would flood the log
+        chunk = PROGRESS_RE.sub(b'', chunk).replace(b'\r', b'')
+        if not chunk:
+            return
+        self.file.write(chunk)
+        self.tail.append(chunk)
+        self.tail_size += len(chunk)
+        while self.tail_size - len(self.tail[0]) >= self.tail_bytes:
+            self.tail_size -= len(self.tail.popleft())
+
+    def get_tail(self) -> bytes:
+        return b''.join(self.tail)[-self.tail_bytes:]
+
+    def close(self):
+        if not self.file.closed:
+            self.file.close()
+
+
+class LogUploader:
+    """Streams a compressed job log to the manager in fixed-size chunks"""
+    logger = logging.getLogger(__name__)
+
+    @classmethod
+    def chunks(cls, job_id, path):
+        with open(path, 'rb') as log_file:
+            offset = 0
+            while data := log_file.read(UPLOAD_CHUNK_SIZE):
+                yield LogChunk(id=JobId(id=job_id), offset=offset, data=data)
+                offset += len(data)
+
+    @classmethod
+    def upload(cls, job_id, path) -> bool:
+        client = make_replica_client()
+        try:
+            status = client.UploadJobLog(cls.chunks(job_id, path))
+        except grpc.RpcError as e:
+            cls.logger.warning(
+                'Job id=%s: log upload failed, kept at %s: %s', job_id, path, e.details())
+            return False
+        cls.logger.info('Job id=%s: uploaded %s bytes of log', job_id, status.size)
+        os.remove(path)
+        return True
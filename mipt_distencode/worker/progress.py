@@ -0,0 +1,154 @@
+import logging
+import re
+import threading
+import time
+
+import grpc
+
+from mipt_distencode.config import Config
+from mipt_distencode.jobs_pb2 import JobId, JobProgress
+from mipt_distencode.manager.client import make_replica_client
+
+
+# melt -progress writes "Current Frame:   123, percentage:   4" terminated by \r
+PROGRESS_RE = re.compile(rb'Current Frame:\s*(\d+), percentage:\s*(\d+)')
+
+
+class JobProgressState:
+    def __init__(self, job_id, total_frames=None):
+        self.job_id = job_id
+        self.total_frames = total_frames
+        self.frame = 0
+        self.percent = 0
+        self.started_at = time.monotonic()
+        self.fps = 0.0
+        self.finished = False
+        self.suspended = False
+        self.version = 0
+
+    def update(self, frame, percent):
+        self.frame = frame
+        self.percent = percent
+        elapsed = time.monotonic() - self.started_at
+        if elapsed > 0:
+            self.fps = frame / elapsed
+        self.version += 1
+
+    def eta_seconds(self) -> 'Optional[float]':
+        if self.fps <= 0:
+            return None
+        if self.total_frames:
+            return max(self.total_frames - self.frame, 0) / self.fps
+        if self.percent > 0:
+            elapsed = time.monotonic() - self.started_at
+            return elapsed * (100 - self.percent) / self.percent
+        return None
+
+    def proto(self) -> JobProgress:
+        message = JobProgress(
+            id=JobId(id=self.job_id),
+            hostname=Config.identity,
+            frame=self.frame,
+            percent=self.percent,
+            fps=self.fps,
+            elapsedSeconds=time.monotonic() - self.started_at,
+            finished=self.finished)
+        if self.suspended:
+            message.suspended = True
+        if self.total_frames:
+            message.totalFrames = self.total_frames
+        eta = self.eta_seconds()
+        if eta is not None:
+            message.etaSeconds = eta
+        return message
+
+
+class ProgressTracker:
+    """Progress of running jobs, parsed from melt output, with blocking watch"""
+    def __init__(self):
+        self.jobs = dict()
+        self.changed = threading.Condition()
+
+    def start(self, job_id, total_frames=None):
+        with self.changed:
+            self.jobs[job_id] = JobProgressState(job_id, total_frames)
+
+    def feed(self, job_id, chunk: bytes):
+        """Parse a chunk of melt stderr, the last progress line wins"""
+        matches = PROGRESS_RE.findall(chunk)
+        if not matches:
+            return
+        frame, percent = matches[-1]
+        with self.changed:
+            state = self.jobs.get(job_id)
+            if state is not None:
+                state.update(int(frame), int(percent))
+                self.changed.notify_all()
+
+    def set_suspended(self, job_id, suspended):
+        with self.changed:
+            state = self.jobs.get(job_id)
+            if state is not None:
+                state.suspended = suspended
+                state.version += 1
+                self.changed.notify_all()
+
+    def finish(self, job_id):
+        with self.changed:
+            state = self.jobs.pop(job_id, None)
+            if state is not None:
+                state.finished = True
+                state.version += 1
+                self.changed.notify_all()
+
+    def snapshot(self, job_id) -> 'Optional[JobProgress]':
+        with self.changed:
+            state = self.jobs.get(job_id)
+            return None if state is None else state.proto()
+
+    def snapshots(self) -> 'List[JobProgress]':
+        with self.changed:
+            return [state.proto() for state in self.jobs.values()]
+
+    def watch(self, job_id, is_active, min_interval=1.0):
+        """Yields progress on change, at most once per min_interval, until the job ends"""
+        with self.changed:
+            state = self.jobs.get(job_id)
+        if state is None:
+            return
+        seen = -1
+        while is_active():
+            with self.changed:
+                self.changed.wait_for(
+                    lambda: state.version != seen, timeout=min_interval)
+                if state.version == seen:
+                    continue
+                seen = state.version
+                message = state.proto()
+            yield message
+            if message.finished:
+                return
+            time.sleep(min_interval)
+
+
+class ProgressReporter(threading.Thread):
+    """Periodically pushes progress of running jobs to the manager"""
+    def __init__(self, tracker):
+        super().__init__(name='ProgressReporter', daemon=True)
+        self.tracker = tracker
+        self.stopping = threading.Event()
+        self.logger = logging.getLogger(__name__)
+
+    def run(self):
+        while not self.stopping.wait(Config.progress_interval_seconds):
+            client = make_replica_client()
+            for message in self.tracker.snapshots():
+                try:
+                    client.PostJobProgress(message)
+                except grpc.RpcError as e:
+                    self.logger.warning(
+                        'Job id=%s: progress report failed: %s', message.id.id, e.details())
+
+    def stop(self):
+        self.stopping.set()
+        self.join()
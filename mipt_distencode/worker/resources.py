@@ -0,0 +1,125 @@
+import os
+import threading
+
+
+# Used by presets without a "resources" section
+DEFAULT_DEMAND = {'cpu_threads': 1}
+
+
+def _total_memory_mb() -> int:
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // 2**20
+    except (ValueError, OSError, AttributeError):
+        return 0
+
+
+def cpu_load() -> float:
+    """One-minute load average per CPU"""
+    try:
+        return os.getloadavg()[0] / (os.cpu_count() or 1)
+    except OSError:
+        return 0.0
+
+
+def available_memory_bytes() -> int:
+    try:
+        with open('/proc/meminfo') as meminfo:
+            for line in meminfo:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_AVPHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        return 0
+
+
+def disk_free_bytes(path) -> int:
+    try:
+        stat = os.statvfs(path)
+    except OSError:
+        return 0
+    return stat.f_bavail * stat.f_frsize
+
+
+def default_capacity() -> 'Dict[str, int]':
+    return {
+        'cpu_threads': os.cpu_count() or 1,
+        'encoder_sessions': 1,
+        'memory_mb': _total_memory_mb(),
+    }
+
+
+def parse_resources(spec: str) -> 'Dict[str, int]':
+    """Parse 'name=amount,...', e.g. 'cpu_threads=32,encoder_sessions=3'"""
+    resources = dict()
+    for item in filter(None, (part.strip() for part in spec.split(','))):
+        name, amount = item.split('=', 1)
+        resources[name.strip()] = int(amount)
+    return resources
+
+
+class ResourcePool:
+    """Admission control: a job runs only if its whole demand fits"""
+    HELD_WHILE_SUSPENDED = ('encoder_sessions', 'memory_mb')
+
+    def __init__(self, capacity: 'Dict[str, int]'):
+        self.capacity = dict(capacity)
+        self.held = dict()
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, spec) -> 'ResourcePool':
+        capacity = default_capacity()
+        capacity.update(parse_resources(spec or ''))
+        return cls(capacity)
+
+    def satisfiable(self, demand) -> bool:
+        """Whether the demand fits into an idle worker at all"""
+        return all(
+            amount <= self.capacity.get(name, 0) for name, amount in demand.items())
+
+    def try_acquire(self, job_id, demand) -> bool:
+        with self.lock:
+            free = self._free()
+            if any(amount > free.get(name, 0) for name, amount in demand.items()):
+                return False
+            self.held[job_id] = dict(demand)
+            return True
+
+    def release(self, job_id):
+        with self.lock:
+            self.held.pop(job_id, None)
+
+    def suspend(self, job_id):
+        """A stopped process gives up CPU but keeps its memory and encoder sessions"""
+        with self.lock:
+            demand = self.held.get(job_id)
+            if demand is not None:
+                self.held[job_id] = {
+                    name: amount for name, amount in demand.items()
+                    if name in self.HELD_WHILE_SUSPENDED
+                }
+
+    def try_resume(self, job_id, demand) -> bool:
+        """Take back the whole demand of a suspended job if it fits"""
+        with self.lock:
+            held = self.held.get(job_id, {})
+            free = self._free()
+            if any(amount - held.get(name, 0) > free.get(name, 0)
+                   for name, amount in demand.items()):
+                return False
+            self.held[job_id] = dict(demand)
+            return True
+
+    def free(self) -> 'Dict[str, int]':
+        with self.lock:
+            return self._free()
+
+    def _free(self):
+        free = dict(self.capacity)
+        for demand in self.held.values():
+            for name, amount in demand.items():
+                free[name] = free.get(name, 0) - amount
+        return free
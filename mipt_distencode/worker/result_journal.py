@@ -0,0 +1,80 @@
+import logging
+import os
+import threading
+
+from google.protobuf.message import DecodeError
+
+from mipt_distencode.jobs_pb2 import MeltJobResult
+
+
+class ResultJournal:
+    """Job results the manager has not acknowledged yet, a file per job
+
+    A result is written before it is reported and removed once the manager
+    answers, so it survives manager outages and worker restarts"""
+    SUFFIX = '.result'
+
+    def __init__(self, root):
+        self.root = root
+        self.logger = logging.getLogger(__name__)
+        os.makedirs(root, exist_ok=True)
+
+    def add(self, message):
+        path = self._path(message.id.id)
+        partial = f'{path}.partial'
+        with open(partial, 'wb') as journal_file:
+            journal_file.write(message.SerializeToString())
+            journal_file.flush()
+            os.fsync(journal_file.fileno())
+        os.replace(partial, path)
+
+    def remove(self, job_id):
+        try:
+            os.remove(self._path(job_id))
+        except FileNotFoundError:
+            pass
+
+    def job_ids(self) -> 'List[int]':
+        return sorted(
+            int(name[len('job-'):-len(self.SUFFIX)]) for name in os.listdir(self.root)
+            if name.startswith('job-') and name.endswith(self.SUFFIX))
+
+    def pending(self) -> 'List[MeltJobResult]':
+        messages = list()
+        for job_id in self.job_ids():
+            message = MeltJobResult()
+            try:
+                with open(self._path(job_id), 'rb') as journal_file:
+                    message.ParseFromString(journal_file.read())
+            except FileNotFoundError:
+                continue  # Delivered meanwhile
+            except DecodeError:
+                self.logger.error('Dropping unreadable journal entry of job id=%s', job_id)
+                self.remove(job_id)
+                continue
+            messages.append(message)
+        return messages
+
+    def _path(self, job_id) -> str:
+        return os.path.join(self.root, f'job-{job_id}{self.SUFFIX}')
+
+
+class ResultReplayer(threading.Thread):
+    """Periodically re-sends journaled results until the manager takes them"""
+    def __init__(self, servicer, interval):
+        super().__init__(name='ResultReplayer', daemon=True)
+        self.servicer = servicer
+        self.interval = interval
+        self.stopping = threading.Event()
+        self.logger = logging.getLogger(__name__)
+
+    def run(self):
+        while not self.stopping.wait(self.interval):
+            try:
+                self.servicer.replay_results()
+            except Exception:
+                self.logger.exception('Replaying job results failed')
+
+    def stop(self):
+        self.stopping.set()
+        self.join()
@@ -8,19 +8,25 @@ from sqlalchemy.orm import sessionmaker
 
 from mipt_distencode.worker.worker_pb2_grpc import add_WorkerServicer_to_server
 from mipt_distencode.worker.worker import WorkerServicer
-from mipt_distencode.pb_common import add_endpoint_to_server
+from mipt_distencode.metrics import MetricsInterceptor, MetricsServer
+from mipt_distencode.pb_common import SERVER_OPTIONS, add_endpoint_to_server
 from mipt_distencode.config import Config
 
 
 class WorkerServer:
     def __init__(self, endpoint, secure=False):
-        self.server = grpc.server(futures.ThreadPoolExecutor(max_workers=1))
+        self.server = grpc.server(
+            futures.ThreadPoolExecutor(max_workers=Config.worker_rpc_threads),
+            interceptors=[MetricsInterceptor()],
+            options=SERVER_OPTIONS)
+        self.metrics = MetricsServer(Config.metrics_address, Config.worker_metrics_port)
         self.servicer = WorkerServicer()
         add_WorkerServicer_to_server(self.servicer, self.server)
         add_endpoint_to_server(self.server, endpoint, secure)
 
     def start(self):
         self.server.start()
+        self.metrics.start()
 
     def post_start(self):
         self.servicer.post_start()
@@ -34,6 +40,7 @@ class WorkerServer:
     def stop(self):
         self.server.stop(grace=30)
         self.servicer.join()
+        self.metrics.stop()
 
 def server_main():
     worker_server = WorkerServer(f'{Config.identity}:50053', secure=True)
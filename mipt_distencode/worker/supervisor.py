@@ -0,0 +1,163 @@
+import logging
+import os
+import shutil
+import signal
+import subprocess
+import threading
+import time
+
+from mipt_distencode.jobs_pb2 import BULK, NORMAL, URGENT
+
+
+class MeltTimeout(Exception):
+    pass
+
+
+class SupervisedRun:
+    def __init__(self, job_id, process, timeout):
+        self.job_id = job_id
+        self.process = process
+        self.timeout = timeout
+        # Seconds run before the current stretch, which started at resumed_at
+        self.ran = 0.0
+        self.resumed_at = time.monotonic()
+        self.suspended = False
+        self.timed_out = False
+
+    def running_seconds(self) -> float:
+        if self.suspended:
+            return self.ran
+        return self.ran + time.monotonic() - self.resumed_at
+
+
+class MeltSupervisor:
+    """Runs melt in a process group of its own, so that the encoder
+    processes it spawns are signalled with it
+
+    The group can be cancelled, suspended with SIGSTOP and resumed. A run
+    longer than its timeout, time suspended excluded, is killed and raises
+    MeltTimeout. melt is started under nice, bulk jobs also under ionice idle
+    class; their I/O priority otherwise follows the nice level"""
+    CHECK_INTERVAL_SECONDS = 1.0
+
+    def __init__(self, nice_levels, grace_seconds):
+        self.nice_levels = nice_levels
+        self.grace_seconds = grace_seconds
+        self.nice = shutil.which('nice')
+        self.ionice = shutil.which('ionice')
+        self.runs = dict()
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.watchdog = threading.Thread(target=self._watch, name='MeltWatchdog', daemon=True)
+        self.watchdog.start()
+        self.logger = logging.getLogger(__name__)
+
+    def command(self, cmdline, priority) -> 'List[str]':
+        prefix = list()
+        nice = self.nice_levels.get(_PRIORITY_NAMES[priority], 0)
+        if nice and self.nice is not None:
+            prefix += [self.nice, '-n', str(nice)]
+        if priority == BULK and self.ionice is not None:
+            prefix += [self.ionice, '-c', '3']
+        return prefix + list(cmdline)
+
+    def run(self, job_id, cmdline, priority, timeout, on_output, cancelled=lambda: False):
+        """Blocks until melt exits, feeding its output to on_output. timeout
+        of None or 0 is unlimited. cancelled() is checked once the run is
+        registered: a cancel that came before found no run to terminate"""
+        with subprocess.Popen(
+                self.command(cmdline, priority), stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT, start_new_session=True) as process:
+            run = SupervisedRun(job_id, process, timeout)
+            with self.lock:
+                self.runs[job_id] = run
+            if cancelled():
+                self.logger.info('Job id=%s: cancelled while melt was starting', job_id)
+                threading.Thread(target=self._terminate, args=(run,), daemon=True).start()
+            try:
+                while chunk := process.stdout.read1(4096):
+                    on_output(chunk)
+            finally:
+                process.wait()
+                with self.lock:
+                    del self.runs[job_id]
+        if run.timed_out:
+            raise MeltTimeout(f'melt ran longer than {timeout}s')
+        if process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, cmdline)
+
+    def cancel(self, job_id) -> bool:
+        """SIGTERM to the group, SIGKILL after the grace period. Returns
+        once melt exited, False if it was not running"""
+        with self.lock:
+            run = self.runs.get(job_id)
+        if run is None:
+            return False
+        self._terminate(run)
+        return True
+
+    def suspend(self, job_id) -> bool:
+        with self.lock:
+            run = self.runs.get(job_id)
+            if run is None or run.suspended:
+                return False
+            if not self._signal(run, signal.SIGSTOP):
+                return False
+            run.ran += time.monotonic() - run.resumed_at
+            run.suspended = True
+        self.logger.info('Job id=%s: melt suspended', job_id)
+        return True
+
+    def resume(self, job_id) -> bool:
+        with self.lock:
+            run = self.runs.get(job_id)
+            if run is None or not run.suspended:
+                return False
+            run.suspended = False
+            run.resumed_at = time.monotonic()
+            self._signal(run, signal.SIGCONT)
+        self.logger.info('Job id=%s: melt resumed', job_id)
+        return True
+
+    def is_suspended(self, job_id) -> bool:
+        with self.lock:
+            run = self.runs.get(job_id)
+            return run is not None and run.suspended
+
+    def stop(self):
+        self.stopping.set()
+
+    def _terminate(self, run):
+        self._signal(run, signal.SIGTERM)
+        # A stopped process handles SIGTERM only once continued
+        self._signal(run, signal.SIGCONT)
+        try:
+            run.process.wait(self.grace_seconds)
+        except subprocess.TimeoutExpired:
+            self._signal(run, signal.SIGKILL)
+            run.process.wait()
+
+    def _signal(self, run, signum) -> bool:
+        try:
+            os.killpg(run.process.pid, signum)
+        except ProcessLookupError:
+            return False
+        return True
+
+    def _watch(self):
+        while not self.stopping.wait(self.CHECK_INTERVAL_SECONDS):
+            with self.lock:
+                expired = [
+                    run for run in self.runs.values()
+                    if run.timeout and not run.timed_out
+                    and run.running_seconds() > run.timeout
+                ]
+                for run in expired:
+                    run.timed_out = True
+            for run in expired:
+                self.logger.warning('Job id=%s: melt ran longer than %ss, killing',
+                                    run.job_id, run.timeout)
+                threading.Thread(target=self._terminate, args=(run,), daemon=True).start()
+
+
+_PRIORITY_NAMES = {BULK: 'bulk', NORMAL: 'normal', URGENT: 'urgent'}
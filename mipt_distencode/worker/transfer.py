@@ -0,0 +1,93 @@
+import logging
+import mmap
+import os
+import threading
+
+import grpc
+
+from mipt_distencode.jobs_pb2 import JobId, ResultChunk
+from mipt_distencode.manager.client import make_replica_client
+
+
+class ResultUploader:
+    """Upload mode: melt writes results to local scratch and they are streamed
+    to the manager in fixed-size chunks read from a memory map
+
+    After a disconnect the upload asks the manager how much it has stored and
+    resumes there. Uploads run on their own threads, so the slot is free for
+    the next encode meanwhile"""
+    # The manager will not take the file however often it is sent
+    REJECTED = [
+        grpc.StatusCode.NOT_FOUND, grpc.StatusCode.FAILED_PRECONDITION,
+        grpc.StatusCode.INVALID_ARGUMENT,
+    ]
+
+    def __init__(self, scratch_dir, chunk_bytes, retry_seconds):
+        self.scratch_dir = scratch_dir
+        self.chunk_bytes = chunk_bytes
+        self.retry_seconds = retry_seconds
+        self.stopping = threading.Event()
+        self.logger = logging.getLogger(__name__)
+        os.makedirs(scratch_dir, exist_ok=True)
+
+    def scratch_path(self, job_id, result_path) -> str:
+        return os.path.join(
+            self.scratch_dir, f'job-{job_id}{os.path.splitext(result_path)[1]}')
+
+    def chunks(self, job_id, path, offset):
+        """The first chunk carries the size and may be empty, which completes
+        an upload that only lacks the final move"""
+        size = os.path.getsize(path)
+        with open(path, 'rb') as result_file:
+            if size == 0:
+                yield ResultChunk(id=JobId(id=job_id), offset=0, data=b'', totalSize=0)
+                return
+            with mmap.mmap(result_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                end = min(offset + self.chunk_bytes, size)
+                yield ResultChunk(id=JobId(id=job_id), offset=offset,
+                                  data=mapped[offset:end], totalSize=size)
+                for start in range(end, size, self.chunk_bytes):
+                    yield ResultChunk(id=JobId(id=job_id), offset=start,
+                                      data=mapped[start:start + self.chunk_bytes])
+
+    def upload(self, job_id, path) -> bool:
+        """True once the manager has the whole file, False if it refuses the
+        file or the worker stops while the manager is away. The scratch file
+        is removed either way"""
+        while True:
+            client = make_replica_client()
+            try:
+                offset = client.GetResultUpload(JobId(id=job_id)).offset
+                if offset:
+                    self.logger.info('Job id=%s: resuming result upload at %s bytes',
+                                     job_id, offset)
+                status = client.UploadResult(self.chunks(job_id, path, offset))
+            except grpc.RpcError as e:
+                if e.code() in self.REJECTED:
+                    self.logger.error('Job id=%s: result upload rejected: %s',
+                                      job_id, e.details())
+                    break
+                self.logger.warning('Job id=%s: result upload interrupted: %s %s',
+                                    job_id, e.code(), e.details())
+                if self.stopping.wait(self.retry_seconds):
+                    break
+                continue
+            if status.complete:
+                self.logger.info('Job id=%s: uploaded %s bytes of result',
+                                 job_id, status.offset)
+                os.remove(path)
+                return True
+            self.logger.warning('Job id=%s: upload ended at %s bytes, resuming',
+                                job_id, status.offset)
+        self.discard(path)
+        return False
+
+    def discard(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def stop(self):
+        """Uploads in progress finish, failed ones are not retried"""
+        self.stopping.set()
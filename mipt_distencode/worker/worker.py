@@ -1,116 +1,477 @@
+import collections
 import io
 import json
 import logging
-import multiprocessing
 import os
-import subprocess
 import sys
+import threading
 import traceback
+from concurrent import futures
 
 import grpc
 from google.protobuf.text_format import MessageToString
 
 from mipt_distencode.config import Config
-from mipt_distencode.jobs_pb2 import JobId, MeltJob, MeltJobResult
-from mipt_distencode.mgmt_messages_pb2 import WorkerSelfAnnouncement, WorkerState
-from mipt_distencode.pb_common import PeerIdentityMixin, make_channel
+from mipt_distencode.jobs_pb2 import BULK, URGENT, JobId, MeltJob, MeltJobResult
+from mipt_distencode.metrics import REGISTRY
+from mipt_distencode.mgmt_messages_pb2 import (
+    ResourceAmount, WorkerSelfAnnouncement, WorkerState
+)
+from mipt_distencode.pb_common import PeerIdentityMixin
 from mipt_distencode.worker import worker_pb2_grpc
+from mipt_distencode.worker.leaser import JobLeaser
+from mipt_distencode.worker.media_cache import MediaCache
 from mipt_distencode.worker.melt import MeltHelper
-from mipt_distencode.manager.client import make_client as make_manager_client
+from mipt_distencode.worker.melt_log import LogUploader, MeltLog
+from mipt_distencode.worker.progress import ProgressReporter, ProgressTracker
+from mipt_distencode.worker.resources import (
+    DEFAULT_DEMAND, ResourcePool, available_memory_bytes, cpu_load, disk_free_bytes,
+    parse_resources
+)
+from mipt_distencode.worker.result_journal import ResultJournal, ResultReplayer
+from mipt_distencode.worker.supervisor import MeltSupervisor, MeltTimeout
+from mipt_distencode.worker.transfer import ResultUploader
+from mipt_distencode.manager.client import make_replica_client
+
+
+JOBS = REGISTRY.gauge(
+    'distenc_worker_jobs', 'Jobs encoding, waiting for resources or reporting results',
+    ['state'])
+FREE_RESOURCES = REGISTRY.gauge(
+    'distenc_worker_free_resources', 'Resources not held by running jobs', ['resource'])
+MELT_FPS = REGISTRY.histogram(
+    'distenc_melt_fps', 'Frames per second of successful melt runs by main preset',
+    ['preset'], buckets=(1, 2, 5, 10, 25, 50, 100, 250, 500, 1000))
+MELT_SECONDS = REGISTRY.histogram(
+    'distenc_melt_seconds', 'Duration of melt runs by main preset and outcome',
+    ['preset', 'outcome'], buckets=(1, 10, 30, 60, 300, 600, 1800, 3600, 7200, 14400))
 
 
 class JobExecutionError(Exception):
-    def __init__(self, jobId, message, stacktrace):
+    def __init__(self, jobId, message, stacktrace, melt_log=None, timed_out=False):
         self.jobId = jobId
         self.message = message
         self.stacktrace = stacktrace
+        self.melt_log = melt_log
+        self.timed_out = timed_out
 
     @classmethod
-    def with_traceback(cls, jobId, e):
+    def with_traceback(cls, jobId, e, melt_log=None):
         with io.StringIO() as string_io:
             traceback.print_exc(file=string_io)
             trace = string_io.getvalue()
-            return JobExecutionError(jobId, str(e), trace)
+            return JobExecutionError(jobId, str(e), trace, melt_log,
+                                     timed_out=isinstance(e, MeltTimeout))
 
 
 class WorkerServicer(worker_pb2_grpc.WorkerServicer, PeerIdentityMixin):
-    PROCESS_COUNT = 1
+    # Seconds melt gets to exit on SIGTERM before SIGKILL
+    CANCEL_GRACE_SECONDS = 10
+    # The manager will not take these results however often they are sent
+    RESULT_REJECTED = [
+        grpc.StatusCode.NOT_FOUND, grpc.StatusCode.FAILED_PRECONDITION,
+        grpc.StatusCode.INVALID_ARGUMENT,
+    ]
 
     def __init__(self):
         super().__init__()
         self.melt_presets = self._load_melt_presets()
-        self.process_pool = multiprocessing.Pool(self.PROCESS_COUNT)
+        self.slots = Config.worker_slots
+        self.resources = ResourcePool.from_config(Config.worker_resources)
+        # melt runs as a subprocess, a thread per slot only waits for it.
+        # Each slot may also hold a suspended bulk job
+        self.melt_pool = futures.ThreadPoolExecutor(
+            max_workers=2 * self.slots, thread_name_prefix='melt')
+        self.supervisor = MeltSupervisor(
+            parse_resources(Config.melt_nice), self.CANCEL_GRACE_SECONDS)
+        self.progress = ProgressTracker()
+        self.progress_reporter = ProgressReporter(self.progress)
         self.state = WorkerState.ACTIVE
+        self.running_jobs = set()
+        # Leased jobs waiting for resources, in lease order
+        self.waiting_jobs = collections.deque()
+        # Started jobs by id, running or suspended
+        self.started_jobs = dict()
+        # Bulk jobs suspended for urgent ones, in suspension order
+        self.suspended_jobs = collections.OrderedDict()
+        self.running_lock = threading.Lock()
+        # Jobs cancelled but not yet done
+        self.cancelled = set()
+        # Finished jobs until the manager has their result
+        self.reporting_jobs = set()
+        self.journal = ResultJournal(Config.result_journal_dir)
+        self.replayer = ResultReplayer(self, Config.result_replay_seconds)
+        self.leaser = JobLeaser(self) if Config.dispatch_mode == 'pull' else None
+        self.uploader = None
+        self.transfer_pool = None
+        if Config.result_transfer == 'upload':
+            self.uploader = ResultUploader(
+                Config.scratch_dir, Config.transfer_chunk_bytes, Config.result_replay_seconds)
+            self.transfer_pool = futures.ThreadPoolExecutor(
+                max_workers=Config.transfer_threads, thread_name_prefix='transfer')
+        self.media_cache = None
+        if Config.media_cache_dir:
+            self.media_cache = MediaCache(
+                Config.media_cache_dir,
+                max_bytes=int(Config.media_cache_max_gb * 2**30),
+                prefetch_threads=Config.media_prefetch_threads)
         self.logger = logging.getLogger(__name__)
         self.logger.setLevel(logging.DEBUG)
+        JOBS.set_function(self._job_counts)
+        FREE_RESOURCES.set_function(
+            lambda: {(name,): amount for name, amount in self.resources.free().items()})
+
+    def GetState(self, identity, context):
+        peer = self.identify_peer(context)
+        if identity.HasField('manager') and identity.manager == peer:
+            # Reports go to the replica that owns the worker
+            make_replica_client().prefer(identity.manager)
+        return self._state_message(self.state)
 
     def PostMeltJob(self, job, context):
         peer = self.identify_peer(context)
         if self.state == WorkerState.STOPPING:
             context.abort(grpc.StatusCode.UNAVAILABLE, 'Worker is stopping')
-        for field in ['projectPath', 'encodingPresetName', 'resultPath']:
-            if not job.HasField(field):
-                context.abort(
-                    grpc.StatusCode.INVALID_ARGUMENT, f'Missing field: {field}')
-        preset = self.melt_presets.get(job.encodingPresetName)
-        if preset is None:
+        error = self._validate_job(job)
+        if error is not None:
+            context.abort(grpc.StatusCode.INVALID_ARGUMENT, error)
+        if not self._try_start(job):
             context.abort(
-                grpc.StatusCode.INVALID_ARGUMENT,
-                f'Unknown preset: {job.encodingPresetName}')
+                grpc.StatusCode.RESOURCE_EXHAUSTED,
+                'Not enough free resources for presets {}'.format(
+                    ', '.join(_preset_names(job))))
         self.logger.info(
             'Accepted job [%s] from [%s]',
             MessageToString(job, as_one_line=True), peer)
-        self.process_pool.apply_async(
-            self._call_melt, args=[job, preset],
-            callback=self._report_job_success, error_callback=self._report_job_error)
         return job.id
 
+    def WatchJob(self, job_id, context):
+        self.identify_peer(context)
+        if self.progress.snapshot(job_id.id) is None:
+            context.abort(grpc.StatusCode.NOT_FOUND, f'Job id={job_id.id} is not running')
+        yield from self.progress.watch(job_id.id, context.is_active)
+
+    def CancelJob(self, job_id, context):
+        peer = self.identify_peer(context)
+        if not self._cancel(job_id.id):
+            context.abort(grpc.StatusCode.NOT_FOUND, f'Job id={job_id.id} is not running')
+        self.logger.info('Job id=%s cancelled by [%s]', job_id.id, peer)
+        return job_id
+
+    def accept_leased(self, job):
+        error = self._validate_job(job)
+        if error is not None:
+            self.logger.error('Rejecting leased job id=%s: %s', job.id.id, error)
+            self._report_job_result(MeltJobResult(
+                id=job.id, success=False, error=error.encode('utf-8')))
+            return
+        self.logger.info('Leased job [%s]', MessageToString(job, as_one_line=True))
+        if self.media_cache is not None:
+            self.media_cache.prefetch(job)
+        if not self._try_start(job):
+            self.logger.info('Job id=%s waits for resources', job.id.id)
+            with self.running_lock:
+                self.waiting_jobs.append(job)
+
+    def running_job_ids(self) -> 'List[int]':
+        """Running, suspended, admitted but waiting and encoded but unreported jobs"""
+        with self.running_lock:
+            return list(self.started_jobs.keys() | self.reporting_jobs) \
+                + [job.id.id for job in self.waiting_jobs]
+
+    def free_slots(self) -> int:
+        if self.state == WorkerState.STOPPING:
+            return 0
+        with self.running_lock:
+            return self.slots - len(self.running_jobs) - len(self.waiting_jobs)
+
     def post_start(self):
         self._report_state(WorkerState.ACTIVE)
+        self.progress_reporter.start()
+        self.replayer.start()
+        if self.leaser is not None:
+            self.leaser.start()
 
     def pre_stop(self):
         self._report_state(WorkerState.STOPPING)
         self.state = WorkerState.STOPPING
+        if self.leaser is not None:
+            self.leaser.stop()
 
     def join(self):
-        self.process_pool.close()
-        self.process_pool.join()
+        # Suspended jobs would never finish otherwise
+        with self.running_lock:
+            suspended = list(self.suspended_jobs)
+        for job_id in suspended:
+            self.supervisor.resume(job_id)
+        self.melt_pool.shutdown(wait=True)
+        self.supervisor.stop()
+        if self.uploader is not None:
+            self.uploader.stop()
+            self.transfer_pool.shutdown(wait=True)
+        self.progress_reporter.stop()
+        self.replayer.stop()
+
+    def _job_counts(self) -> 'Dict[Tuple[str], int]':
+        with self.running_lock:
+            return {
+                ('running',): len(self.running_jobs),
+                ('suspended',): len(self.suspended_jobs),
+                ('waiting',): len(self.waiting_jobs),
+                ('reporting',): len(self.reporting_jobs),
+            }
+
+    def _state_message(self, state) -> WorkerSelfAnnouncement:
+        with self.running_lock:
+            active = self.started_jobs.keys() | self.reporting_jobs \
+                | {job.id.id for job in self.waiting_jobs}
+        # Undelivered results still belong to the worker
+        active.update(self.journal.job_ids())
+        return WorkerSelfAnnouncement(
+            hostname=Config.identity, newState=state, slots=self.slots,
+            freeResources=[
+                ResourceAmount(name=name, amount=amount)
+                for name, amount in sorted(self.resources.free().items())
+            ],
+            freeSlots=self.free_slots(),
+            activeJobIds=sorted(active),
+            cpuLoad=cpu_load(),
+            memoryAvailableBytes=available_memory_bytes(),
+            diskFreeBytes=disk_free_bytes(Config.result_disk_path))
 
     def _report_state(self, state):
-        client = make_manager_client(
-            make_channel(f'{Config.manager_address}:50052', secure=True))
-        message = WorkerSelfAnnouncement(
-            hostname=Config.identity, newState=state)
+        client = make_replica_client()
+        message = self._state_message(state)
         client.WorkerAnnounce(message)
         self.logger.info('Reported state: %s', MessageToString(message, as_one_line=True))
 
+    def _validate_job(self, job) -> 'Optional[str]':
+        for field in ['projectPath', 'encodingPresetName', 'resultPath']:
+            if not job.HasField(field):
+                return f'Missing field: {field}'
+        for output in job.extraOutputs:
+            if not output.HasField('encodingPresetName') or not output.HasField('resultPath'):
+                return 'Extra outputs need encodingPresetName and resultPath'
+        for preset_name in _preset_names(job):
+            if preset_name not in self.melt_presets:
+                return f'Unknown preset: {preset_name}'
+        if not self.resources.satisfiable(self._demand(job)):
+            return 'Presets {} need more resources than the worker has'.format(
+                ', '.join(_preset_names(job)))
+        return None
+
+    def _demand(self, job) -> 'Dict[str, int]':
+        """Outputs of one melt run each hold their encoder, demands add up"""
+        demand = collections.Counter()
+        for preset_name in _preset_names(job):
+            demand.update(self.melt_presets[preset_name].get('resources', DEFAULT_DEMAND))
+        return dict(demand)
+
+    def _try_start(self, job) -> bool:
+        """Start the job if a slot and its resources are free, an urgent job
+        may suspend bulk jobs for them"""
+        with self.running_lock:
+            started = self._admit(job) or job.priority == URGENT and self._preempt_for(job)
+            if not started:
+                return False
+            self.started_jobs[job.id.id] = job
+        preset = self.melt_presets[job.encodingPresetName]
+        future = self.melt_pool.submit(self._call_melt, job, preset)
+        future.add_done_callback(self._on_melt_done)
+        return True
+
+    def _admit(self, job) -> bool:
+        """Under running_lock"""
+        if len(self.running_jobs) >= self.slots:
+            return False
+        if not self.resources.try_acquire(job.id.id, self._demand(job)):
+            return False
+        self.running_jobs.add(job.id.id)
+        return True
+
+    def _preempt_for(self, job) -> bool:
+        """Under running_lock: suspend running bulk jobs, latest started first,
+        until the job fits. Nothing stays suspended if it does not"""
+        if not Config.preempt_bulk_jobs:
+            return False
+        suspended = list()
+        for job_id, started in reversed(list(self.started_jobs.items())):
+            if started.priority != BULK or job_id not in self.running_jobs:
+                continue
+            if not self.supervisor.suspend(job_id):
+                continue  # melt has not started yet or is exiting
+            self.running_jobs.discard(job_id)
+            self.resources.suspend(job_id)
+            self.suspended_jobs[job_id] = started
+            self.progress.set_suspended(job_id, True)
+            suspended.append(job_id)
+            if self._admit(job):
+                self.logger.info('Job id=%s: suspended bulk jobs %s to start',
+                                 job.id.id, suspended)
+                return True
+        for job_id in suspended:
+            self._resume(job_id)
+        return False
+
+    def _resume(self, job_id) -> bool:
+        """Under running_lock"""
+        job = self.suspended_jobs[job_id]
+        if len(self.running_jobs) >= self.slots \
+                or not self.resources.try_resume(job_id, self._demand(job)):
+            return False
+        del self.suspended_jobs[job_id]
+        self.running_jobs.add(job_id)
+        self.progress.set_suspended(job_id, False)
+        self.supervisor.resume(job_id)
+        return True
+
+    def _cancel(self, job_id) -> bool:
+        with self.running_lock:
+            for job in self.waiting_jobs:
+                if job.id.id == job_id:
+                    self.waiting_jobs.remove(job)
+                    return True
+            if job_id not in self.started_jobs:
+                return False
+            self.cancelled.add(job_id)
+        self.supervisor.cancel(job_id)
+        return True
+
+    def _on_melt_done(self, future):
+        job_id = future.exception().jobId if future.exception() is not None \
+            else future.result()[0].id.id
+        with self.running_lock:
+            cancelled = job_id in self.cancelled
+            self.cancelled.discard(job_id)
+        if cancelled:
+            # Whoever cancelled the job does not expect its result
+            self._job_done(job_id)
+            if future.exception() is None:
+                self._discard_scratch(future.result()[0])
+            return
+        with self.running_lock:
+            self.reporting_jobs.add(job_id)
+        self._job_done(job_id)
+        if future.exception() is None and self.uploader is not None:
+            # The slot is free, the next encode runs during the transfer
+            self.transfer_pool.submit(self._transfer_result, future.result())
+            return
+        try:
+            if future.exception() is not None:
+                self._report_job_error(future.exception())
+            else:
+                self._report_job_success(future.result())
+        finally:
+            with self.running_lock:
+                self.reporting_jobs.discard(job_id)
+
+    def _job_done(self, job_id):
+        with self.running_lock:
+            self.running_jobs.discard(job_id)
+            self.started_jobs.pop(job_id, None)
+            self.suspended_jobs.pop(job_id, None)
+            self.resources.release(job_id)
+            # Suspended jobs are half done, they go before new ones
+            for suspended_id in list(self.suspended_jobs):
+                if not self._resume(suspended_id):
+                    break
+            waiting = list(self.waiting_jobs)
+            self.waiting_jobs.clear()
+        for job in waiting:
+            if not self._try_start(job):
+                with self.running_lock:
+                    self.waiting_jobs.append(job)
+        if self.leaser is not None:
+            self.leaser.wake()
+
+    def _transfer_result(self, result):
+        """Upload mode, runs on the transfer pool: sends the outputs, then the result"""
+        job, melt_log = result
+        try:
+            uploaded = True
+            for job_id, result_path in _outputs(job):
+                path = self.uploader.scratch_path(job_id, result_path)
+                if uploaded:
+                    uploaded = self.uploader.upload(job_id, path)
+                else:
+                    self.uploader.discard(path)
+            if uploaded:
+                self._report_job_success(result)
+        except Exception as e:
+            self._discard_scratch(job)
+            self._report_job_error(JobExecutionError.with_traceback(job.id.id, e, melt_log))
+        finally:
+            with self.running_lock:
+                self.reporting_jobs.discard(job.id.id)
+
+    def _output_path(self, job_id, result_path) -> str:
+        """Where melt writes the output"""
+        if self.uploader is None:
+            return result_path
+        return self.uploader.scratch_path(job_id, result_path)
+
+    def _discard_scratch(self, job):
+        if self.uploader is not None:
+            for job_id, result_path in _outputs(job):
+                self.uploader.discard(self.uploader.scratch_path(job_id, result_path))
+
     def _report_job_success(self, result):
-        job, cmdline = result
+        job, melt_log = result
+        LogUploader.upload(job.id.id, melt_log.path)
         message = MeltJobResult(
             id=job.id,
             success=True,
             resultPath=job.resultPath,
-            error='Dry run'.encode('utf-8'),
-            log=str(cmdline).encode('utf-8'))
+            log=melt_log.get_tail())
         self._report_job_result(message)
 
     def _report_job_error(self, e: JobExecutionError):
         emesg = f'Unhandled exception in worker thread: {e.message}'
-        self.logger.exception(emesg)
+        self.logger.error('Job id=%s: %s', e.jobId, emesg)
+        log_tail = b''
+        if e.melt_log is not None:
+            LogUploader.upload(e.jobId, e.melt_log.path)
+            log_tail = e.melt_log.get_tail()
         message = MeltJobResult(
             id=JobId(id=e.jobId),
             success=False,
-            error=emesg.encode('utf-8'),
-            log=e.stacktrace.encode('utf-8'))
+            error=f'{emesg}\n{e.stacktrace}'.encode('utf-8'),
+            log=log_tail,
+            timedOut=e.timed_out)
         self._report_job_result(message)
 
     def _report_job_result(self, message):
-        client = make_manager_client(
-            make_channel(f'{Config.manager_address}:50052', secure=True))
-        resp = client.PostMeltJobResult(message)
-        self.logger.info(
-            'Job id=%s report response: %s',
-            message.id.id, MessageToString(resp, as_one_line=True))
+        self.journal.add(message)
+        self._send_result(message)
+
+    def replay_results(self):
+        """Called by ResultReplayer, sends journaled results in job order"""
+        with self.running_lock:
+            reporting = set(self.reporting_jobs)
+        for message in self.journal.pending():
+            if message.id.id in reporting:
+                continue
+            self.logger.info('Job id=%s: replaying the result', message.id.id)
+            if not self._send_result(message):
+                break  # The manager is still away
+
+    def _send_result(self, message) -> bool:
+        """False if the manager is unreachable and the result stays journaled"""
+        client = make_replica_client()
+        try:
+            resp = client.PostMeltJobResult(message)
+        except grpc.RpcError as e:
+            if e.code() not in self.RESULT_REJECTED:
+                self.logger.warning('Job id=%s: result not delivered, journaled: %s %s',
+                                    message.id.id, e.code(), e.details())
+                return False
+            self.logger.error('Job id=%s: result rejected: %s', message.id.id, e.details())
+        else:
+            self.logger.info(
+                'Job id=%s reported: success=%s, %s bytes of log tail',
+                resp.id.id, resp.success, len(resp.log))
+        self.journal.remove(message.id.id)
+        return True
 
     @staticmethod
     def _load_melt_presets() -> 'Dict[str, Dict]':
@@ -125,15 +486,72 @@ class WorkerServicer(worker_pb2_grpc.WorkerServicer, PeerIdentityMixin):
                 presets[name] = json.load(pfile)
         return presets
 
-    @staticmethod
-    def _call_melt(job, preset):
+    def _call_melt(self, job, preset):
+        in_frame = job.inFrame if job.HasField('inFrame') else None
+        out_frame = job.outFrame if job.HasField('outFrame') else None
+        total_frames = None
+        if in_frame is not None and out_frame is not None:
+            total_frames = out_frame - in_frame + 1
+        self.progress.start(job.id.id, total_frames)
+        melt_log = MeltLog(job.id.id)
         try:
-            logger = multiprocessing.log_to_stderr() \
-                .getChild(__name__).getChild(f'Process-{os.getpid()}')
-            logger.setLevel(logging.DEBUG)
-            cmdline = MeltHelper.build_cmdline(job.projectPath, preset, job.resultPath)
-            logger.info('job=%s cmdline: %s', job.id.id, cmdline)
-            subprocess.check_call(cmdline)
-            return job, cmdline
+            project_path = job.projectPath
+            if self.media_cache is not None:
+                project_path = self.media_cache.localize(job)
+            extra_outputs = [
+                (self.melt_presets[output.encodingPresetName],
+                 self._output_path(output.id.id, output.resultPath))
+                for output in job.extraOutputs
+            ]
+            cmdline = MeltHelper.build_cmdline(
+                project_path, preset, self._output_path(job.id.id, job.resultPath),
+                in_frame=in_frame, out_frame=out_frame, extra_outputs=extra_outputs)
+            self.logger.info('job=%s cmdline: %s', job.id.id, cmdline)
+            melt_log.write(f'{cmdline}\n'.encode('utf-8'))
+            self._run_melt(job, cmdline, melt_log)
+            progress = self.progress.snapshot(job.id.id)
+            MELT_SECONDS.observe(progress.elapsedSeconds, job.encodingPresetName, 'success')
+            if progress.frame and progress.elapsedSeconds > 0:
+                MELT_FPS.observe(progress.frame / progress.elapsedSeconds,
+                                 job.encodingPresetName)
+            return job, melt_log
         except Exception as e:
-            raise JobExecutionError.with_traceback(job.id.id, e)
+            progress = self.progress.snapshot(job.id.id)
+            MELT_SECONDS.observe(progress.elapsedSeconds, job.encodingPresetName, 'failure')
+            self._discard_scratch(job)
+            raise JobExecutionError.with_traceback(job.id.id, e, melt_log)
+        finally:
+            melt_log.close()
+            self.progress.finish(job.id.id)
+            if self.media_cache is not None:
+                self.media_cache.release(job.id.id)
+
+    def _run_melt(self, job, cmdline, melt_log):
+        job_id = job.id.id
+        timeout = job.timeoutSeconds if job.HasField('timeoutSeconds') \
+            else Config.melt_timeout_seconds
+
+        def on_output(chunk):
+            self.progress.feed(job_id, chunk)
+            melt_log.write(chunk)
+
+        def cancelled():
+            with self.running_lock:
+                return job_id in self.cancelled
+
+        if cancelled():
+            raise RuntimeError(f'Job id={job_id} cancelled before melt started')
+        # _cancel marks the job before it looks for the run, the run is
+        # registered before the mark is checked again, so one of them sees the other
+        self.supervisor.run(job_id, cmdline, job.priority, timeout, on_output, cancelled)
+
+
+def _outputs(job) -> 'List[Tuple[int, str]]':
+    """(job id, result path) of every output of the melt run"""
+    return [(job.id.id, job.resultPath)] + [
+        (output.id.id, output.resultPath) for output in job.extraOutputs]
+
+
+def _preset_names(job) -> 'List[str]':
+    return [job.encodingPresetName] + [
+        output.encodingPresetName for output in job.extraOutputs]
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""Stand-in for ffprobe: point DISTENC_FFPROBE here to verify results of fake-melt.py
+
+Reads the melt arguments fake-melt.py wrote into the result, one JSON line per
+encoded segment, and prints what ffprobe would report for that encode: a video
+stream with its frame count and an audio stream if the consumer has acodec.
+FAKE_FFPROBE_FRAMES overrides the frame count, FAKE_FFPROBE_EXIT_CODE fails
+"""
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mipt_distencode.mlt_project import MltProject  # noqa: E402
+
+
+def consumer_properties(args, index) -> 'Dict[str, str]':
+    """Properties of a consumer, those of multi consumers are prefixed N."""
+    pairs = [arg.split('=', 1) for arg in args if '=' in arg]
+    if index is None:
+        return {k: v for k, v in pairs if '.' not in k}
+    prefix = f'{index}.'
+    return {k[len(prefix):]: v for k, v in pairs if k.startswith(prefix)}
+
+
+def probe_line(line) -> 'Tuple[float, float, bool]':
+    """Output frames, frame rate and audio of one fake-melt run"""
+    run = json.loads(line)
+    args = run['argv']
+    project = MltProject.load(args[args.index('-progress') + 1])
+    bounds = dict(arg.split('=', 1) for arg in args if arg.startswith(('in=', 'out=')))
+    if 'out' in bounds:
+        frames = int(bounds['out']) - int(bounds.get('in', 0)) + 1
+    else:
+        frames = project.frame_count()
+    properties = consumer_properties(args, run['consumer'])
+    frame_rate = float(properties.get('framerate', project.frame_rate))
+    return frames / float(project.frame_rate) * frame_rate, frame_rate, 'acodec' in properties
+
+
+def main(argv):
+    path = argv[-1]
+    exit_code = int(os.environ.get('FAKE_FFPROBE_EXIT_CODE', '0'))
+    if exit_code:
+        sys.stderr.write(f'{path}: Invalid data found when processing input\n')
+        return exit_code
+    with open(path) as result:
+        probed = [probe_line(line) for line in result if line.strip()]
+    frames = round(sum(frames for frames, _, _ in probed))
+    frames = int(os.environ.get('FAKE_FFPROBE_FRAMES', frames))
+    frame_rate = probed[0][1]
+    streams = [{
+        'index': 0, 'codec_type': 'video', 'nb_frames': str(frames),
+        'r_frame_rate': f'{frame_rate:g}/1',
+    }]
+    if probed[0][2]:
+        streams.append({'index': 1, 'codec_type': 'audio'})
+    json.dump({
+        'streams': streams,
+        'format': {'filename': path, 'duration': f'{frames / frame_rate:.6f}'},
+    }, sys.stdout)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+"""Stand-in for melt: point DISTENC_MELT here to exercise workers without encoding
+
+Takes FAKE_MELT_SECONDS printing melt-style progress, writes the melt arguments
+and the index of the consumer as a JSON line to every consumer target and exits
+with FAKE_MELT_EXIT_CODE. With FAKE_MELT_FPS it takes as long as encoding the
+frames of the project at that speed, FAKE_MELT_BURN=1 spins a CPU meanwhile
+"""
+import json
+import os
+import re
+import sys
+import time
+
+
+def frame_count(argv) -> int:
+    bounds = dict(arg.split('=', 1) for arg in argv if arg.startswith(('in=', 'out=')))
+    if 'out' in bounds:
+        return int(bounds['out']) - int(bounds.get('in', 0)) + 1
+    if '-progress' in argv:
+        sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        from mipt_distencode.mlt_project import MltProject
+        try:
+            return MltProject.load(argv[argv.index('-progress') + 1]).frame_count()
+        except (OSError, ValueError, SyntaxError):
+            pass  # Not a project, e.g. melt run on a media file
+    return 1000
+
+
+def wait(seconds, burn):
+    if not burn:
+        time.sleep(seconds)
+        return
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        sum(i * i for i in range(1000))
+
+
+def main(argv):
+    frames = frame_count(argv)
+    seconds = float(os.environ.get('FAKE_MELT_SECONDS', '1'))
+    if 'FAKE_MELT_FPS' in os.environ:
+        seconds = frames / float(os.environ['FAKE_MELT_FPS'])
+    burn = os.environ.get('FAKE_MELT_BURN') == '1'
+    steps = max(int(seconds * 10), 1)
+    for step in range(1, steps + 1):
+        wait(seconds / steps, burn)
+        if '-progress' in argv:
+            frame = frames * step // steps
+            sys.stderr.write(
+                f'Current Frame: {frame:10d}, percentage: {100 * step // steps:10d}\r')
+            sys.stderr.flush()
+    targets = [
+        (None, target) for flag, target in zip(argv, argv[1:])
+        if flag == '-consumer' and ':' in target
+    ]
+    # Consumers of -consumer multi are 0=avformat:path, 1=...
+    targets.extend(arg.split('=', 1) for arg in argv if re.match(r'\d+=\w+:', arg))
+    for index, target in targets:
+        with open(target.split(':', 1)[1], 'w') as result:
+            result.write(json.dumps({'consumer': index, 'argv': argv}) + '\n')
+    return int(os.environ.get('FAKE_MELT_EXIT_CODE', '0'))
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
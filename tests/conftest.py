@@ -0,0 +1,35 @@
+import os
+import tempfile
+
+import pytest
+
+# Config is read from the environment on import
+os.environ.setdefault('DISTENC_IDENTITY', 'manager-test')
+os.environ.setdefault('DISTENC_LOG_DIR', tempfile.mkdtemp(prefix='distenc-logs-'))
+os.environ.setdefault('DISTENC_MANAGER_METRICS_PORT', '0')
+os.environ.setdefault('DISTENC_WORKER_METRICS_PORT', '0')
+
+from mipt_distencode.manager.db_models import Base, Session, make_engine  # noqa: E402
+
+
+@pytest.fixture
+def db(tmp_path):
+    """Session factory bound to an empty SQLite database"""
+    engine = make_engine(f'sqlite:///{tmp_path}/jobs.sqlite3', pool_size=4)
+    Base.metadata.create_all(engine)
+    Session.configure(bind=engine)
+    yield Session
+    engine.dispose()
+
+
+@pytest.fixture
+def servicer(db, monkeypatch):
+    """ManagerServicer without workers, cancellations on workers are recorded"""
+    from mipt_distencode.manager.manager import ManagerServicer
+    servicer = ManagerServicer()
+    servicer.cancelled_on_workers = list()
+    monkeypatch.setattr(
+        servicer, '_cancel_on_worker',
+        lambda job_handle: servicer.cancelled_on_workers.append(job_handle.id) or True)
+    yield servicer
+    servicer.file_pool.shutdown()
@@ -0,0 +1,78 @@
+import datetime
+
+import sqlalchemy
+
+from mipt_distencode.manager.db_models import (
+    MeltJobHandle, MeltJobState, Session, WorkerRecord, make_engine, upgrade_schema, utcnow
+)
+
+
+# Tables as created by the first version of the manager
+FIRST_SCHEMA = [
+    'CREATE TABLE "WorkerRecord" (hostname VARCHAR NOT NULL, state VARCHAR(8) NOT NULL, '
+    'PRIMARY KEY (hostname))',
+    'CREATE TABLE "MeltJobHandle" (id INTEGER NOT NULL, "projectPath" VARCHAR NOT NULL, '
+    '"encodingPresetName" VARCHAR NOT NULL, "resultPath" VARCHAR NOT NULL, '
+    'state VARCHAR(11) NOT NULL, PRIMARY KEY (id))',
+    'INSERT INTO "WorkerRecord" VALUES (\'worker-1\', \'ACTIVE\')',
+    'INSERT INTO "MeltJobHandle" VALUES (1, \'p.mlt\', \'1080p\', \'p.mp4\', \'ACCEPTED\')',
+]
+
+
+def test_upgrade_schema_of_first_version(tmp_path):
+    engine = make_engine(f'sqlite:///{tmp_path}/old.sqlite3', pool_size=2)
+    with engine.begin() as connection:
+        for statement in FIRST_SCHEMA:
+            connection.execute(sqlalchemy.text(statement))
+
+    upgrade_schema(engine)
+    # Idempotent, a restarted manager upgrades nothing
+    upgrade_schema(engine)
+
+    inspector = sqlalchemy.inspect(engine)
+    assert {'MeltJobTransition', 'ManagerReplica', 'JobVerification'} \
+        <= set(inspector.get_table_names())
+    columns = {column['name'] for column in inspector.get_columns('MeltJobHandle')}
+    assert {'priority', 'attempts', 'createdAt', 'submitter', 'manager'} <= columns
+    indexes = {index['name'] for index in inspector.get_indexes('MeltJobHandle')}
+    assert 'ix_MeltJobHandle_state_id' in indexes
+
+    Session.configure(bind=engine)
+    with Session() as session:
+        job_handle = session.get(MeltJobHandle, 1)
+        assert job_handle.state == MeltJobState.ACCEPTED
+        assert job_handle.attempts == 0
+        assert job_handle.createdAt is not None
+        job_handle.state = MeltJobState.CANCELLED
+        session.commit()
+        assert job_handle.proto_status().state == MeltJobState.CANCELLED.proto()
+
+        worker = session.get(WorkerRecord, 'worker-1')
+        assert worker.version == 1
+        assert worker.claim(session, 'manager-test')
+    engine.dispose()
+
+
+def test_leasable_takes_first_jobs_of_every_submitter_and_due_retries(db):
+    with db() as session:
+        for submitter, priority in [('client-1', 0), ('client-1', 5), ('client-1', 0),
+                                    ('client-2', 0), (None, 0)]:
+            session.add(MeltJobHandle(
+                projectPath='p.mlt', encodingPresetName='1080p', resultPath='p.mp4',
+                state=MeltJobState.ACCEPTED, submitter=submitter, priority=priority))
+        for retry_in in [-60, 3600, None]:
+            retry_at = None if retry_in is None else \
+                utcnow() + datetime.timedelta(seconds=retry_in)
+            session.add(MeltJobHandle(
+                projectPath='p.mlt', encodingPresetName='1080p', resultPath='p.mp4',
+                state=MeltJobState.WAITING_RETRY, submitter='client-3', retryAt=retry_at))
+        session.add(MeltJobHandle(
+            projectPath='p.mlt', encodingPresetName='1080p', resultPath='p.mp4',
+            state=MeltJobState.FINISHED, submitter='client-2'))
+        session.commit()
+
+        rows = MeltJobHandle.leasable(session, 2)
+        assert sorted((row.submitter or '', row.id) for row in rows) == [
+            ('', 5), ('client-1', 1), ('client-1', 2), ('client-2', 4), ('client-3', 6),
+            ('client-3', 8)]
+        assert {row.id: row.priority for row in rows}[2] == 5
@@ -0,0 +1,35 @@
+from mipt_distencode.manager.health import HealthMonitor
+from mipt_distencode.mgmt_messages_pb2 import WorkerSelfAnnouncement, WorkerState
+
+
+class RecordingServicer:
+    def __init__(self):
+        self.events = list()
+
+    def worker_alive(self, state, polled_at, recovering=False):
+        self.events.append(('alive', state.hostname, recovering))
+
+    def worker_down(self, hostname):
+        self.events.append(('down', hostname))
+
+
+def test_worker_is_reported_down_once_and_alive_again():
+    servicer = RecordingServicer()
+    monitor = HealthMonitor(servicer, interval=1, timeout=1, max_failures=2)
+    answering = {'worker-1': True, 'worker-2': False}
+    monitor._get_state = lambda hostname: WorkerSelfAnnouncement(
+        hostname=hostname, newState=WorkerState.ACTIVE) if answering[hostname] else None
+    for hostname in answering:
+        monitor.add(hostname)
+
+    monitor.poll(recovering=True)
+    for _ in range(3):
+        monitor.poll()
+    answering['worker-2'] = True
+    monitor.poll()
+    monitor.pool.shutdown()
+
+    assert [event for event in servicer.events if event[1] == 'worker-2'] == [
+        ('down', 'worker-2'), ('alive', 'worker-2', False)]
+    assert servicer.events[0] == ('alive', 'worker-1', True)
+    assert servicer.events.count(('alive', 'worker-1', False)) == 4
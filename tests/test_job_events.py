@@ -0,0 +1,171 @@
+import asyncio
+import socket
+
+import grpc
+import pytest
+from sqlalchemy import event
+
+from mipt_distencode import jobs_pb2
+from mipt_distencode.config import Config
+from mipt_distencode.manager.db_models import MeltJobHandle, MeltJobState, MeltJobTransition
+from mipt_distencode.manager.job_events import JobEvents
+from mipt_distencode.manager.manager_pb2_grpc import ManagerStub
+from mipt_distencode.manager.watch import WatchServer, WatchServicer
+from mipt_distencode.metrics import REGISTRY
+
+from tests.test_manager import post_job
+
+
+@pytest.fixture
+def job_events(db):
+    """JobEvents fanned out by hand, without its thread"""
+    job_events = JobEvents(poll_interval=60, gap_interval=60, max_watchers=10)
+    yield job_events
+    event.remove(db, 'after_commit', job_events._on_commit)
+
+
+def received(delivered) -> 'List[Tuple[int, int]]':
+    statuses = [(status.id.id, status.state) for status in delivered]
+    delivered.clear()
+    return statuses
+
+
+def change_state(session, job_id, transition_id, state):
+    """Moves the job as another replica would, with a transition id it took earlier"""
+    session.get(MeltJobHandle, job_id).state = state
+    session.flush()
+    session.query(MeltJobTransition) \
+        .filter(MeltJobTransition.jobId == job_id, MeltJobTransition.toState == state) \
+        .update({MeltJobTransition.id: transition_id})
+
+
+def test_transition_committed_after_a_later_one_is_fanned_out(db, job_events):
+    with db() as session:
+        first, second = post_job(session), post_job(session)
+        session.commit()
+        first_id, second_id = first.id, second.id
+    watcher = list()
+    job_events.subscribe([first_id, second_id], None, watcher.append)
+    cursor = job_events.cursor
+
+    # The slow transaction took the next id, a later one commits before it
+    with db() as slow, db() as fast:
+        slow.get(MeltJobHandle, second_id)
+        change_state(fast, first_id, cursor + 2, MeltJobState.IN_PROGRESS)
+        fast.commit()
+        job_events._fan_out()
+        assert received(watcher) == [(first_id, MeltJobState.IN_PROGRESS.proto())]
+        assert job_events.cursor == cursor + 2
+        assert list(job_events.gaps) == [cursor + 1]
+
+        change_state(slow, second_id, cursor + 1, MeltJobState.CANCELLED)
+        slow.commit()
+    job_events._fan_out()
+    assert received(watcher) == [(second_id, MeltJobState.CANCELLED.proto())]
+    assert job_events.gaps == {}
+
+    job_events._fan_out()
+    assert received(watcher) == []
+
+
+def test_gap_is_given_up_after_the_interval(db, job_events):
+    job_events.gap_interval = 0
+    with db() as session:
+        job = post_job(session)
+        session.commit()
+        job_id = job.id
+    watcher = list()
+    job_events.subscribe([job_id], None, watcher.append)
+    cursor = job_events.cursor
+    with db() as session:
+        change_state(session, job_id, cursor + 2, MeltJobState.IN_PROGRESS)
+        session.commit()
+    job_events._fan_out()
+    assert received(watcher) == [(job_id, MeltJobState.IN_PROGRESS.proto())]
+    job_events._fan_out()
+    assert job_events.gaps == {}
+
+
+class FakeContext:
+    def __init__(self, peer='client-1'):
+        self.peer = peer
+
+    def auth_context(self):
+        return {'security_level': [b'TSI_PRIVACY_AND_INTEGRITY'],
+                'x509_common_name': [self.peer.encode()]}
+
+    async def abort(self, code, details):
+        raise grpc.RpcError(code, details)
+
+
+async def watch(servicer, watch, stop_after, on_first=None,
+                peer='client-1') -> 'List[Tuple[int, int]]':
+    statuses = list()
+    async for status in WatchServicer(servicer).WatchJobs(watch, FakeContext(peer)):
+        statuses.append((status.id.id, status.state))
+        if len(statuses) == 1 and on_first is not None:
+            await asyncio.get_running_loop().run_in_executor(None, on_first)
+        if len(statuses) == stop_after:
+            break
+    return statuses
+
+
+def test_watch_streams_changes_until_jobs_are_over(servicer, db):
+    with db() as session:
+        job = post_job(session)
+        session.commit()
+        job_id = job.id
+
+    def cancel():
+        with db() as session:
+            session.get(MeltJobHandle, job_id).state = MeltJobState.CANCELLED
+            session.commit()
+        servicer.job_events._fan_out()
+
+    request = jobs_pb2.JobWatch(ids=[jobs_pb2.JobId(id=job_id)])
+    statuses = asyncio.run(watch(servicer, request, stop_after=None, on_first=cancel))
+    assert statuses == [(job_id, jobs_pb2.ACCEPTED), (job_id, jobs_pb2.CANCELLED)]
+    assert servicer.job_events.watcher_count() == 0
+
+
+def test_watch_unknown_job_is_not_found(servicer):
+    request = jobs_pb2.JobWatch(ids=[jobs_pb2.JobId(id=42)])
+    with pytest.raises(grpc.RpcError) as error:
+        asyncio.run(watch(servicer, request, stop_after=1))
+    assert error.value.args[0] == grpc.StatusCode.NOT_FOUND
+    assert servicer.job_events.watcher_count() == 0
+
+
+def test_watch_jobs_of_others_is_denied(servicer, db, monkeypatch):
+    with db() as session:
+        job = post_job(session)
+        session.commit()
+        job_id = job.id
+    by_ids = jobs_pb2.JobWatch(ids=[jobs_pb2.JobId(id=job_id)])
+    by_submitter = jobs_pb2.JobWatch(submitter='client-1')
+    for request in [by_ids, by_submitter]:
+        with pytest.raises(grpc.RpcError) as error:
+            asyncio.run(watch(servicer, request, stop_after=1, peer='client-2'))
+        assert error.value.args[0] == grpc.StatusCode.PERMISSION_DENIED
+    assert servicer.job_events.watcher_count() == 0
+
+    monkeypatch.setattr(Config, 'admin_identities', ['ops'])
+    statuses = asyncio.run(watch(servicer, by_ids, stop_after=1, peer='ops'))
+    assert statuses == [(job_id, jobs_pb2.ACCEPTED)]
+
+
+def test_watch_endpoint_records_rpc_metrics(servicer):
+    with socket.socket() as probe:
+        probe.bind(('localhost', 0))
+        port = probe.getsockname()[1]
+    server = WatchServer(servicer, f'localhost:{port}')
+    server.start()
+    try:
+        with grpc.insecure_channel(f'localhost:{port}') as channel:
+            with pytest.raises(grpc.RpcError) as error:
+                list(ManagerStub(channel).WatchJobs(jobs_pb2.JobWatch(submitter='client-1')))
+        assert error.value.code() == grpc.StatusCode.UNAUTHENTICATED
+    finally:
+        server.stop()
+    assert 'distenc_rpc_total{method="/mipt_distencode.Manager/WatchJobs",' \
+        'code="UNAUTHENTICATED"} 1' in REGISTRY.render()
@@ -0,0 +1,370 @@
+import datetime
+import os
+import time
+
+import grpc
+import pytest
+
+from mipt_distencode import jobs_pb2
+from mipt_distencode.config import Config
+from mipt_distencode.manager.db_models import (
+    ManagerReplica, MeltJobHandle, MeltJobState, WorkerRecord, WorkerState, utcnow
+)
+from mipt_distencode.manager.result_cache import ResultCache
+from mipt_distencode.worker import transfer
+from mipt_distencode.worker.melt_log import LogUploader, MeltLog
+
+
+def post_job(session, submitter='client-1', **fields) -> MeltJobHandle:
+    proto = jobs_pb2.MeltJob(
+        projectPath='/media/p.mlt', encodingPresetName='1080p', resultPath='/media/p.mp4',
+        **fields)
+    return MeltJobHandle.new_from_proto(proto, session, submitter=submitter)
+
+
+class FakeContext:
+    """ServicerContext of a peer authenticated by its client certificate"""
+    def __init__(self, peer='client-1'):
+        self.peer = peer
+
+    def auth_context(self):
+        return {'security_level': [b'TSI_PRIVACY_AND_INTEGRITY'],
+                'x509_common_name': [self.peer.encode()]}
+
+    def abort(self, code, details):
+        raise grpc.RpcError(code, details)
+
+    def is_active(self):
+        return True
+
+
+def split(session, parent, count) -> 'List[MeltJobHandle]':
+    parent.state = MeltJobState.IN_PROGRESS
+    segments = [
+        parent.new_segment(f'/media/p.{index}.mp4', index * 100, index * 100 + 99, session)
+        for index in range(count)
+    ]
+    session.commit()
+    return segments
+
+
+def test_failed_segment_cancels_siblings(servicer, db):
+    with db() as session:
+        parent = post_job(session)
+        failed, running, queued, done = split(session, parent, 4)
+        for segment, state in [(failed, MeltJobState.IN_PROGRESS),
+                               (running, MeltJobState.IN_PROGRESS),
+                               (queued, MeltJobState.WAITING_RETRY),
+                               (done, MeltJobState.FINISHED)]:
+            segment.state = state
+        failed.worker, running.worker = 'worker-1', 'worker-2'
+        session.commit()
+        copy = running.new_speculative_copy('/media/p.1.spec.mp4', session)
+        copy.state, copy.worker = MeltJobState.IN_PROGRESS, 'worker-3'
+        session.commit()
+
+        servicer._fail_job(failed, session)
+        session.commit()
+
+        states = {
+            job_handle.id: job_handle.state for job_handle in
+            session.query(MeltJobHandle).populate_existing()
+        }
+    assert states[parent.id] == MeltJobState.FAILED
+    assert states[failed.id] == MeltJobState.FAILED
+    assert states[running.id] == MeltJobState.CANCELLED
+    assert states[copy.id] == MeltJobState.CANCELLED
+    assert states[queued.id] == MeltJobState.CANCELLED
+    assert states[done.id] == MeltJobState.FINISHED
+    assert sorted(servicer.cancelled_on_workers) == sorted([running.id, copy.id])
+
+
+def test_list_jobs_shows_own_jobs_unless_admin(servicer, db, monkeypatch):
+    with db() as session:
+        own, foreign = post_job(session), post_job(session, submitter='client-2')
+        session.commit()
+        own_id, foreign_id = own.id, foreign.id
+
+    def listed(query, peer) -> 'List[int]':
+        return [status.id.id for status in servicer.ListJobs(query, FakeContext(peer)).jobs]
+
+    assert listed(jobs_pb2.JobQuery(), 'client-1') == [own_id]
+    with pytest.raises(grpc.RpcError) as error:
+        listed(jobs_pb2.JobQuery(submitter='client-2'), 'client-1')
+    assert error.value.args[0] == grpc.StatusCode.PERMISSION_DENIED
+    with pytest.raises(grpc.RpcError) as error:
+        servicer.GetJob(jobs_pb2.JobId(id=foreign_id), FakeContext('client-1'))
+    assert error.value.args[0] == grpc.StatusCode.PERMISSION_DENIED
+
+    monkeypatch.setattr(Config, 'manager_addresses', ['manager-2'])
+    assert listed(jobs_pb2.JobQuery(), 'manager-2') == [foreign_id, own_id]
+    assert listed(jobs_pb2.JobQuery(submitter='client-2'), 'manager-2') == [foreign_id]
+    assert servicer.GetJob(jobs_pb2.JobId(id=foreign_id), FakeContext('manager-2')).id.id \
+        == foreign_id
+
+
+def test_leases_are_renewed_by_owner_and_expire(servicer, db):
+    servicer.push_dispatch = False
+    with db() as session:
+        job_ids = [post_job(session).id for _ in range(3)]
+        session.commit()
+    leased = servicer.LeaseJobs(
+        jobs_pb2.LeaseRequest(hostname='worker-1', maxJobs=2, waitSeconds=0),
+        FakeContext('worker-1'))
+    assert leased.leaseSeconds == Config.lease_seconds
+    leased_ids = [job.id.id for job in leased.jobs]
+    assert len(leased_ids) == 2 and set(leased_ids) < set(job_ids)
+
+    renewal = jobs_pb2.LeaseRenewal(ids=[jobs_pb2.JobId(id=job_id) for job_id in job_ids])
+    assert [job_id.id for job_id in servicer.RenewLeases(renewal, FakeContext('worker-1')).ids] \
+        == leased_ids
+    assert not servicer.RenewLeases(renewal, FakeContext('worker-2')).ids
+
+    expired_id, kept_id = leased_ids
+    with db() as session:
+        session.get(MeltJobHandle, expired_id).leaseDeadline = \
+            utcnow() - datetime.timedelta(seconds=1)
+        session.commit()
+        servicer._expire_leases(session)
+        expired, kept = session.get(MeltJobHandle, expired_id), session.get(MeltJobHandle, kept_id)
+        assert expired.state == MeltJobState.WAITING_RETRY
+        assert expired.leaseOwner is None and expired.failed_on() == ['worker-1']
+        assert kept.state == MeltJobState.IN_PROGRESS and kept.leaseOwner == 'worker-1'
+    assert [job_id.id for job_id in servicer.RenewLeases(renewal, FakeContext('worker-1')).ids] \
+        == [kept_id]
+
+
+def wait_for_state(db, job_id, state, timeout=5) -> MeltJobHandle:
+    deadline = time.monotonic() + timeout
+    while True:
+        with db() as session:
+            job_handle = session.get(MeltJobHandle, job_id)
+            if job_handle.state == state or time.monotonic() > deadline:
+                return job_handle
+        time.sleep(0.01)
+
+
+def test_identical_jobs_coalesce_and_hit_result_cache(servicer, db, tmp_path, monkeypatch):
+    (tmp_path / 'clip.mp4').write_bytes(b'media')
+    (tmp_path / 'p.mlt').write_text(
+        f'<mlt><producer id="clip"><property name="resource">{tmp_path}/clip.mp4</property>'
+        '</producer></mlt>')
+    (tmp_path / '1080p.json').write_text('{}')
+    monkeypatch.setattr(Config, 'melt_preset_dir', str(tmp_path))
+    servicer.result_cache = ResultCache(
+        str(tmp_path / 'cache'), max_bytes=2**20, max_age=datetime.timedelta(days=1))
+
+    def post(result_name) -> int:
+        proto = jobs_pb2.MeltJob(
+            projectPath=str(tmp_path / 'p.mlt'), encodingPresetName='1080p',
+            resultPath=str(tmp_path / result_name))
+        return servicer.PostMeltJob(proto, FakeContext()).id
+
+    leader_id, follower_id = post('a.mp4'), post('b.mp4')
+    with db() as session:
+        leader, follower = session.get(MeltJobHandle, leader_id), \
+            session.get(MeltJobHandle, follower_id)
+        assert leader.state == MeltJobState.ACCEPTED and leader.cacheKey is not None
+        assert follower.state == MeltJobState.COALESCED
+        assert follower.coalescedWith == leader_id
+
+        (tmp_path / 'a.mp4').write_bytes(b'result')
+        servicer._on_verified(leader, session)
+    assert wait_for_state(db, follower_id, MeltJobState.FINISHED).state \
+        == MeltJobState.FINISHED
+    assert (tmp_path / 'b.mp4').read_bytes() == b'result'
+
+    cached_id = post('c.mp4')
+    assert wait_for_state(db, cached_id, MeltJobState.FINISHED).state == MeltJobState.FINISHED
+    assert (tmp_path / 'c.mp4').read_bytes() == b'result'
+    # Only the leader was queued for a worker
+    assert servicer.scheduler.usage()[1] == 1
+
+
+def test_journaled_result_is_accepted_until_another_attempt_starts(servicer, db, monkeypatch):
+    verified = list()
+    monkeypatch.setattr(servicer.verifier, 'submit',
+                        lambda job_handle, callback: verified.append(job_handle.id))
+    with db() as session:
+        late, restarted = post_job(session), post_job(session)
+        for job_handle in [late, restarted]:
+            job_handle.state, job_handle.worker = MeltJobState.WAITING_RETRY, 'worker-1'
+        session.commit()
+        late_id, restarted_id = late.id, restarted.id
+    # The job was requeued while the manager was away, then retried on worker-2
+    with db() as session:
+        MeltJobHandle.transition(session, restarted_id, [MeltJobState.WAITING_RETRY],
+                                 MeltJobState.IN_PROGRESS, worker='worker-2')
+        session.commit()
+
+    def report(job_id):
+        result = jobs_pb2.MeltJobResult(
+            id=jobs_pb2.JobId(id=job_id), success=True, resultPath='/media/p.mp4')
+        return servicer.PostMeltJobResult(result, FakeContext('worker-1'))
+
+    report(late_id)
+    with pytest.raises(grpc.RpcError) as error:
+        report(restarted_id)
+    assert error.value.args[0] == grpc.StatusCode.FAILED_PRECONDITION
+    with db() as session:
+        assert session.get(MeltJobHandle, late_id).state == MeltJobState.VERIFICATION
+        assert session.get(MeltJobHandle, restarted_id).worker == 'worker-2'
+    assert verified == [late_id]
+
+
+class Disconnected(grpc.RpcError):
+    def code(self):
+        return grpc.StatusCode.UNAVAILABLE
+
+    def details(self):
+        return 'stream reset'
+
+
+class UploadingWorker:
+    """Replica client of worker-1 calling the servicer directly, the first
+    upload stream breaks after a chunk"""
+    def __init__(self, servicer):
+        self.servicer = servicer
+        self.offsets = list()
+
+    def GetResultUpload(self, job_id):
+        status = self.servicer.GetResultUpload(job_id, FakeContext('worker-1'))
+        self.offsets.append(status.offset)
+        return status
+
+    def UploadResult(self, chunks):
+        if len(self.offsets) == 1:
+            chunks = self._break_after_first(chunks)
+        return self.servicer.UploadResult(chunks, FakeContext('worker-1'))
+
+    @staticmethod
+    def _break_after_first(chunks):
+        yield next(chunks)
+        raise Disconnected()
+
+
+def test_interrupted_result_upload_resumes_at_stored_offset(servicer, db, tmp_path,
+                                                           monkeypatch):
+    with db() as session:
+        job_handle = post_job(session)
+        job_handle.resultPath = str(tmp_path / 'p.mp4')
+        job_handle.state, job_handle.worker = MeltJobState.IN_PROGRESS, 'worker-1'
+        session.commit()
+        job_id = job_handle.id
+    worker = UploadingWorker(servicer)
+    monkeypatch.setattr(transfer, 'make_replica_client', lambda: worker)
+    uploader = transfer.ResultUploader(str(tmp_path / 'scratch'), chunk_bytes=4,
+                                       retry_seconds=0)
+    scratch = uploader.scratch_path(job_id, str(tmp_path / 'p.mp4'))
+    with open(scratch, 'wb') as scratch_file:
+        scratch_file.write(b'0123456789')
+
+    assert uploader.upload(job_id, scratch)
+    assert worker.offsets == [0, 4]
+    assert (tmp_path / 'p.mp4').read_bytes() == b'0123456789'
+    assert not (tmp_path / 'p.mp4.worker-1.upload').exists()
+    assert not os.path.exists(scratch)
+
+    # Only the worker running the job may upload its result
+    with pytest.raises(grpc.RpcError) as error:
+        servicer.GetResultUpload(jobs_pb2.JobId(id=job_id), FakeContext('worker-2'))
+    assert error.value.args[0] == grpc.StatusCode.FAILED_PRECONDITION
+
+
+def test_replica_takes_over_jobs_and_workers_of_expired_one(servicer, db, monkeypatch):
+    verified = list()
+    monkeypatch.setattr(servicer.verifier, 'submit',
+                        lambda job_handle, callback: verified.append(job_handle.id))
+    with db() as session:
+        now = utcnow()
+        session.add_all([
+            ManagerReplica(identity='manager-2', leaseDeadline=now - datetime.timedelta(seconds=1)),
+            ManagerReplica(identity='manager-3', leaseDeadline=now + datetime.timedelta(minutes=1)),
+            WorkerRecord(hostname='worker-2', state=WorkerState.ACTIVE, owner='manager-2'),
+            WorkerRecord(hostname='worker-3', state=WorkerState.ACTIVE, owner='manager-3'),
+        ])
+        orphaned = post_job(session)
+        orphaned.state = MeltJobState.VERIFICATION
+        session.commit()
+        orphaned_id = orphaned.id
+        # State changes record the replica making them, this one was manager-2
+        session.query(MeltJobHandle).filter(MeltJobHandle.id == orphaned_id) \
+            .update({'manager': 'manager-2'})
+        session.commit()
+
+        servicer._renew_replica(session)
+
+        assert servicer.live_replicas == ['manager-3', Config.identity]
+        assert session.get(ManagerReplica, 'manager-2') is None
+        assert session.get(MeltJobHandle, orphaned_id).manager == Config.identity
+        owners = {record.hostname: record.owner
+                  for record in session.query(WorkerRecord).populate_existing()}
+    assert verified == [orphaned_id]
+    assert owners == {'worker-2': Config.identity, 'worker-3': 'manager-3'}
+    assert servicer.health.hostnames() == {'worker-2'}
+    assert servicer.foreign_workers == {'worker-3'}
+
+
+def test_batch_rejects_invalid_jobs_and_accepts_the_rest(servicer, db):
+    batch = jobs_pb2.MeltJobBatch(jobs=[
+        jobs_pb2.MeltJob(projectPath='/media/a.mlt', encodingPresetName='1080p',
+                         resultPath='/media/a.mp4'),
+        jobs_pb2.MeltJob(projectPath='/media/b.mlt', encodingPresetName='1080p'),
+        jobs_pb2.MeltJob(projectPath='/media/c.mlt', encodingPresetName='1080p',
+                         resultPath='/media/c.mp4'),
+    ])
+    first, invalid, last = servicer.PostMeltJobs(batch, FakeContext()).submissions
+    assert invalid.error == 'Missing field: resultPath' and not invalid.HasField('id')
+    assert not first.HasField('error') and not last.HasField('error')
+    with db() as session:
+        assert [(job_handle.id, job_handle.projectPath, job_handle.submitter)
+                for job_handle in session.query(MeltJobHandle).order_by(MeltJobHandle.id)] \
+            == [(first.id.id, '/media/a.mlt', 'client-1'), (last.id.id, '/media/c.mlt', 'client-1')]
+
+
+def test_extra_outputs_render_in_one_melt_run(servicer, db, monkeypatch):
+    servicer.push_dispatch = False
+    verified = list()
+    monkeypatch.setattr(servicer.verifier, 'submit',
+                        lambda job_handle, callback: verified.append(job_handle.id))
+    proto = jobs_pb2.MeltJob(
+        projectPath='/media/p.mlt', encodingPresetName='1080p', resultPath='/media/p.mp4',
+        extraOutputs=[jobs_pb2.MeltOutput(encodingPresetName='720p',
+                                          resultPath='/media/p.720.mp4')])
+    job_id = servicer.PostMeltJob(proto, FakeContext()).id
+
+    leased = servicer.LeaseJobs(
+        jobs_pb2.LeaseRequest(hostname='worker-1', maxJobs=2, waitSeconds=0),
+        FakeContext('worker-1'))
+    assert [job.id.id for job in leased.jobs] == [job_id]
+    output, = leased.jobs[0].extraOutputs
+    assert (output.encodingPresetName, output.resultPath) == ('720p', '/media/p.720.mp4')
+    with db() as session:
+        bundled = session.get(MeltJobHandle, output.id.id)
+        assert bundled.state == MeltJobState.BUNDLED and bundled.bundledWith == job_id
+
+    servicer.PostMeltJobResult(
+        jobs_pb2.MeltJobResult(id=jobs_pb2.JobId(id=job_id), success=True,
+                               resultPath='/media/p.mp4'),
+        FakeContext('worker-1'))
+    assert sorted(verified) == [job_id, output.id.id]
+
+
+def test_melt_log_keeps_a_bounded_tail_and_uploads_whole(servicer, db, tmp_path,
+                                                        monkeypatch):
+    monkeypatch.setattr(Config, 'log_dir', str(tmp_path))
+    with db() as session:
+        job_id = post_job(session).id
+    lines = [f'line {index}\n'.encode() for index in range(1000)]
+    with MeltLog(job_id, tail_bytes=32) as melt_log:
+        for line in lines:
+            melt_log.write(line + b'Current Frame:  10, percentage:  1\r')
+    text = b''.join(lines)
+    assert melt_log.get_tail() == text[-32:]
+
+    status = servicer.UploadJobLog(LogUploader.chunks(job_id, melt_log.path),
+                                   FakeContext('worker-1'))
+    assert status.size == os.path.getsize(melt_log.path) < len(text)
+    log_range = jobs_pb2.LogRange(id=jobs_pb2.JobId(id=job_id), offset=100, length=50)
+    assert b''.join(chunk.data for chunk in servicer.GetJobLog(log_range, FakeContext())) \
+        == text[100:150]
@@ -0,0 +1,35 @@
+from mipt_distencode.worker.melt import MeltHelper
+
+
+PRESET = {
+    'resources': {'encoder_sessions': 1, 'cpu_threads': 1},
+    'cost': 2.0,
+    'general': {'format': 'mp4', 'size': '1920x1080'},
+    'video': {'vcodec': 'h264_nvenc'},
+}
+
+
+def test_cmdline_skips_cost_and_resources():
+    cmdline = MeltHelper.build_cmdline('/media/p.mlt', PRESET, '/media/p.mp4', 0, 99)
+    assert cmdline[1:] == [
+        '-progress', '/media/p.mlt', 'in=0', 'out=99',
+        '-consumer', 'avformat:/media/p.mp4',
+        'format=mp4', 'size=1920x1080', 'vcodec=h264_nvenc',
+    ]
+
+
+def test_cmdline_of_bundled_outputs_skips_cost():
+    cheap = dict(PRESET, cost=0.5, video={'vcodec': 'libx264'})
+    cmdline = MeltHelper.build_cmdline(
+        '/media/p.mlt', PRESET, '/media/a.mp4', extra_outputs=[(cheap, '/media/b.mp4')])
+    assert cmdline[cmdline.index('-consumer'):] == [
+        '-consumer', 'multi',
+        '0=avformat:/media/a.mp4', '0.format=mp4', '0.size=1920x1080', '0.vcodec=h264_nvenc',
+        '1=avformat:/media/b.mp4', '1.format=mp4', '1.size=1920x1080', '1.vcodec=libx264',
+    ]
+
+
+def test_unknown_scalar_key_is_not_a_section():
+    preset = dict(PRESET, comment='archive copies')
+    cmdline = MeltHelper.build_cmdline('/media/p.mlt', preset, '/media/p.mp4')
+    assert not any('archive' in argument for argument in cmdline[1:])
@@ -0,0 +1,50 @@
+import time
+from concurrent import futures
+
+import grpc
+import pytest
+
+from mipt_distencode.pb_common import ChannelPool
+
+
+def ticks(count, context):
+    for tick in range(count[0]):
+        time.sleep(0.2)
+        yield bytes([tick])
+
+
+@pytest.fixture
+def endpoint():
+    """A server streaming a byte every 0.2 s, as many as the request's first byte"""
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=2))
+    server.add_generic_rpc_handlers([grpc.method_handlers_generic_handler('test.Ticks', {
+        'Ticks': grpc.unary_stream_rpc_method_handler(ticks),
+    })])
+    port = server.add_insecure_port('localhost:0')
+    server.start()
+    yield f'localhost:{port}'
+    server.stop(None)
+
+
+def call(channel, count):
+    return channel.unary_stream('/test.Ticks/Ticks')(bytes([count]), timeout=10)
+
+
+def test_stream_outlasting_the_idle_timeout_is_not_cut(endpoint):
+    pool = ChannelPool(idle_seconds=0.5)
+    try:
+        channel = pool.get(endpoint)
+        assert pool.get(endpoint) is channel
+        received = b''
+        # Twice the idle timeout, the open call keeps the channel
+        for tick in call(channel, 5):
+            received += tick
+            # Other callers use the pool meanwhile
+            pool.get('localhost:1')
+        assert received == bytes(range(5))
+        time.sleep(1)
+        # Idle since, the same channel connects again
+        assert pool.get(endpoint) is channel
+        assert b''.join(call(channel, 1)) == b'\0'
+    finally:
+        pool.close()
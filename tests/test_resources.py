@@ -0,0 +1,78 @@
+import pytest
+
+from mipt_distencode.worker.resources import ResourcePool, parse_resources
+
+
+def make_pool() -> ResourcePool:
+    return ResourcePool({'cpu_threads': 8, 'encoder_sessions': 2, 'memory_mb': 4096})
+
+
+def test_parse_resources():
+    assert parse_resources('cpu_threads=32, encoder_sessions=3,,memory_mb=65536') == {
+        'cpu_threads': 32, 'encoder_sessions': 3, 'memory_mb': 65536}
+    assert parse_resources('') == {}
+    with pytest.raises(ValueError):
+        parse_resources('cpu_threads')
+    with pytest.raises(ValueError):
+        parse_resources('cpu_threads=many')
+
+
+def test_from_config_overrides_defaults():
+    pool = ResourcePool.from_config('encoder_sessions=3,gpus=1')
+    assert pool.capacity['encoder_sessions'] == 3
+    assert pool.capacity['gpus'] == 1
+    assert pool.capacity['cpu_threads'] >= 1
+
+
+def test_try_acquire_admits_whole_demand_only():
+    pool = make_pool()
+    assert pool.try_acquire(1, {'cpu_threads': 6, 'encoder_sessions': 1})
+    # Encoder sessions would fit, CPU threads not
+    assert not pool.try_acquire(2, {'cpu_threads': 4, 'encoder_sessions': 1})
+    assert pool.free() == {'cpu_threads': 2, 'encoder_sessions': 1, 'memory_mb': 4096}
+    assert pool.try_acquire(2, {'cpu_threads': 2, 'encoder_sessions': 1})
+    assert not pool.try_acquire(3, {'encoder_sessions': 1})
+    pool.release(1)
+    assert pool.try_acquire(3, {'encoder_sessions': 1})
+
+
+def test_unknown_resource_is_never_free():
+    pool = make_pool()
+    assert not pool.satisfiable({'gpus': 1})
+    assert not pool.try_acquire(1, {'gpus': 1})
+    assert pool.satisfiable({'cpu_threads': 8, 'memory_mb': 4096})
+    assert not pool.satisfiable({'cpu_threads': 9})
+
+
+def test_suspended_job_keeps_sessions_and_memory():
+    pool = make_pool()
+    demand = {'cpu_threads': 8, 'encoder_sessions': 1, 'memory_mb': 3072}
+    assert pool.try_acquire(1, demand)
+    pool.suspend(1)
+    assert pool.free() == {'cpu_threads': 8, 'encoder_sessions': 1, 'memory_mb': 1024}
+    # CPU threads are free for the urgent job, memory held by the stopped one is not
+    assert not pool.try_acquire(2, {'cpu_threads': 8, 'encoder_sessions': 1,
+                                    'memory_mb': 2048})
+    urgent = {'cpu_threads': 8, 'encoder_sessions': 1, 'memory_mb': 1024}
+    assert pool.try_acquire(2, urgent)
+    assert not pool.try_acquire(3, {'encoder_sessions': 1})
+
+
+def test_try_resume_needs_the_rest_of_the_demand():
+    pool = make_pool()
+    demand = {'cpu_threads': 6, 'encoder_sessions': 1, 'memory_mb': 2048}
+    assert pool.try_acquire(1, demand)
+    pool.suspend(1)
+    assert pool.try_acquire(2, {'cpu_threads': 4, 'encoder_sessions': 1})
+    # Only the 6 CPU threads given up are missing, 4 are free
+    assert not pool.try_resume(1, demand)
+    assert pool.free()['cpu_threads'] == 4
+    pool.release(2)
+    assert pool.try_resume(1, demand)
+    assert pool.free() == {'cpu_threads': 2, 'encoder_sessions': 1, 'memory_mb': 2048}
+
+
+def test_suspend_of_unknown_job_is_ignored():
+    pool = make_pool()
+    pool.suspend(42)
+    assert pool.free() == pool.capacity
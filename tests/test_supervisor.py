@@ -0,0 +1,34 @@
+import subprocess
+import sys
+import time
+
+import pytest
+
+from mipt_distencode.jobs_pb2 import NORMAL
+from mipt_distencode.worker.supervisor import MeltSupervisor, MeltTimeout
+
+
+SLEEPER = [sys.executable, '-c', 'import time; time.sleep(30)']
+
+
+@pytest.fixture
+def supervisor():
+    supervisor = MeltSupervisor({}, grace_seconds=5)
+    yield supervisor
+    supervisor.stop()
+
+
+def test_cancel_before_the_run_is_registered_kills_melt(supervisor):
+    # The cancel found no run, the mark it left is seen once melt started
+    assert not supervisor.cancel(1)
+    started = time.monotonic()
+    with pytest.raises(subprocess.CalledProcessError):
+        supervisor.run(1, SLEEPER, NORMAL, None, lambda chunk: None, lambda: True)
+    assert time.monotonic() - started < 10
+    assert not supervisor.runs
+
+
+def test_run_longer_than_its_timeout_is_killed(supervisor):
+    with pytest.raises(MeltTimeout):
+        supervisor.run(2, SLEEPER, NORMAL, 1, lambda chunk: None)
+    assert not supervisor.runs
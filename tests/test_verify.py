@@ -0,0 +1,155 @@
+import json
+import os
+
+import pytest
+
+from mipt_distencode.config import Config
+from mipt_distencode.manager.db_models import (
+    JobVerification, MeltJobHandle, MeltJobState, Session
+)
+from mipt_distencode.manager.verify import ResultTarget, ResultVerifier, check_ffprobe
+
+from tests.test_manager import post_job, split
+
+
+FAKE_FFPROBE = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'scripts', 'fake-ffprobe.py')
+PRESET = {
+    'general': {'format': 'mp4', 'framerate': '30'},
+    'audio': {'acodec': 'aac'},
+    'video': {'vcodec': 'libx264'},
+}
+
+
+@pytest.fixture
+def media(tmp_path, monkeypatch):
+    """A 100 frame project at 30 fps and a directory with its preset"""
+    monkeypatch.setattr(Config, 'ffprobe_path', FAKE_FFPROBE)
+    if not os.access(FAKE_FFPROBE, os.X_OK):
+        pytest.skip('fake-ffprobe.py is not executable')
+    (tmp_path / 'p.mlt').write_text(
+        '<mlt><profile frame_rate_num="30" frame_rate_den="1"/>'
+        '<tractor id="t" in="0" out="99"/></mlt>')
+    presets = tmp_path / 'presets'
+    presets.mkdir()
+    (presets / '1080p.json').write_text(json.dumps(PRESET))
+    return tmp_path
+
+
+def write_result(path, project_path, *frame_ranges):
+    """What fake-melt.py writes, a line per encoded segment"""
+    with open(path, 'w') as result:
+        for in_frame, out_frame in frame_ranges:
+            argv = ['-progress', project_path, f'in={in_frame}', f'out={out_frame}',
+                    '-consumer', f'avformat:{path}',
+                    *(f'{key}={value}' for section in PRESET.values()
+                      for key, value in section.items())]
+            result.write(json.dumps({'consumer': None, 'argv': argv}) + '\n')
+
+
+def make_verifier(media) -> ResultVerifier:
+    return ResultVerifier(1, str(media / 'presets'), frame_tolerance=2)
+
+
+def target(media, **fields) -> ResultTarget:
+    job_handle = MeltJobHandle(
+        id=1, projectPath=str(media / 'p.mlt'), encodingPresetName='1080p',
+        resultPath=str(media / 'p.mp4'), **fields)
+    return ResultTarget(job_handle)
+
+
+def test_result_passes(media):
+    write_result(media / 'p.mp4', str(media / 'p.mlt'), (0, 99))
+    verification = make_verifier(media).verify(target(media))
+    assert verification.error is None
+    assert verification.ok
+    assert verification.frames == verification.expectedFrames == 100
+    assert verification.duration == pytest.approx(100 / 30)
+    assert len(verification.checksum) == 64
+
+
+def test_segment_result_passes(media):
+    write_result(media / 'p.mp4', str(media / 'p.mlt'), (50, 99))
+    verification = make_verifier(media).verify(target(media, inFrame=50, outFrame=99))
+    assert verification.ok
+    assert verification.frames == 50
+
+
+@pytest.mark.parametrize('environment, error', [
+    ({'FAKE_FFPROBE_FRAMES': '90'}, '90 frames, expected 100'),
+    ({'FAKE_FFPROBE_EXIT_CODE': '1'}, 'ffprobe failed'),
+])
+def test_result_fails(media, monkeypatch, environment, error):
+    write_result(media / 'p.mp4', str(media / 'p.mlt'), (0, 99))
+    for name, value in environment.items():
+        monkeypatch.setenv(name, value)
+    verification = make_verifier(media).verify(target(media))
+    assert not verification.ok
+    assert error in verification.error
+
+
+def test_result_fails_without_ffprobe(media, monkeypatch):
+    write_result(media / 'p.mp4', str(media / 'p.mlt'), (0, 99))
+    monkeypatch.setattr(Config, 'ffprobe_path', str(media / 'no-ffprobe'))
+    verification = make_verifier(media).verify(target(media))
+    assert not verification.ok
+    assert verification.error.startswith('Cannot run ffprobe')
+    with pytest.raises(RuntimeError):
+        check_ffprobe()
+
+
+def test_empty_result_fails(media):
+    (media / 'p.mp4').write_bytes(b'')
+    verification = make_verifier(media).verify(target(media))
+    assert not verification.ok
+    assert verification.error == 'Empty result file'
+
+
+def merged_parent(db, media) -> 'Tuple[int, List[int]]':
+    """A job of two finished segments merged into its result, in VERIFICATION"""
+    with db() as session:
+        parent = post_job(session)
+        parent.projectPath = str(media / 'p.mlt')
+        parent.encodingPresetName = '1080p'
+        parent.resultPath = str(media / 'p.mp4')
+        segments = split(session, parent, 2)
+        for segment in segments:
+            segment.state = MeltJobState.FINISHED
+        parent.state = MeltJobState.VERIFICATION
+        session.commit()
+        return parent.id, [segment.id for segment in segments]
+
+
+def verify_on_pool(servicer, verifier, job_id):
+    servicer.verifier.pool.shutdown()
+    servicer.verifier = verifier
+    with Session() as session:
+        verifier.submit(session.get(MeltJobHandle, job_id), servicer._on_verification_done)
+    # Waits for the check and the callback
+    verifier.pool.shutdown(wait=True)
+
+
+def test_merged_parent_verified(servicer, db, media):
+    write_result(media / 'p.mp4', str(media / 'p.mlt'), (0, 49), (50, 99))
+    parent_id, segment_ids = merged_parent(db, media)
+    verify_on_pool(servicer, make_verifier(media), parent_id)
+    with db() as session:
+        assert session.get(MeltJobHandle, parent_id).state == MeltJobState.FINISHED
+        [verification] = JobVerification.of_job(session, parent_id)
+        assert verification.ok and verification.frames == 100
+
+
+def test_merged_parent_failing_verification_fails(servicer, db, media):
+    # A segment is missing from the merged result
+    write_result(media / 'p.mp4', str(media / 'p.mlt'), (0, 49))
+    parent_id, segment_ids = merged_parent(db, media)
+    verify_on_pool(servicer, make_verifier(media), parent_id)
+    with db() as session:
+        # Not retried, the segments are merged already
+        job_handle = session.get(MeltJobHandle, parent_id)
+        assert job_handle.state == MeltJobState.FAILED
+        assert job_handle.attempts == 0
+        [verification] = JobVerification.of_job(session, parent_id)
+        assert verification.error == '50 frames, expected 100'
+        assert all(session.get(MeltJobHandle, segment_id).state == MeltJobState.FINISHED
+                   for segment_id in segment_ids)
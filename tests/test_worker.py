@@ -0,0 +1,137 @@
+import json
+import os
+import queue
+
+import grpc
+import pytest
+
+from mipt_distencode.config import Config
+from mipt_distencode.jobs_pb2 import JobId, MeltJob, MeltJobResult
+from mipt_distencode.mgmt_messages_pb2 import WorkerState
+from mipt_distencode.worker import worker as worker_module
+from mipt_distencode.worker.worker import WorkerServicer
+
+
+FAKE_MELT = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'scripts', 'fake-melt.py')
+PRESETS = {
+    'nvenc': {'resources': {'encoder_sessions': 1, 'cpu_threads': 1},
+              'general': {'format': 'mp4'}, 'video': {'vcodec': 'h264_nvenc'}},
+    'x264': {'resources': {'cpu_threads': 4},
+             'general': {'format': 'mp4'}, 'video': {'vcodec': 'libx264'}},
+}
+
+
+@pytest.fixture
+def worker(tmp_path, monkeypatch):
+    """WorkerServicer running fake-melt.py, results are collected instead of reported"""
+    if not os.access(FAKE_MELT, os.X_OK):
+        pytest.skip('fake-melt.py is not executable')
+    presets = tmp_path / 'presets'
+    presets.mkdir()
+    for name, preset in PRESETS.items():
+        (presets / f'{name}.json').write_text(json.dumps(preset))
+    for name, value in [('melt_path', FAKE_MELT), ('melt_preset_dir', str(presets)),
+                        ('worker_slots', 4),
+                        ('worker_resources', 'cpu_threads=8,encoder_sessions=2'),
+                        ('dispatch_mode', 'push'), ('result_transfer', 'shared'),
+                        ('media_cache_dir', None),
+                        ('result_journal_dir', str(tmp_path / 'journal'))]:
+        monkeypatch.setattr(Config, name, value)
+    monkeypatch.setenv('FAKE_MELT_SECONDS', '1')
+    monkeypatch.setattr(worker_module.LogUploader, 'upload', lambda job_id, path: True)
+    worker = WorkerServicer()
+    worker.results = queue.SimpleQueue()
+    monkeypatch.setattr(worker, '_send_result', lambda message: worker.results.put(message))
+    (tmp_path / 'p.mlt').write_text(
+        '<mlt><profile frame_rate_num="25" frame_rate_den="1"/>'
+        '<tractor id="t" in="0" out="24"/></mlt>')
+    worker.tmp_path = tmp_path
+    yield worker
+    worker.melt_pool.shutdown(wait=True)
+    worker.supervisor.stop()
+
+
+def job(worker, job_id, preset) -> MeltJob:
+    return MeltJob(id=JobId(id=job_id), projectPath=str(worker.tmp_path / 'p.mlt'),
+                   encodingPresetName=preset,
+                   resultPath=str(worker.tmp_path / f'{job_id}.mp4'))
+
+
+def free_resources(worker) -> 'Dict[str, int]':
+    """Advertised free amounts of the resources the presets declare"""
+    message = worker._state_message(WorkerState.ACTIVE)
+    return {amount.name: amount.amount for amount in message.freeResources
+            if amount.name in ['cpu_threads', 'encoder_sessions']}
+
+
+def test_jobs_beyond_free_encoders_wait(worker):
+    for job_id in [1, 2, 3]:
+        worker.accept_leased(job(worker, job_id, 'nvenc'))
+
+    # Two encoder sessions, the third job waits although slots are free
+    assert sorted(worker.running_jobs) == [1, 2]
+    assert [waiting.id.id for waiting in worker.waiting_jobs] == [3]
+    assert free_resources(worker) == {'cpu_threads': 6, 'encoder_sessions': 0}
+    assert worker._state_message(WorkerState.ACTIVE).freeSlots == 1
+    # Resources it does not need are free for a CPU job
+    worker.accept_leased(job(worker, 4, 'x264'))
+    assert sorted(worker.running_jobs) == [1, 2, 4]
+    assert free_resources(worker) == {'cpu_threads': 2, 'encoder_sessions': 0}
+
+    results = [worker.results.get(timeout=30) for _ in range(4)]
+    assert all(result.success for result in results)
+    # Started once an encoder session was released
+    assert results[-1].id.id == 3
+    assert free_resources(worker) == {'cpu_threads': 8, 'encoder_sessions': 2}
+    assert not worker.waiting_jobs
+    written = json.loads((worker.tmp_path / '3.mp4').read_text())
+    assert 'vcodec=h264_nvenc' in written['argv']
+
+
+def test_job_needing_more_than_the_worker_has_is_rejected(worker):
+    worker.resources.capacity['encoder_sessions'] = 0
+    worker.accept_leased(job(worker, 1, 'nvenc'))
+    result = worker.results.get(timeout=5)
+    assert not result.success
+    assert b'need more resources' in result.error
+    assert not worker.waiting_jobs
+
+
+class FakeManager:
+    """Replica client that is unreachable until it goes up"""
+    class Unavailable(grpc.RpcError):
+        def code(self):
+            return grpc.StatusCode.UNAVAILABLE
+
+        def details(self):
+            return 'connection refused'
+
+    def __init__(self):
+        self.up = False
+        self.results = list()
+
+    def PostMeltJobResult(self, message):
+        if not self.up:
+            raise self.Unavailable()
+        self.results.append(message.id.id)
+        return message
+
+
+def test_results_are_journaled_until_the_manager_takes_them(worker, monkeypatch):
+    manager = FakeManager()
+    monkeypatch.setattr(worker_module, 'make_replica_client', lambda: manager)
+    monkeypatch.delattr(worker, '_send_result')
+    for job_id in [2, 1]:
+        worker._report_job_result(
+            MeltJobResult(id=JobId(id=job_id), success=True, resultPath=f'/media/{job_id}.mp4'))
+    assert worker.journal.job_ids() == [1, 2]
+    # Undelivered results are still jobs of the worker
+    assert worker._state_message(WorkerState.ACTIVE).activeJobIds == [1, 2]
+
+    worker.replay_results()
+    assert worker.journal.job_ids() == [1, 2]
+    manager.up = True
+    worker.replay_results()
+    assert manager.results == [1, 2]
+    assert worker.journal.job_ids() == []